@@ -0,0 +1,91 @@
+"""
+Per-step overhead of callback dispatch.
+
+Compares the dispatch table of `_BaseTrainer` with iterating every callback and dispatching by function name
+(`BaseCallback.on_begin/on_end`), on a no-op `train_step` with typical callbacks registered.
+
+    python examples/benchmark/callback_dispatch.py --steps 100000
+"""
+import argparse
+import time
+
+from lumo.trainer.base import _BaseTrainer
+from lumo.trainer import callbacks
+
+
+class ToyTrainer(_BaseTrainer):
+    callback_function = {'train_step'}
+
+    def __init__(self):
+        self.params = None
+
+    def train(self):
+        pass
+
+    test = evaluate = train
+
+    def train_step(self, batch, params=None):
+        return batch
+
+
+class StepCounter(callbacks.TrainCallback):
+    def __init__(self):
+        self.c = 0
+
+    def on_train_step_end(self, trainer, func, params, metric, *args, **kwargs):
+        self.c += 1
+
+
+def create_callbacks():
+    # callbacks which only hook epoch/train/initial level functions, and one hooking the step
+    return [
+        callbacks.EvalCallback(),
+        callbacks.EpochCheckpoint(),
+        callbacks.SeedCallback(),
+        callbacks.AutoLoadModel(),
+        callbacks.EvalFirst(),
+        callbacks.TrainCallback(),
+        callbacks.InitialCallback(),
+        StepCounter(),
+    ]
+
+
+def legacy_step(trainer, func, batch):
+    """The dispatch before the table: every callback is called and re-dispatches by name."""
+    for callback in trainer.callbacks:
+        callback.on_begin(trainer, func, trainer.params, batch)
+    res = func(batch)
+    for callback in trainer.callbacks:
+        callback.on_end(trainer, func, trainer.params, res, batch)
+    return res
+
+
+def bench(fn, steps):
+    start = time.perf_counter()
+    for i in range(steps):
+        fn(i)
+    return (time.perf_counter() - start) / steps * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=100000)
+    args = parser.parse_args()
+
+    trainer = ToyTrainer()
+    for callback in create_callbacks():
+        trainer.callbacks.append(callback)
+        callback._hooked = trainer
+    raw = ToyTrainer.train_step.__get__(trainer)
+
+    bare = bench(raw, args.steps)
+    legacy = bench(lambda i: legacy_step(trainer, raw, i), args.steps)
+    table = bench(trainer.train_step, args.steps)
+    print(f'{len(trainer.callbacks)} callbacks, {args.steps} steps')
+    print(f'bare train_step      : {bare:.2f} us/step')
+    print(f'iterate all callbacks: {legacy - bare:.2f} us/step overhead')
+    print(f'dispatch table       : {table - bare:.2f} us/step overhead')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,3 @@
+# 
+
+python /tmp/s19/run.py $@
\ No newline at end of file
@@ -28,12 +28,35 @@ def classify(preds: torch.Tensor,
     """
     if topk is None:
         topk = (1, 5)
-    k = topk
-    _, maxk = torch.topk(preds, max(*k), dim=-1)
     total = labels.size(0)
-    test_labels = labels.view(-1, 1)  # reshape labels from [n] to [n,1] to compare [n,k]
+    # one host sync for all k
+    counts = topk_correct(preds, labels, topk).tolist()
 
     if cacu_rate:
-        return [(test_labels == maxk[:, 0:i]).sum().item() / total for i in k]
+        return [count / total for count in counts]
     else:
-        return total, [(test_labels == maxk[:, 0:i]).sum().item() for i in k]
+        return total, counts
+
+
+def topk_correct(preds: torch.Tensor, labels: torch.Tensor, topk: List[int] = (1, 5)) -> torch.Tensor:
+    """
+    Number of samples whose label is in the top-k predictions, for each k in one pass, without syncing with host.
+
+    Args:
+        preds: [batch,logits]
+        labels: [labels,]
+        topk: list(int)
+
+    Returns:
+        a long tensor of shape [len(topk)] on the device of `preds`.
+    """
+    _, maxk = torch.topk(preds, max(topk), dim=-1)
+    # hit[:, i] is True if the label is in top-(i+1)
+    hit = (maxk == labels.view(-1, 1)).cumsum(dim=-1) > 0
+    index = torch.tensor([k - 1 for k in topk], device=hit.device)
+    return hit.index_select(1, index).sum(dim=0)
+
+
+def topk_accuracy(preds: torch.Tensor, labels: torch.Tensor, topk: List[int] = (1, 5)) -> torch.Tensor:
+    """Same as `topk_correct()` but returns the rates, a float tensor of shape [len(topk)]."""
+    return topk_correct(preds, labels, topk).float() / max(labels.size(0), 1)
@@ -1,7 +1,7 @@
 """
 Used for recording data
 """
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from collections.abc import ItemsView
 from numbers import Number
 from typing import Union, Iterator, Tuple, Mapping, Sequence
@@ -14,12 +14,19 @@ from lumo.core import PropVar
 
 
 class Meter(metaclass=PropVar):
-    def __init__(self):
+    """
+    Args:
+        lazy: if True, scalar tensors are kept (detached) on their device instead of being converted by `.item()`,
+            so recording metrics does not synchronize with the device. `Record` aggregates them on device.
+    """
+
+    def __init__(self, lazy=False):
         self._rec = {}
         self._avg = {}
+        self._lazy = lazy
 
     def sorted(self) -> 'Meter':
-        m = Meter()
+        m = Meter(lazy=self._lazy)
         m._rec = self._rec
         m._avg = OrderedDict()
         m._prop = self._prop
@@ -48,23 +55,28 @@ class Meter(metaclass=PropVar):
         return self._rec[item]
 
     def __setitem__(self, key, value):
-        value = to_ndarray(value)
+        lazy = self._lazy and isinstance(value, torch.Tensor) and value.numel() == 1
+        if lazy:
+            value = value.detach().reshape(())
+            dtype = str(value.dtype)
+            isscalar = True
+        else:
+            value = to_ndarray(value)
+            dtype = value.dtype.name
+            isscalar = value.size == 1
 
         stg = self._avg.get(key, None)
-        isscalar = value.size == 1
 
         if stg is None:
-            dtype = value.dtype.name
-
             if self._stage in {'min', 'max'} and not isscalar:
                 raise ValueError(
                     f'Only support min/max(a) operator on scalar metrics, but got data of shape {value.shape}.')
-            elif self._stage in {'min', 'max', 'sum', 'mean', 'smean'} and 'str' in dtype:
+            elif self._stage in {'min', 'max', 'sum', 'mean', 'smean', 'slide', 'ema'} and 'str' in dtype:
                 raise ValueError(f'Only support min/max/sum/mean operator on tensor metrics, but got type {dtype}.')
 
             if self._stage == 'default':
                 if isscalar:
-                    if 'int' in dtype:
+                    if 'int' in dtype or 'str' in dtype:
                         self._stage = 'last'
                     else:
                         self._stage = 'mean'
@@ -73,14 +85,14 @@ class Meter(metaclass=PropVar):
 
             self._avg[key] = self._stage
 
-        if isscalar:
+        if isscalar and not lazy:
             value = value.item()
 
         self._rec[key] = value
         self._stage = 'default'
 
     def __repr__(self):
-        return ' | '.join([f'{k}: {v}' for k, v in self._rec.items()])
+        return ' | '.join([f'{k}: {v}' for k, v in self.host_items()])
 
     def __iter__(self):
         yield from self.keys()
@@ -115,6 +127,18 @@ class Meter(metaclass=PropVar):
         self._stage = 'smean'
         return self
 
+    @property
+    def slide(self):
+        """mean of the latest `Record.window_size` values."""
+        self._stage = 'slide'
+        return self
+
+    @property
+    def ema(self):
+        """exponential moving average with `Record.ema_decay`."""
+        self._stage = 'ema'
+        return self
+
     def update(self, dic: Mapping) -> 'Meter':
         for k, v in dic.items():
             self[str(k)] = v
@@ -122,19 +146,26 @@ class Meter(metaclass=PropVar):
 
     def serialize(self) -> OrderedDict:
         res = OrderedDict()
-        for k, v in self.items():
+        for k, v in self.host_items():
             res[k] = f'{v}'
         return res
 
     def items(self) -> ItemsView:
         return self._rec.items()
 
+    def host_items(self) -> Iterator[Tuple[str, object]]:
+        """Like `items()`, but lazy scalar tensors are converted to python numbers."""
+        for k, v in self._rec.items():
+            if isinstance(v, torch.Tensor):
+                v = v.item()
+            yield k, v
+
     def keys(self):
         return self._rec.keys()
 
     @staticmethod
-    def from_dict(dic: Mapping):
-        m = Meter()
+    def from_dict(dic: Mapping, lazy=False):
+        m = Meter(lazy=lazy)
         for k, v in dic.items():
             m[k] = v
         return m
@@ -153,7 +184,10 @@ class AvgItem:
     def __init__(self, item, gb_method):
         item_ = detach(item)
         self.gb_method = gb_method  # groupby method
-        self.acc = [item_]
+        if gb_method == 'slide':
+            self.acc = deque([item_], maxlen=AvgItem.SLIDE_WINDOW_SIZE)
+        else:
+            self.acc = [item_]
         self.c = 1
         self.cur = item
         self.last = item_
@@ -204,8 +238,6 @@ class AvgItem:
 
         if avg == 'slide':
             self.acc.append(item)
-            if len(self.acc) > AvgItem.SLIDE_WINDOW_SIZE:
-                self.acc.pop(0)
             self.last = self.cur
         elif avg in {'mean', 'sum'}:
             self.acc[0] = self.acc[0] + item
@@ -18,7 +18,7 @@ from collections import namedtuple
 record_event = namedtuple('record_event', ['global_step', 'metric', 'time'])
 
 
-def wrap_result(metric: MetricType) -> Meter:
+def wrap_result(metric: MetricType, lazy=False) -> Meter:
     """
     Wrap any form of metric data into Meter form.
 
@@ -26,30 +26,243 @@ def wrap_result(metric: MetricType) -> Meter:
     if isinstance(metric, (Meter,)):
         return metric
     elif isinstance(metric, Mapping):
-        return Meter.from_dict(metric)
+        return Meter.from_dict(metric, lazy=lazy)
     elif isinstance(metric, Sequence):
-        return Meter.from_dict({f'm{i}': v for i, v in enumerate(metric)})
+        return Meter.from_dict({f'm{i}': v for i, v in enumerate(metric)}, lazy=lazy)
     elif isinstance(metric, (torch.Tensor, np.ndarray, float, int)):
-        return Meter.from_dict({'metric': metric})
-    return Meter()
+        return Meter.from_dict({'metric': metric}, lazy=lazy)
+    return Meter(lazy=lazy)
+
+
+class MetricBuffer:
+    """
+    Per-step values of a scalar metric, stored in a preallocated numpy array which is grown geometrically.
+    If `maxlen` is given, only the latest `maxlen` values are kept as a ring buffer, while the running
+    count/sum/min/max/ema still cover all values.
+
+    Args:
+        capacity: initial size of the array.
+        maxlen: max number of values kept, None means unbounded.
+        dtype: dtype of values, int64/bool buffers are promoted to float64 if a float is appended.
+        ema_decay: decay of the exponential moving average.
+    """
+
+    def __init__(self, capacity=64, maxlen=None, dtype=np.float64, ema_decay=0.9):
+        self.maxlen = maxlen
+        if maxlen is not None:
+            capacity = min(capacity, maxlen)
+        self._data = np.empty(max(capacity, 1), dtype=dtype)
+        self._start = 0  # position of the oldest value when the ring is full
+        self._size = 0
+        self.ema_decay = ema_decay
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.ema = None
+
+    @property
+    def dtype(self):
+        return self._data.dtype
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size):
+        capacity = len(self._data)
+        if size <= capacity or capacity == self.maxlen:
+            return
+        while capacity < size:
+            capacity *= 2
+        if self.maxlen is not None:
+            capacity = min(capacity, self.maxlen)
+        data = np.empty(capacity, dtype=self._data.dtype)
+        data[:self._size] = self._data[:self._size]
+        self._data = data
+
+    def _promote(self, values: np.ndarray):
+        if values.dtype.kind == 'f' and self._data.dtype.kind != 'f':
+            self._data = self._data.astype(np.float64)
+
+    def append(self, value):
+        """Append one value, the stats are updated without creating temporary arrays."""
+        if isinstance(value, float) and self._data.dtype.kind != 'f':
+            self._data = self._data.astype(np.float64)
+        if self.maxlen is None or self._size < self.maxlen:
+            self._reserve(self._size + 1)
+            self._data[self._size] = value
+            self._size += 1
+        else:
+            self._data[self._start] = value
+            self._start = (self._start + 1) % self.maxlen
+
+        self.count += 1
+        self.sum = self.sum + value
+        self.min = value if self.min is None or value < self.min else self.min
+        self.max = value if self.max is None or value > self.max else self.max
+        self.ema = value if self.ema is None else self.ema * self.ema_decay + value * (1 - self.ema_decay)
+        self.last = value
+
+    def extend(self, values: np.ndarray):
+        """Append an array of values, the stats are updated vectorized."""
+        values = np.asarray(values).reshape(-1)
+        if len(values) == 0:
+            return
+        self._promote(values)
+
+        self.count += len(values)
+        self.sum = self.sum + values.sum().item()
+        vmin, vmax = values.min().item(), values.max().item()
+        self.min = vmin if self.min is None else min(self.min, vmin)
+        self.max = vmax if self.max is None else max(self.max, vmax)
+        self.last = values[-1].item()
+        self.ema = _ema(self.ema, values, self.ema_decay)
+
+        if self.maxlen is not None and len(values) >= self.maxlen:
+            self._reserve(self.maxlen)
+            self._data[:] = values[-self.maxlen:]
+            self._start, self._size = 0, self.maxlen
+            return
+        if self.maxlen is None or self._size + len(values) <= self.maxlen:
+            self._reserve(self._size + len(values))
+            self._data[self._size:self._size + len(values)] = values
+            self._size += len(values)
+            return
+
+        # ring is (or will be) full, write from the oldest position with wrap-around.
+        self._reserve(self.maxlen)
+        free = self.maxlen - self._size
+        self._data[self._size:] = values[:free]
+        self._size = self.maxlen
+        values = values[free:]
+        end = self._start + len(values)
+        head = min(end, self.maxlen) - self._start
+        self._data[self._start:self._start + head] = values[:head]
+        self._data[:len(values) - head] = values[head:]
+        self._start = end % self.maxlen
+
+    def values(self) -> np.ndarray:
+        """Kept values in chronological order."""
+        if self._start == 0:
+            return self._data[:self._size]
+        return np.concatenate([self._data[self._start:self._size], self._data[:self._start]])
+
+    def percentile(self, q):
+        """Percentile of the kept values, see `np.percentile()`."""
+        return np.percentile(self.values(), q)
+
+    def res(self, stg='mean', window=None):
+        """Aggregated value, `stg` is one of 'mean', 'sum', 'min', 'max', 'last', 'slide' and 'ema'."""
+        if self.count == 0:
+            return 0
+        if stg == 'mean':
+            return self.sum / self.count
+        elif stg == 'sum':
+            return self.sum
+        elif stg == 'min':
+            return self.min
+        elif stg == 'max':
+            return self.max
+        elif stg == 'slide':
+            values = self.values()
+            if window is not None:
+                values = values[-window:]
+            return values.mean().item()
+        elif stg == 'ema':
+            return self.ema
+        return self.last
+
+    def clear(self):
+        self.__init__(len(self._data), self.maxlen, self._data.dtype, self.ema_decay)
+
+
+def _ema(prev, values: np.ndarray, decay):
+    """Exponential moving average after `prev` is updated by each of `values`, computed vectorized."""
+    if prev is None:
+        prev, values = values[0].item(), values[1:]
+    size = len(values)
+    if size == 0:
+        return prev
+    weights = (1 - decay) * np.power(decay, np.arange(size - 1, -1, -1, dtype=np.float64))
+    return (prev * decay ** size + (weights * values).sum()).item()
+
+
+class _DeviceBuffer:
+    """Scalar tensors staged on their device, copied to host together by `Record.sync()`."""
+
+    def __init__(self, value: torch.Tensor, capacity=64):
+        self.data = torch.empty(capacity, dtype=value.dtype, device=value.device)
+        self.size = 0
+
+    def append(self, value: torch.Tensor):
+        if self.size == len(self.data):
+            data = torch.empty(len(self.data) * 2, dtype=self.data.dtype, device=self.data.device)
+            data[:self.size] = self.data
+            self.data = data
+        self.data[self.size] = value
+        self.size += 1
 
 
 class Record(metaclass=PropVar):
-    def __init__(self, window_size=500, **kwargs):
+    """
+    Aggregate metrics of steps, scalar metrics are stored in columnar `MetricBuffer`s with their per-step history,
+    others (arrays, strings) are aggregated by `AggItem`.
+
+    Scalar tensors (e.g., from a lazy `Meter`) are staged on their device, and only copied to host when `agg()` is
+    called or every `sync_interval` records, so recording them does not synchronize with the device.
+
+    Args:
+        window_size: window size of the 'slide' aggregation.
+        lazy: whether to wrap dict metrics by a lazy `Meter`.
+        sync_interval: copy staged tensors to host every `sync_interval` records, None means only in `agg()`.
+        history_size: number of per-step values kept for each metric, None means all values of the epoch.
+        ema_decay: decay of the 'ema' aggregation.
+    """
+
+    def __init__(self, window_size=500, lazy=False, sync_interval=None, history_size=None, ema_decay=0.9,
+                 **kwargs):
         self._prop.update(kwargs)
         self._cache = []
-        self._agg = OrderedDict()  # type:Dict[str,AggItem]
+        self._agg = OrderedDict()  # type:Dict[str,Union[MetricBuffer, AggItem]]
+        self._stages = {}
+        self._staged = OrderedDict()  # type:Dict[str,_DeviceBuffer]
+        self.window_size = window_size
+        self.lazy = lazy
+        self.sync_interval = sync_interval
+        self.history_size = history_size
+        self.ema_decay = ema_decay
+        self._count = 0
 
     def avg(self) -> Attr:
         warnings.warn('avg will be deprecated in later version, use agg() instead.')
         return self.agg()
 
     def agg(self) -> Attr:
+        self.sync()
         res = Attr()
         for k, v in self._agg.items():
-            res[k] = v.res
+            if isinstance(v, MetricBuffer):
+                res[k] = v.res(self._stages[k], self.window_size)
+            else:
+                res[k] = v.res
         return res
 
+    def percentile(self, key, q):
+        """Percentile of the per-step values of a scalar metric."""
+        self.sync()
+        return self._agg[key].percentile(q)
+
+    def history(self) -> Dict[str, np.ndarray]:
+        """Per-step values of each scalar metric, one array per metric."""
+        self.sync()
+        return OrderedDict((k, v.values().copy()) for k, v in self._agg.items() if isinstance(v, MetricBuffer))
+
+    def dump(self, fn):
+        """Save `history()` into a `.npz` file."""
+        np.savez(fn, **self.history())
+        return fn
+
     @property
     def stage(self):
         return self._prop['stage']
@@ -61,35 +274,86 @@ class Record(metaclass=PropVar):
     def tostr(self):
         return str(self)
 
+    def _buffer(self, key, stg, dtype) -> MetricBuffer:
+        buffer = self._agg.get(key, None)
+        if buffer is None:
+            buffer = MetricBuffer(maxlen=self.history_size, dtype=dtype, ema_decay=self.ema_decay)
+            self._agg[key] = buffer
+            self._stages[key] = stg
+        return buffer
+
     def record(self, metric, global_step=None):
-        meter = wrap_result(metric)
+        meter = wrap_result(metric, lazy=self.lazy)
         agg = meter._avg
 
         for k, v in meter.items():
             stg = agg.get(k, 'last')
-            item = self._agg.get(k, None)
-            if item is None:
-                item = AggItem(stg)
-            item.update(v)
-            self._agg[k] = item
+            if isinstance(v, torch.Tensor) and v.dim() == 0:
+                staged = self._staged.get(k, None)
+                if staged is None:
+                    self._buffer(k, stg, _host_dtype(v.dtype))
+                    staged = self._staged[k] = _DeviceBuffer(v)
+                staged.append(v)
+            elif isinstance(v, (bool, int, float)) and not isinstance(self._agg.get(k, None), AggItem):
+                if k in self._staged and self._staged[k].size > 0:
+                    self.sync()
+                self._buffer(k, stg, np.asarray(v).dtype).append(v)
+            else:
+                item = self._agg.get(k, None)
+                if item is None:
+                    item = AggItem(stg)
+                item.update(v)
+                self._agg[k] = item
+
+        self._count += 1
+        if self.sync_interval is not None and self._count % self.sync_interval == 0:
+            self.sync()
+
+    def sync(self):
+        """Copy the staged tensors to host, with one transfer for each device and dtype."""
+        groups = {}
+        for k, staged in self._staged.items():
+            if staged.size > 0:
+                groups.setdefault((staged.data.device, staged.data.dtype), []).append(k)
+
+        for keys in groups.values():
+            host = torch.cat([self._staged[k].data[:self._staged[k].size] for k in keys]).cpu().numpy()
+            offset = 0
+            for k in keys:
+                size = self._staged[k].size
+                self._agg[k].extend(host[offset:offset + size])
+                offset += size
+                self._staged[k].size = 0
 
     def clear(self):
         self._agg.clear()
+        self._stages.clear()
+        self._staged.clear()
         self._cache.clear()
 
     def flush(self):
         self._cache.clear()
 
 
+def _host_dtype(dtype: torch.dtype):
+    if dtype.is_floating_point:
+        return np.float64
+    if dtype == torch.bool:
+        return np.bool_
+    return np.int64
+
+
 class AggItem:
     def __init__(self, stg):
         self.stg = stg
         self._last = 0
-        self.acc = 0
+        self.acc = None
         self.c = 0
 
     @property
     def res(self):
+        if self.acc is None:
+            return 0
         if self.stg == 'mean':
             return self.acc / self.c
 
@@ -106,13 +370,14 @@ class AggItem:
         return self._last
 
     def update(self, val):
-        if self.stg == 'last':
+        if self.stg == 'last' or self.acc is None:
             self.acc = val
+            self.c = 1
         elif self.stg == 'min':
             self.acc = min(self.acc, val)
         elif self.stg == 'max':
             self.acc = max(self.acc, val)
         elif self.stg in {'mean', 'sum'}:
-            self.acc += val
+            self.acc = self.acc + val
             self.c += 1
         self._last = val
@@ -0,0 +1,3 @@
+from .abc import RecordBackend
+from .record_csv import CSVRecordBackend
+from .record_sqlite import SqliteRecordBackend
@@ -18,3 +18,10 @@ class RecordBackend(ABC):
         raise NotImplementedError()
     def log_image(self, image_array, caption=None):
         raise NotImplementedError()
+
+    def flush(self):
+        """Write buffered records."""
+        pass
+
+    def close(self):
+        self.flush()
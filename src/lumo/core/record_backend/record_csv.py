@@ -0,0 +1,73 @@
+import csv
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, List, Tuple
+
+from .abc import RecordBackend
+
+FIELDS = ['step', 'key', 'value', 'time']
+
+
+class CSVRecordBackend(RecordBackend):
+    """
+    Record metrics into a csv file with columns `step, key, value, time`, one row per metric, so new keys
+    can be appended without rewriting the file.
+
+    Rows are buffered in memory and appended in chunks when `buffer_size` rows are buffered, `flush()`
+    is called or `sync=True` is passed to `log()`.
+
+    Args:
+        location: path of the csv file.
+        buffer_size: number of buffered rows before a flush.
+    """
+
+    def __init__(self, location, buffer_size: int = 1000):
+        super().__init__(location)
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._step = 0
+
+    def log(self, data: Dict[str, Any],
+            step: Optional[int] = None,
+            commit: Optional[bool] = None,
+            sync: Optional[bool] = None):
+        if step is None:
+            step = self._step
+        self._step = step + 1
+        now = time.time()
+        for k, v in data.items():
+            self._buffer.append((step, k, v if isinstance(v, str) else float(v), now))
+        if sync or len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        new_file = not os.path.exists(self.location)
+        with open(self.location, 'a', newline='', encoding='utf-8') as w:
+            writer = csv.writer(w)
+            if new_file:
+                writer.writerow(FIELDS)
+            writer.writerows(self._buffer)
+        self._buffer = []
+
+    def read(self) -> Dict[str, List[Tuple[int, Any]]]:
+        """(step, value) pairs of each key, in the order of recording."""
+        self.flush()
+        return read_csv_records(self.location)
+
+
+def read_csv_records(location) -> Dict[str, List[Tuple[int, Any]]]:
+    res = OrderedDict()
+    if not os.path.exists(location):
+        return res
+    with open(location, 'r', newline='', encoding='utf-8') as r:
+        for row in csv.DictReader(r):
+            value = row['value']
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+            res.setdefault(row['key'], []).append((int(row['step']), value))
+    return res
@@ -0,0 +1,81 @@
+import sqlite3
+import time
+from typing import Dict, Any, Optional, List, Tuple
+
+from .abc import RecordBackend
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS metrics ('
+    'test TEXT NOT NULL, key TEXT NOT NULL, step INTEGER, value REAL, text TEXT, time REAL)',
+    'CREATE INDEX IF NOT EXISTS metrics_index ON metrics (test, key, step)',
+]
+
+
+class SqliteRecordBackend(RecordBackend):
+    """
+    Record metrics into a SQLite database, which can be shared by concurrent tests of an experiment.
+
+    Records are buffered in memory and inserted in one transaction when `buffer_size` records are buffered,
+    `flush()` is called or `sync=True` is passed to `log()`. The database is in WAL mode, so readers don't
+    block writers.
+
+    Args:
+        location: path of the database file.
+        test: name of the test, records of different tests are distinguished by it.
+        buffer_size: number of buffered records before a flush.
+        timeout: seconds to wait for the lock held by other writers.
+    """
+
+    def __init__(self, location, test: str = '', buffer_size: int = 1000, timeout: float = 60):
+        super().__init__(location)
+        self.test = test
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._step = 0
+        self.conn = sqlite3.connect(location, timeout=timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            for sql in _SCHEMA:
+                self.conn.execute(sql)
+
+    def log(self, data: Dict[str, Any],
+            step: Optional[int] = None,
+            commit: Optional[bool] = None,
+            sync: Optional[bool] = None):
+        if step is None:
+            step = self._step
+        self._step = step + 1
+        now = time.time()
+        for k, v in data.items():
+            if isinstance(v, str):
+                self._buffer.append((self.test, k, step, None, v, now))
+            else:
+                self._buffer.append((self.test, k, step, float(v), None, now))
+        if sync or len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) == 0:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?)', self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def keys(self, test: str = None) -> List[str]:
+        """Keys recorded by `test`, current test by default."""
+        test = self.test if test is None else test
+        self.flush()
+        return [row[0] for row in self.conn.execute('SELECT DISTINCT key FROM metrics WHERE test = ?', (test,))]
+
+    def query(self, key: str, test: str = None) -> List[Tuple[int, Any]]:
+        """(step, value) pairs of `key` recorded by `test`, current test by default, ordered by step."""
+        test = self.test if test is None else test
+        self.flush()
+        cursor = self.conn.execute('SELECT step, COALESCE(value, text) FROM metrics '
+                                   'WHERE test = ? AND key = ? ORDER BY step', (test, key))
+        return cursor.fetchall()
@@ -1,4 +1,8 @@
 from .builder import DatasetBuilder
-from .collate import CollateBase
+from .cache import TransformCache
+from .collate import CollateBase, PadCollate
 from .datamodule import DataModule
 from .loader import *
+from .sampler import BucketBatchSampler
+from .sources import MemmapSource, ShardedSource
+from .stream import DatasetStream
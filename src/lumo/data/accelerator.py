@@ -1,4 +1,5 @@
 import math
+import time
 from typing import Optional, List, Union
 
 import torch
@@ -7,7 +8,7 @@ from accelerate.data_loader import (IterableDatasetShard, BatchSamplerShard, _PY
 from accelerate.state import AcceleratorState, DistributedType, is_tpu_available
 from accelerate.utils import RNGType, synchronize_rng_states, send_to_device
 from torch.utils.data import DataLoader, IterableDataset
-from .loader import LumoDataLoader, DataLoaderIterWrap
+from .loader import LumoDataLoader, DataLoaderIterWrap, DataLoaderPrefetch
 
 if is_tpu_available():
     import torch_xla.core.xla_model as xm
@@ -25,10 +26,25 @@ class DataLoaderShard(_DataLoaderShard, LumoDataLoader):
         if self.rng_types is not None:
             synchronize_rng_states(self.rng_types, self.generator)
         state = AcceleratorState()
+        prefetch = self._prop.get('prefetch', None)
+        if prefetch is not None and self.device is not None:
+            # copy batches to device in the prefetch thread instead of here.
+            prefetch = dict(prefetch, device=self.device)
+            for batch in self._count_consumed(DataLoaderPrefetch(self._wraooed_iter_(), **prefetch)):
+                if state.distributed_type == DistributedType.TPU:
+                    xm.mark_step()
+                yield batch
+            return
+
         for batch in LumoDataLoader.__iter__(self):
             if state.distributed_type == DistributedType.TPU:
                 xm.mark_step()
-            yield batch if self.device is None else send_to_device(batch, self.device)
+            if self.device is not None:
+                start = time.perf_counter()
+                batch = send_to_device(batch, self.device)
+                # read by `lumo.trainer.callbacks.ProfileCallback`
+                self.h2d_time = getattr(self, 'h2d_time', 0.) + time.perf_counter() - start
+            yield batch
 
 
 def prepare_data_loader(
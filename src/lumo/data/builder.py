@@ -6,9 +6,12 @@ from pprint import pformat
 from typing import Callable, NewType, Dict, Any, Iterable, Sequence
 
 import numpy as np
+import torch
 from torch.utils.data import Dataset
 
+from lumo.data.cache import TransformCache
 from lumo.data.loader import LumoDataLoader
+from lumo.data.sources import MemmapSource, dump_memmap, is_memmap_file
 
 SingleValueTransform = NewType('SingleValueTransform', Callable[[Any], Any])
 DictTransform = NewType('DictTransform', Callable[[Dict[str, Any]], Any])
@@ -22,10 +25,13 @@ class DatasetBuilder(Dataset):
         self._data = {}
         self._outs = {}
         self._transforms = {}
+        self._batch_transforms = set()
+        self._caches = {}  # type: Dict[str, TransformCache]
 
         self._outkeys = []
 
         self._iter_cache = {}
+        self._plan = None  # type: _FlatPlan
 
     def copy(self):
         db = DatasetBuilder()
@@ -34,6 +40,8 @@ class DatasetBuilder(Dataset):
         db._data = copy.copy(self._data)
         db._outs = copy.deepcopy(self._outs)
         db._transforms = copy.copy(self._transforms)
+        db._batch_transforms = copy.copy(self._batch_transforms)
+        db._caches = copy.copy(self._caches)
         db._outkeys = copy.copy(self._outkeys)
         return db
 
@@ -45,6 +53,10 @@ class DatasetBuilder(Dataset):
             return f'Builder(flow={pformat(self._outs)}, sized={self.sized}, iterable={self.iterable})'
 
     def __iter__(self):
+        """
+        Iterate over raw sources without transforms. Use `stream()` to iterate with transforms and
+        worker/rank sharding.
+        """
         if self.subindices is not None:
             warnings.warn('subset() has no effects in iter mode.')
 
@@ -71,38 +83,138 @@ class DatasetBuilder(Dataset):
             raise e
 
     def __getitem__(self, index):
+        plan = self._plan
+        if plan is None:
+            plan = self.compile()._plan
+        return plan(index)
 
-        index = self.map_index(index)
+    def compile(self):
+        """
+        Flatten the source -> output -> global transform graph into a `_FlatPlan`, which will be used by
+        `__getitem__` until any `add_*/set_*` or index related method (`subset/repeat/chain/...`) is called.
 
-        outputs = {}
+        It is called automatically when creating `builder.DataLoader()` or fetching the first item.
+        """
+        self._plan = _FlatPlan(self)
+        return self
+
+    def __getitems__(self, indices):
+        """
+        Batched version of `__getitem__`, used by `torch.utils.data.DataLoader` (torch>=2.0) when automatic
+        batching is enabled.
+
+        Sources which are `np.ndarray` or `torch.Tensor` are sliced once by the whole index vector, and transforms
+        registered with `batched=True` are called once on the whole batch, others are called sample by sample.
+
+        Returns:
+            A list of samples in the same format as `__getitem__`, so any `collate_fn` can be used.
+        """
+        outputs = self._fetch_batch(indices)
+        size = len(indices)
 
+        glb_transform = self._transforms.get('::global::', None)
+        if glb_transform is not None and '::global::' in self._batch_transforms:
+            outputs = glb_transform(outputs)
+
+        samples = [{k: v[i] for k, v in outputs.items()} for i in range(size)]
+        if glb_transform is not None and '::global::' not in self._batch_transforms:
+            samples = [glb_transform(sample) for sample in samples]
+
+        return [self._format_outputs(sample) for sample in samples]
+
+    def get_batch(self, indices):
+        """
+        Fetch a batch of samples in column form, each output key is mapped to one batched value (an array/tensor
+        if it is sliced from an array/tensor source and only batched transforms are applied, otherwise a list).
+
+        Unlike `__getitems__`, samples are not split, so this can be used directly as the batch without collating.
+        """
+        outputs = self._fetch_batch(indices)
+
+        glb_transform = self._transforms.get('::global::', None)
+        if glb_transform is not None:
+            if '::global::' in self._batch_transforms:
+                outputs = glb_transform(outputs)
+            else:
+                samples = [glb_transform({k: v[i] for k, v in outputs.items()}) for i in range(len(indices))]
+                outputs = {k: [sample[k] for sample in samples] for k in (samples[0] if samples else outputs)}
+
+        return self._format_outputs(outputs)
+
+    def _fetch_batch(self, indices):
+        indices = self.map_index(np.asarray(indices, dtype=np.int64))
+
+        outputs = {}
         for key, outkeys in self._outs.items():
             if key == '::idx::':
-                ipt = index
+                ipt = self._transform_batch(key, indices, indices)
             else:
-                ipt = self._data[key][index]
-            ipt_transform = self._transforms.get(key, None)
-            if ipt_transform is not None:
-                ipt = ipt_transform(ipt)
+                ipt = self._transform_batch(key, indices, self._data[key], indices)
 
             for outkey in outkeys:
-                opt = ipt
-                opt_transform = self._transforms.get(f'::{outkey}', None)
-                if opt_transform is not None:
-                    opt = opt_transform(opt)
+                outputs[outkey] = self._transform_batch(f'::{outkey}', indices, ipt)
+        return outputs
 
-                outputs[outkey] = opt
+    def _transform_batch(self, key, indices: np.ndarray, source, positions: np.ndarray = None):
+        """
+        Batched version of the per-key transform in `_FlatPlan`, the transform of `key` is applied on
+        `source[positions]` (or on `source` itself if `positions` is None), cached items are looked up by `indices`.
 
-        glb_transform = self._transforms.get('::global::', None)
-        if glb_transform is not None:
-            outputs = glb_transform(outputs)
+        When the key is cached, the result is a list, and only missed items are fetched and transformed.
+        """
+        cache = self._caches.get(key, None)
+        if cache is None:
+            batch = source if positions is None else self._take(source, positions)
+            return self._apply_batch_transform(key, batch)
+
+        res = [None] * len(indices)
+        missing = []
+        for pos, index in enumerate(indices.tolist()):
+            hit, value = cache.lookup(index)
+            if hit:
+                res[pos] = value
+            else:
+                missing.append(pos)
+
+        if len(missing) > 0:
+            missing = np.array(missing, dtype=np.int64)
+            batch = self._take(source, missing if positions is None else positions[missing])
+            for pos, value in zip(missing.tolist(), self._apply_batch_transform(key, batch)):
+                res[pos] = value
+                cache.put(int(indices[pos]), value)
+        return res
 
+    @staticmethod
+    def _take(source, indices: np.ndarray):
+        if isinstance(source, (np.ndarray, MemmapSource)):
+            return source[indices]
+        elif isinstance(source, torch.Tensor):
+            return source[torch.from_numpy(indices)]
+        return [source[index] for index in indices.tolist()]
+
+    def _apply_batch_transform(self, key, batch):
+        transform = self._transforms.get(key, None)
+        if transform is None:
+            return batch
+        if key in self._batch_transforms:
+            return transform(batch)
+        return [transform(item) for item in batch]
+
+    def _format_outputs(self, outputs):
         if self.mode == 'chain':
             outputs = [outputs[outkey] for outkey in self._outkeys]
         elif self.mode == 'item':
             outputs = list(outputs.values())[0]
         return outputs
 
+    def stream(self, shuffle_buffer: int = 0, seed: int = None, shard_by_rank=True):
+        """
+        Create a streaming view of this builder, which is sharded across DataLoader workers and distributed ranks.
+        See `lumo.data.stream.DatasetStream` for details.
+        """
+        from .stream import DatasetStream
+        return DatasetStream(self, shuffle_buffer=shuffle_buffer, seed=seed, shard_by_rank=shard_by_rank)
+
     def __len__(self):
         if not self.sized:
             raise TypeError('DatasetBuilder can not be sized when data source is empty or only iterable.')
@@ -110,6 +222,7 @@ class DatasetBuilder(Dataset):
         return self._prop['__clen__']
 
     def _update_len(self):
+        self._plan = None
         if not self.sized:
             self._prop['__clen__'] = None
             return
@@ -198,14 +311,17 @@ class DatasetBuilder(Dataset):
 
     def chain(self):
         self._prop['mode'] = 'chain'
+        self._plan = None
         return self
 
     def item(self):
         self._prop['mode'] = 'item'
+        self._plan = None
         return self
 
     def zip(self):
         self._prop['mode'] = 'zip'
+        self._plan = None
         return self
 
     def _check_source(self, name, source):
@@ -244,21 +360,92 @@ class DatasetBuilder(Dataset):
         assert name not in self._outkeys, f'Output key {name} duplicated.'
         outkeys.append(name)
         self._outkeys.append(name)
+        self._plan = None
         return self
 
-    def add_input(self, name: str, source, transform: SingleValueTransform = None):
+    def _set_transform(self, key, transform, batched=False):
+        """
+        Args:
+            batched: if True, `transform` will receive the whole batch (an array/tensor sliced from source, or a list)
+                when fetched by `__getitems__`/`get_batch`. It is still called with a single sample in `__getitem__`.
+        """
+        if key in self._caches and self._transforms.get(key, None) is not transform:
+            self._caches[key].clear()
+        self._plan = None
+        self._transforms[key] = transform
+        if batched:
+            self._batch_transforms.add(key)
+        else:
+            self._batch_transforms.discard(key)
+
+    def _set_cache(self, key, cache):
+        self._plan = None
+        cache = TransformCache.create(cache)
+        if cache is None:
+            self._caches.pop(key, None)
+        else:
+            self._caches[key] = cache
+
+    def cache_info(self) -> Dict[str, dict]:
+        """hit/miss counters of all declared caches, keyed by source name or output key."""
+        return {key[2:] if key.startswith('::') else key: cache.info()
+                for key, cache in self._caches.items()}
+
+    def add_input(self, name: str, source, transform: SingleValueTransform = None, batched=False, cache=None):
+        """
+        Register a data source.
+
+        A top-level `np.memmap` or a path of `.npy` file will be registered as a `MemmapSource`, which is shared by
+        all DataLoader workers instead of being copied into each of them.
+
+        Args:
+            cache: a `TransformCache` (or True/int as its maxsize) to memoize the outputs of `transform` by index.
+                Only declare it for deterministic transforms.
+        """
         assert name not in self._data, f'Source name {name} duplicated.'
+        if is_memmap_file(source):
+            source = MemmapSource.from_memmap(source)
+        elif isinstance(source, str) and source.endswith('.npy'):
+            source = MemmapSource(source)
         self._check_source(name, source)
         self._data[name] = source
-        self._transforms[name] = transform
+        self._set_transform(name, transform, batched)
+        self._set_cache(name, cache)
         return self
 
-    def add_input_transform(self, name: str, transform: SingleValueTransform = None):
+    def add_input_memmap(self, name: str, path: str, dtype=None, shape=None, offset=0,
+                         transform: SingleValueTransform = None, batched=False, cache=None):
+        """
+        Register a memory-mapped source from a `.npy` file, or from a raw binary file with given `dtype` and `shape`.
+        """
+        return self.add_input(name, MemmapSource(path, dtype=dtype, shape=shape, offset=offset),
+                              transform=transform, batched=batched, cache=cache)
+
+    def materialize_memmap(self, name: str, cache_name: str = None, fn: str = None):
+        """
+        Dump an in-memory source to a `.npy` file under `lumo.proc.path.dataset_cache_dir(cache_name)`
+        (or `fn` if given), and replace it by the memory-mapped one.
+        """
         assert name in self._data, f'Source {name} should be added.'
-        self._transforms[name] = transform
+        source = self._data[name]
+        if not isinstance(source, MemmapSource):
+            self._data[name] = dump_memmap(source, fn=fn, name=name, cache_name=cache_name)
+            self._plan = None
         return self
 
-    def add_output(self, name: str, outkey: str, transform: SingleValueTransform = None):
+    def add_input_transform(self, name: str, transform: SingleValueTransform = None, batched=False):
+        assert name in self._data, f'Source {name} should be added.'
+        self._set_transform(name, transform, batched)
+        return self
+
+    def add_output(self, name: str, outkey: str, transform: SingleValueTransform = None, batched=False,
+                   cache=None):
+        """
+        Args:
+            cache: see `add_input()`. The cached outputs are only valid when both the input transform of `name` and
+                `transform` are deterministic, random augmentations should be added by `add_output_transform()`
+                on another output key.
+        """
         assert name in self._data, f'Must have data source {name} first.'
 
         outkeys = self._outs.setdefault(name, list())
@@ -266,24 +453,25 @@ class DatasetBuilder(Dataset):
         outkeys.append(outkey)
         self._outkeys.append(outkey)
 
-        self._transforms[f'::{outkey}'] = transform
+        self._set_transform(f'::{outkey}', transform, batched)
+        self._set_cache(f'::{outkey}', cache)
         return self
 
-    def add_output_transform(self, outkey: str, transform: SingleValueTransform = None):
+    def add_output_transform(self, outkey: str, transform: SingleValueTransform = None, batched=False):
         assert outkey in self._outkeys, f'Output key {outkey} should be added.'
-        self._transforms[f'::{outkey}'] = transform
+        self._set_transform(f'::{outkey}', transform, batched)
         return self
 
-    def add_global_transform(self, transform: DictTransform):
-        self._transforms['::global::'] = transform
+    def add_global_transform(self, transform: DictTransform, batched=False):
+        self._set_transform('::global::', transform, batched)
         return self
 
-    def set_input_transform(self, name, transform: SingleValueTransform):
-        self._transforms[name] = transform
+    def set_input_transform(self, name, transform: SingleValueTransform, batched=False):
+        self._set_transform(name, transform, batched)
         return self
 
-    def set_output_transform(self, outkey, transform: SingleValueTransform):
-        self._transforms[f'::{outkey}'] = transform
+    def set_output_transform(self, outkey, transform: SingleValueTransform, batched=False):
+        self._set_transform(f'::{outkey}', transform, batched)
         return self
 
     DataLoader = LumoDataLoader
@@ -291,8 +479,103 @@ class DatasetBuilder(Dataset):
     def __getattribute__(self, item):
         res = super(DatasetBuilder, self).__getattribute__(item)
         if item == 'DataLoader':
+            self.compile()
             res = partial(res, dataset=self)
         return res
 
     def get_source(self, name):
         return self._data[name]
+
+
+class _FlatPlan:
+    """
+    Precomputed execution plan of a `DatasetBuilder`, created by `DatasetBuilder.compile()`.
+
+    All transforms, caches and index mappings are resolved once, and a source registered under several names is
+    read only once per sample.
+    """
+
+    def __init__(self, builder: DatasetBuilder):
+        self.modulo = None
+        self.subindices = builder.subindices
+        if builder.pseudo_length is not None or builder.pseudo_repeat is not None:
+            if self.subindices is not None:
+                self.modulo = len(self.subindices)
+            else:
+                self.modulo = builder._prop['__len__']
+
+        slots = {}
+        self.sources = []
+        self.inputs = []
+        for key, outkeys in builder._outs.items():
+            if key == '::idx::':
+                slot = None
+            else:
+                source = builder._data[key]
+                slot = slots.get(id(source), None)
+                if slot is None:
+                    slot = slots[id(source)] = len(self.sources)
+                    self.sources.append(source)
+
+            outputs = [(outkey, builder._transforms.get(f'::{outkey}', None), builder._caches.get(f'::{outkey}', None))
+                       for outkey in outkeys]
+            self.inputs.append((slot, builder._transforms.get(key, None), builder._caches.get(key, None), outputs))
+
+        self.glb_transform = builder._transforms.get('::global::', None)
+        self.mode = builder.mode
+        self.outkeys = list(builder._outkeys)
+
+    def map_index(self, index):
+        if self.modulo is not None:
+            index = index % self.modulo
+        if self.subindices is not None:
+            index = self.subindices[index]
+        return index
+
+    def __call__(self, index):
+        return self.apply(self.map_index(index), {})
+
+    def apply(self, index, reads: dict):
+        """
+        Args:
+            index: mapped index of sources.
+            reads: values already read from sources, keyed by slot in `self.sources`. Missing ones will be read by
+                `index`.
+        """
+        outputs = {}
+        for slot, transform, cache, outkeys in self.inputs:
+            hit = False
+            if cache is not None:
+                hit, ipt = cache.lookup(index)
+            if not hit:
+                if slot is None:
+                    ipt = index
+                else:
+                    ipt = reads.get(slot, reads)
+                    if ipt is reads:
+                        ipt = reads[slot] = self.sources[slot][index]
+                if transform is not None:
+                    ipt = transform(ipt)
+                if cache is not None:
+                    cache.put(index, ipt)
+
+            for outkey, opt_transform, opt_cache in outkeys:
+                hit = False
+                if opt_cache is not None:
+                    hit, opt = opt_cache.lookup(index)
+                if not hit:
+                    opt = ipt
+                    if opt_transform is not None:
+                        opt = opt_transform(opt)
+                    if opt_cache is not None:
+                        opt_cache.put(index, opt)
+                outputs[outkey] = opt
+
+        if self.glb_transform is not None:
+            outputs = self.glb_transform(outputs)
+
+        if self.mode == 'chain':
+            outputs = [outputs[outkey] for outkey in self.outkeys]
+        elif self.mode == 'item':
+            outputs = list(outputs.values())[0]
+        return outputs
@@ -0,0 +1,120 @@
+"""
+Cache for the outputs of deterministic transforms in `DatasetBuilder`.
+"""
+import os
+import shutil
+from collections import OrderedDict
+from typing import Any, Tuple
+
+from lumo.proc.path import dataset_cache_dir
+from lumo.utils import safe_io as io
+
+__all__ = ['TransformCache']
+
+
+class TransformCache:
+    """
+    Cache of transform outputs, keyed by the index of data source.
+
+    Declare it when registering a deterministic transform:
+    ```
+    builder.add_input('xs', paths, transform=decode, cache=TransformCache(maxsize=10000, disk='cifar.decode'))
+    ```
+
+    Args:
+        maxsize: max number of items kept in memory, the least recently used ones will be evicted.
+            None means unbounded, 0 disables the memory tier.
+        disk: name of the on-disk tier, items will be pickled into `lumo.proc.path.dataset_cache_dir(disk)`.
+            None disables the disk tier.
+
+    Notes:
+        Each DataLoader worker has its own memory tier and counters (use `persistent_workers=True` to keep them
+        across epochs), while the disk tier is shared by all workers and runs.
+    """
+
+    def __init__(self, maxsize: int = 4096, disk: str = None):
+        self.maxsize = maxsize
+        self.disk = disk
+        self._mem = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'TransformCache(maxsize={self.maxsize}, disk={self.disk})'
+
+    @staticmethod
+    def create(cache) -> 'TransformCache':
+        """Create from the `cache` argument of `DatasetBuilder.add_input()/add_output()`."""
+        if cache is None or cache is False:
+            return None
+        if cache is True:
+            return TransformCache()
+        if isinstance(cache, int):
+            return TransformCache(maxsize=cache)
+        if isinstance(cache, TransformCache):
+            return cache
+        raise TypeError(f'cache should be a bool, int or TransformCache, but got {type(cache)}.')
+
+    @property
+    def disk_dir(self):
+        if self.disk is None:
+            return None
+        return dataset_cache_dir(self.disk)
+
+    def _disk_file(self, index):
+        return os.path.join(self.disk_dir, f'{int(index)}.pkl')
+
+    def _put_mem(self, index, value):
+        if self.maxsize == 0:
+            return
+        self._mem[index] = value
+        if self.maxsize is not None and len(self._mem) > self.maxsize:
+            self._mem.popitem(last=False)
+
+    def lookup(self, index) -> Tuple[bool, Any]:
+        """
+        Returns:
+            (True, value) if hit, else (False, None).
+        """
+        if index in self._mem:
+            self._mem.move_to_end(index)
+            self.hits += 1
+            return True, self._mem[index]
+
+        if self.disk is not None:
+            fn = self._disk_file(index)
+            if os.path.exists(fn):
+                value = io.load_pkl(fn)
+                self._put_mem(index, value)
+                self.disk_hits += 1
+                return True, value
+
+        self.misses += 1
+        return False, None
+
+    def put(self, index, value):
+        self._put_mem(index, value)
+        if self.disk is not None:
+            fn = self._disk_file(index)
+            # workers may write the same item at the same time, write to a temp file first.
+            tmp_fn = f'{fn}.{os.getpid()}.lumo_cache'
+            io.dump_pkl(value, tmp_fn)
+            os.replace(tmp_fn, fn)
+
+    def clear(self, disk=True):
+        """Drop all cached items, including the disk tier if `disk` is True."""
+        self._mem.clear()
+        if disk and self.disk is not None:
+            shutil.rmtree(self.disk_dir, ignore_errors=True)
+
+    def __len__(self):
+        return len(self._mem)
+
+    def info(self) -> dict:
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self._mem),
+        }
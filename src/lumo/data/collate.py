@@ -1,11 +1,12 @@
 """
 
 """
-from functools import wraps
+from functools import wraps, partial
 from typing import Any, Mapping, Sequence
 
 import numpy as np
 import torch
+from torch.utils.data import get_worker_info
 from torch.utils.data._utils.collate import default_collate
 
 
@@ -55,35 +56,221 @@ class IgnoreNoneCollate(CollateBase):
         return list(filter(self._filter_none, sample_list))
 
 
-def numpy_collate(batch):
-    r"""Puts each data field into a tensor with outer dimension batch size"""
+class PadCollate(CollateBase):
+    """
+    Collate variable-size tensors or ndarrays by padding them to the max size of the batch, see `pad_collate()`.
+    Usually paired with `lumo.data.sampler.BucketBatchSampler`.
+    """
+
+    def __init__(self, pad_value=0, *args, **kwargs) -> None:
+        super().__init__(partial(pad_collate, pad_value=pad_value), *args, **kwargs)
+
+
+def _pad_tensors(tensors: Sequence[torch.Tensor], pad_value=0) -> torch.Tensor:
+    elem = tensors[0]
+    if any(t.dim() != elem.dim() for t in tensors):
+        raise RuntimeError('each tensor in batch should have the same number of dimensions to be padded')
+    size = [len(tensors)] + [max(t.shape[d] for t in tensors) for d in range(elem.dim())]
+
+    if get_worker_info() is not None:
+        # allocate in shared memory directly, to avoid a copy when sent to the main process.
+        numel = int(np.prod(size))
+        storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+        out = elem.new(storage).resize_(*size).fill_(pad_value)
+    else:
+        out = elem.new_full(size, pad_value)
+
+    for i, t in enumerate(tensors):
+        out[(i,) + tuple(slice(0, s) for s in t.shape)] = t
+    return out
+
+
+def pad_collate(batch, pad_value=0):
+    """
+    Like `default_collate`, but tensors or ndarrays of different shapes are padded with `pad_value` to the max size of
+    each dimension. The output tensor is allocated once and samples are copied into it.
 
+    Lengths are not returned, let the dataset output them (e.g., `'xs_len': len(xs)`) if masks are needed.
+    """
     elem = batch[0]
-    elem_type = type(elem)
-    if isinstance(elem, torch.Tensor):
-        batch = [elem.detach().cpu().numpy() for elem in batch]
-        return np.stack(batch, 0)
-    elif elem_type.__module__ == 'numpy' and elem_type.__name__ != 'str_' \
-            and elem_type.__name__ != 'string_':
-        if elem_type.__name__ == 'ndarray' or elem_type.__name__ == 'memmap':
-            return numpy_collate([np.array(b) for b in batch])
-        elif elem.shape == ():  # scalars
-            return np.array(batch)
-    elif isinstance(elem, float):
-        return np.array(batch, dtype=np.float)
-    elif isinstance(elem, int):
-        return np.array(batch)
-    elif isinstance(elem, (str, bytes)):
-        return batch
+    if isinstance(elem, (torch.Tensor, np.ndarray)):
+        tensors = [torch.as_tensor(b) for b in batch]
+        if all(t.shape == tensors[0].shape for t in tensors):
+            return default_collate(tensors)
+        return _pad_tensors(tensors, pad_value)
     elif isinstance(elem, Mapping):
-        return {key: numpy_collate([d[key] for d in batch]) for key in elem}
+        return {key: pad_collate([d[key] for d in batch], pad_value) for key in elem}
     elif isinstance(elem, tuple) and hasattr(elem, '_fields'):  # namedtuple
-        return elem_type(*(numpy_collate(samples) for samples in zip(*batch)))
-    elif isinstance(elem, Sequence):
-        # check to make sure that the elements in batch have consistent size
-        it = iter(batch)
-        elem_size = len(next(it))
-        if not all(len(elem) == elem_size for elem in it):
-            raise RuntimeError('each element in list of batch should be of equal size')
-        transposed = zip(*batch)
-        return [numpy_collate(samples) for samples in transposed]
+        return type(elem)(*(pad_collate(samples, pad_value) for samples in zip(*batch)))
+    elif isinstance(elem, (list, tuple)):
+        return [pad_collate(samples, pad_value) for samples in zip(*batch)]
+    return default_collate(batch)
+
+
+class _SchemaMismatch(Exception):
+    pass
+
+
+class BufferCollate:
+    """
+    A collate engine for samples of the same structure, which can be used as the `collate_fn` of DataLoader or
+    `CollateBase` instead of `default_collate`:
+    ```
+    loader = LumoDataLoader(dataset, batch_size=128, collate_fn=BufferCollate())
+    ```
+
+    The structure (schema) of samples is inferred from the first sample and cached, and inferred again if the
+    first sample of a batch does not match it. Like `default_collate`, a RuntimeError is raised if other samples
+    of the batch have different keys, lengths or shapes. For each batch, one output buffer is allocated for each
+    tensor/ndarray leaf, and samples are stacked into it in one call, without converting them one by one.
+
+    Create one instance for each loader, since the cached schema is the one of its samples.
+
+    Args:
+        to: 'torch' or 'numpy', the type of collated arrays.
+        shared_memory: whether to allocate torch buffers in shared memory when called in a DataLoader worker,
+            so that batches are sent to the main process without copying. Only for `to='torch'`.
+
+    Notes:
+        Numbers are collated to int64/float64/bool arrays, strings and other objects are collated to lists.
+    """
+
+    def __init__(self, to='torch', shared_memory=True):
+        assert to in {'torch', 'numpy'}, "`to` should be 'torch' or 'numpy'."
+        self.to = to
+        self.shared_memory = shared_memory
+        self._schema = None
+
+    def infer_schema(self, elem):
+        """
+        Returns:
+            (template, leaves). `template` is a nested tuple describing the structure, in which leaves are replaced
+            by their index in `leaves`, each leaf is (path, kind, shape, dtype).
+        """
+        leaves = []
+
+        def infer(elem, path):
+            if isinstance(elem, (torch.Tensor, np.ndarray, np.generic)) and not isinstance(elem, (np.str_, np.bytes_)):
+                if isinstance(elem, torch.Tensor):
+                    kind = 'tensor'
+                    dtype = elem.dtype if self.to == 'torch' else torch.empty(0, dtype=elem.dtype).numpy().dtype
+                else:
+                    kind = 'ndarray'
+                    dtype = elem.dtype if self.to == 'numpy' else torch.from_numpy(np.empty(0, elem.dtype)).dtype
+                leaves.append((path, kind, tuple(elem.shape), dtype))
+                return 'leaf', len(leaves) - 1
+            elif isinstance(elem, (bool, int, float)):
+                leaves.append((path, 'number', (), type(elem)))
+                return 'leaf', len(leaves) - 1
+            elif isinstance(elem, Mapping):
+                return 'map', type(elem), tuple((key, infer(value, path + (key,))) for key, value in elem.items())
+            elif isinstance(elem, tuple) and hasattr(elem, '_fields'):  # namedtuple
+                return 'namedtuple', type(elem), tuple(infer(value, path + (i,)) for i, value in enumerate(elem))
+            elif isinstance(elem, Sequence) and not isinstance(elem, (str, bytes)):
+                return 'list', None, tuple(infer(value, path + (i,)) for i, value in enumerate(elem))
+            leaves.append((path, 'object', None, None))
+            return 'leaf', len(leaves) - 1
+
+        return infer(elem, ()), leaves
+
+    def _empty(self, size, dtype):
+        if self.to == 'numpy':
+            return np.empty(size, dtype=dtype)
+        if self.shared_memory and get_worker_info() is not None:
+            elem = torch.empty(0, dtype=dtype)
+            storage = elem._typed_storage()._new_shared(int(np.prod(size)), device=elem.device)
+            return elem.new(storage).resize_(*size)
+        return torch.empty(size, dtype=dtype)
+
+    def _gather(self, template, values, path, outputs):
+        """Collect the values of each leaf across samples into `outputs`, checking that samples have the structure
+        of `template`."""
+        kind = template[0]
+        if kind == 'leaf':
+            outputs[template[1]] = values
+            return
+        children = template[-1]
+        if kind == 'map':
+            keys = [key for key, _ in children]
+            for value in values:
+                if not isinstance(value, Mapping) or len(value) != len(keys) or any(key not in value for key in keys):
+                    raise _SchemaMismatch(f'each element of {path} in batch should have the keys {keys}.')
+            for key, child in children:
+                self._gather(child, [value[key] for value in values], path + (key,), outputs)
+        else:
+            for value in values:
+                if isinstance(value, (str, bytes, Mapping)) or not isinstance(value, Sequence) \
+                        or len(value) != len(children):
+                    raise _SchemaMismatch(f'each element of {path} in batch should be a sequence '
+                                          f'of size {len(children)}.')
+            for i, child in enumerate(children):
+                self._gather(child, [value[i] for value in values], path + (i,), outputs)
+
+    def _collate_leaf(self, values, leaf):
+        path, kind, shape, dtype = leaf
+        if kind == 'object':
+            return values
+        if kind == 'number':
+            if self.to == 'numpy':
+                return np.array(values, dtype=np.float64 if dtype is float else None)
+            return torch.tensor(values, dtype=torch.float64 if dtype is float else None)
+
+        if tuple(values[0].shape) != shape:
+            raise _SchemaMismatch(f'each element of {path} in batch should be of size {shape}.')
+        try:
+            if kind == 'tensor' and self.to == 'torch':
+                if not (self.shared_memory and get_worker_info() is not None):
+                    # nothing to preallocate, `torch.stack` allocates the output itself
+                    return torch.stack(values)
+                out = self._empty((len(values),) + shape, dtype)
+                torch.stack(values, out=out)
+                return out
+            # fill the buffer in one call, numpy arrays through a numpy view
+            out = self._empty((len(values),) + shape, dtype)
+            if kind == 'tensor':
+                np.stack([value.detach().cpu().numpy() for value in values], out=out)
+            else:
+                np.stack(values, out=out.numpy() if self.to == 'torch' else out)
+        except (RuntimeError, ValueError):
+            shapes = {tuple(value.shape) for value in values}
+            if len(shapes) == 1:
+                raise
+            raise RuntimeError(f'each element of {path} in batch should be of equal size, '
+                               f'got {sorted(shapes)}, use `PadCollate` for variable sizes.')
+        return out
+
+    def _build(self, template, outputs):
+        kind, cls, children = template[0], template[1], template[-1]
+        if kind == 'leaf':
+            return outputs[cls]
+        if kind == 'map':
+            return {key: self._build(child, outputs) for key, child in children}
+        if kind == 'namedtuple':
+            return cls(*(self._build(child, outputs) for child in children))
+        return [self._build(child, outputs) for child in children]
+
+    def _collate(self, batch, schema):
+        template, leaves = schema
+        values = [None] * len(leaves)
+        self._gather(template, batch, (), values)
+        return self._build(template, [self._collate_leaf(value, leaf) for value, leaf in zip(values, leaves)])
+
+    def __call__(self, batch):
+        schema = self._schema
+        if schema is not None:
+            try:
+                return self._collate(batch, schema)
+            except (_SchemaMismatch, TypeError, AttributeError):
+                # structure of samples changed, infer again.
+                pass
+        schema = self._schema = self.infer_schema(batch[0])
+        try:
+            return self._collate(batch, schema)
+        except _SchemaMismatch as e:
+            # samples of the batch have different structures
+            raise RuntimeError(str(e)) from None
+
+
+def numpy_collate(batch):
+    r"""Puts each data field into a ndarray with outer dimension batch size, see `BufferCollate`."""
+    return BufferCollate(to='numpy')(batch)
@@ -1,21 +1,28 @@
+import itertools
+import queue
+import threading
+import time
 import warnings
 from collections import OrderedDict
+from collections.abc import Mapping
 from pprint import pformat
-from typing import NewType, Union
+from typing import NewType, Union, Optional
 
-from torch.utils.data import DataLoader
+import torch
+from torch.utils.data import DataLoader, BatchSampler, IterableDataset
 
 from lumo.core.metaclasses import PropVar
 
-__all__ = ['DataLoader', 'LumoDataLoader', 'DataLoaderSide', 'DataLoaderType']
+__all__ = ['DataLoader', 'LumoDataLoader', 'DataLoaderSide', 'DataLoaderPrefetch', 'DataLoaderType']
 
 
 class DataLoaderIterWrap:
-    def __init__(self, iter_fn, batch_count=None):
+    def __init__(self, iter_fn, batch_count=None, start=0):
         self.iter_fn = iter_fn
         self.iter = iter_fn()
-        self.c = 0
+        self.c = start
         self.batch_count = batch_count
+        self.exhausted = False
 
     def __iter__(self):
         while True:
@@ -33,6 +40,7 @@ class DataLoaderIterWrap:
     def __next__(self):
         if self.batch_count is not None:
             if self.c >= self.batch_count:
+                self.exhausted = True
                 raise StopIteration()
         try:
             batch = next(self.iter)
@@ -41,12 +49,138 @@ class DataLoaderIterWrap:
                 self.iter = self.iter_fn()
                 batch = next(self.iter)
             else:
+                self.exhausted = True
                 raise e
 
         self.c += 1
         return batch
 
 
+def apply_tensor(func, data):
+    """Recursively apply `func` on each tensor in nested list/tuple/dict, other objects are returned as is."""
+    if isinstance(data, torch.Tensor):
+        return func(data)
+    elif isinstance(data, Mapping):
+        return type(data)({k: apply_tensor(func, v) for k, v in data.items()})
+    elif isinstance(data, tuple) and hasattr(data, '_fields'):  # namedtuple
+        return type(data)(*(apply_tensor(func, v) for v in data))
+    elif isinstance(data, (list, tuple)):
+        return type(data)(apply_tensor(func, v) for v in data)
+    return data
+
+
+class _PrefetchEnd:
+    pass
+
+
+class _PrefetchError:
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class DataLoaderPrefetch:
+    """
+    Wrap a DataLoader (or `DataLoaderSide`, or any iterable of batches) to fetch the next `depth` batches in a
+    background thread, so batch collating and host-to-device copies overlap with the training step.
+
+    When `device` is a CUDA device, batches are copied from pinned memory with `non_blocking=True` on a side stream,
+    and the training stream waits for the copy only when the batch is consumed. Otherwise, batches are only
+    fetched (and moved to `device` if given) in the background thread.
+
+    Args:
+        loader: iterable of batches.
+        depth: number of batches staged ahead.
+        device: target device of batches, None means batches are yielded as is.
+        pin_memory: whether to pin batches before copying, default is True if `device` is a CUDA device.
+    """
+
+    def __init__(self, loader, depth: int = 2, device=None, pin_memory: bool = None):
+        self.loader = loader
+        self.depth = max(depth, 1)
+        self.device = torch.device(device) if device is not None else None
+        is_cuda = self.device is not None and self.device.type == 'cuda' and torch.cuda.is_available()
+        if pin_memory is None:
+            pin_memory = is_cuda
+        self.pin_memory = pin_memory
+        self._use_stream = is_cuda
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, item):
+        if item == 'loader':
+            raise AttributeError(item)
+        return getattr(self.loader, item)
+
+    def state_dict(self) -> dict:
+        """State of the wrapped loader, batches staged but not yet consumed are not counted."""
+        return self.loader.state_dict(consumed=self.__dict__.get('_consumed', None))
+
+    def load_state_dict(self, state_dict: dict):
+        self.loader.load_state_dict(state_dict)
+        return self
+
+    def _stage(self, batch, stream):
+        if self.pin_memory:
+            batch = apply_tensor(lambda t: t if t.is_pinned() else t.pin_memory(), batch)
+        if self.device is None:
+            return batch, None
+        if stream is None:
+            return apply_tensor(lambda t: t.to(self.device), batch), None
+
+        with torch.cuda.stream(stream):
+            batch = apply_tensor(lambda t: t.to(self.device, non_blocking=True), batch)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return batch, event
+
+    def _produce(self, iterable, que: queue.Queue, stop: threading.Event, stream):
+        try:
+            for batch in iterable:
+                item = self._stage(batch, stream)
+                while not stop.is_set():
+                    try:
+                        que.put(item, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            que.put(_PrefetchEnd())
+        except BaseException as e:
+            que.put(_PrefetchError(e))
+
+    def __iter__(self):
+        self._consumed = 0
+        stream = torch.cuda.Stream(self.device) if self._use_stream else None
+        que = queue.Queue(self.depth)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(self.loader, que, stop, stream), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = que.get()
+                if isinstance(item, _PrefetchEnd):
+                    break
+                if isinstance(item, _PrefetchError):
+                    raise item.exc
+                batch, event = item
+                if event is not None:
+                    current = torch.cuda.current_stream(self.device)
+                    current.wait_event(event)
+                    # the memory is allocated on the side stream, mark it used by current stream.
+                    apply_tensor(lambda t: t.record_stream(current), batch)
+                self._consumed += 1
+                yield batch
+        finally:
+            stop.set()
+            while thread.is_alive():
+                try:
+                    que.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+
 class MPropVar(PropVar): pass
 
 
@@ -62,21 +196,172 @@ class LumoDataLoader(DataLoader, metaclass=MPropVar):
         self._prop['batch_count'] = size
         return self
 
+    def set_prefetch(self, depth=2, device=None, pin_memory=None):
+        """
+        Fetch the next `depth` batches in a background thread, see `DataLoaderPrefetch` for details.
+        `depth=0` disables it.
+        """
+        if depth > 0:
+            self._prop['prefetch'] = {'depth': depth, 'device': device, 'pin_memory': pin_memory}
+        else:
+            self._prop.pop('prefetch', None)
+        return self
+
     def __len__(self):
         bc = self._prop.get('batch_count', None)
         if bc is None:
             return super(LumoDataLoader, self).__len__()
         return bc
 
+    @property
+    def _index_sampler(self):
+        index_sampler = super()._index_sampler
+        skip = self.__dict__.get('_resume_skip', 0)
+        if skip > 0:
+            return _ResumeBatchSampler(index_sampler, skip)
+        return index_sampler
+
+    def _sampler_generator(self) -> Optional[torch.Generator]:
+        """
+        The generator of the sampler, a dedicated one seeded from the global RNG is created if the sampler
+        is shuffled by the global RNG, so that its state can be saved and restored.
+        """
+        batch_sampler = self.batch_sampler
+        inner = getattr(batch_sampler, 'batch_sampler', None)
+        samplers = [getattr(inner, 'sampler', None), inner,
+                    getattr(batch_sampler, 'sampler', None), batch_sampler,
+                    self.sampler]
+        for sampler in samplers:
+            if sampler is not None and hasattr(sampler, 'generator'):
+                if sampler.generator is None:
+                    sampler.generator = torch.Generator()
+                    sampler.generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+                return sampler.generator
+        return None
+
+    def _iter_pass(self):
+        """Start one pass over the sampler, and record the state of its generator to resume from."""
+        generator = self._sampler_generator()
+        skip = 0
+        resume = self.__dict__.pop('_resume', None)
+        if resume is not None:
+            if generator is not None and resume['rng'] is not None:
+                generator.set_state(resume['rng'])
+            skip = resume['pos']
+        self._passes.append(generator.get_state() if generator is not None else None)
+
+        self._resume_skip = skip
+        try:
+            return super().__iter__()
+        finally:
+            self._resume_skip = 0
+
+    def _count_consumed(self, iterable):
+        """Count the batches consumed from `iterable`, which is fetched ahead of the consumer."""
+        self._consumed = 0
+
+        def counted():
+            for batch in iterable:
+                self._consumed += 1
+                yield batch
+
+        return counted()
+
+    def state_dict(self, consumed: int = None) -> dict:
+        """
+        Position and sampler RNG state of the current epoch. After `load_state_dict()`, the next `iter()` continues
+        from the next unconsumed batch, the consumed ones are skipped by slicing sampler indices instead of
+        fetching them.
+
+        Args:
+            consumed: number of batches consumed since the last `iter()`, default is the number yielded by it.
+                Wrappers which fetch batches ahead (like `DataLoaderPrefetch`) pass their own count.
+
+        Returns:
+            {'consumed': batches consumed in this epoch, 'pos': position in the current pass of sampler,
+             'rng': state of the sampler generator at the beginning of the current pass (None if not shuffled)}
+        """
+        wrap = self.__dict__.get('_iter_wrap', None)  # type: DataLoaderIterWrap
+        if consumed is None:
+            consumed = self.__dict__.get('_consumed', None)
+
+        if wrap is None or (wrap.exhausted and (consumed is None or wrap.c <= self._iter_start + consumed)):
+            # not started, or finished, resume from the beginning of the next epoch.
+            generator = self._sampler_generator()
+            return {'consumed': 0, 'pos': 0, 'rng': generator.get_state() if generator is not None else None}
+
+        total = wrap.c if consumed is None else self._iter_start + consumed
+        try:
+            pass_size = len(super()._index_sampler)
+        except TypeError:
+            pass_size = 0
+        i = len(self._passes) - 1
+        if pass_size > 0:
+            i = min((total - self._pass_base) // pass_size, i)
+        pos = total - self._pass_base - i * pass_size
+        return {'consumed': total, 'pos': pos, 'rng': self._passes[i]}
+
+    def load_state_dict(self, state_dict: dict):
+        """Restore the state returned by `state_dict()`, takes effect on the next `iter()`."""
+        state_dict = dict(state_dict)
+        if state_dict['pos'] > 0 and isinstance(self.dataset, IterableDataset):
+            warnings.warn('Batches of an IterableDataset can not be skipped by index, '
+                          'the position of the state dict is ignored.')
+            state_dict['pos'] = 0
+        self._resume = state_dict
+        return self
+
     def _wraooed_iter_(self):
-        return DataLoaderIterWrap(super().__iter__,
-                                  self._prop.get('batch_count', None))
+        resume = self.__dict__.get('_resume', None)
+        start = resume['consumed'] if resume is not None else 0
+        self._iter_start = start
+        self._pass_base = start - (resume['pos'] if resume is not None else 0)
+        self._passes = []
+        self._consumed = None
+        self._iter_wrap = DataLoaderIterWrap(self._iter_pass,
+                                             self._prop.get('batch_count', None),
+                                             start=start)
+        return self._iter_wrap
 
     def __iter__(self) -> DataLoaderIterWrap:
-        return self._wraooed_iter_()
+        res = self._wraooed_iter_()
+        prefetch = self._prop.get('prefetch', None)
+        if prefetch is not None:
+            res = self._count_consumed(DataLoaderPrefetch(res, **prefetch))
+        return res
+
+
+class _ResumeBatchSampler:
+    """
+    Skip the first `skip` batches of `batch_sampler` by index, without fetching their data.
+    Only the first iteration is skipped, as persistent workers may iterate it again in the next epoch.
+    """
+
+    def __init__(self, batch_sampler, skip: int):
+        self.batch_sampler = batch_sampler
+        self.skip = skip
+
+    def __len__(self):
+        return max(len(self.batch_sampler) - self.skip, 0)
+
+    def __iter__(self):
+        skip, self.skip = self.skip, 0
+        batch_sampler = self.batch_sampler
+        if type(batch_sampler) is BatchSampler:
+            batch_size = batch_sampler.batch_size
+            indices = list(batch_sampler.sampler)[skip * batch_size:]
+            for i in range(0, len(indices), batch_size):
+                batch = indices[i:i + batch_size]
+                if batch_sampler.drop_last and len(batch) < batch_size:
+                    break
+                yield batch
+        else:
+            yield from itertools.islice(batch_sampler, skip, None)
 
 
 def summarize_loader(loader: DataLoader):
+    if isinstance(loader, DataLoaderPrefetch):
+        return f"DataLoaderPrefetch(depth={loader.depth}, {summarize_loader(loader.loader)})"
     if isinstance(loader, DataLoaderSide):
         inner = pformat({f"{k}(cycle={loader._cycle[k]})": summarize_loader(v) for k, v in loader._loaders.items()})
         return f"DataLoaderSide({inner})"
@@ -105,23 +390,48 @@ def summarize_loader(loader: DataLoader):
         raise ValueError(f'Need {DataLoaderType}, got type {type(loader)}')
 
 
+def _cycle_loader(loader):
+    """Iterate `loader` endlessly, stop if it yields nothing in a whole pass."""
+    while True:
+        empty = True
+        for batch in loader:
+            empty = False
+            yield batch
+        if empty:
+            return
+
+
 class DataLoaderSide:
     """
     `DataLoaderSide` is used when different DataLoader with different batch_size are feeded at the same time.
+
+    Args:
+        concurrent: if True, each loader is fetched in its own background thread, so slow loaders are waited
+            concurrently instead of one after another. Iterators of `cycle=True` loaders are kept across
+            iterations of `DataLoaderSide`, and are restarted in background when exhausted. Disabled by default,
+            loaders are fetched one after another in the main thread.
     """
 
-    def __init__(self):
+    def __init__(self, concurrent=False):
         self._loaders = OrderedDict()
         self._cycle = OrderedDict()
         self._state = 'zip'
+        self._concurrent = concurrent
+        self._cycle_iters = {}
+        self._wait = OrderedDict()
 
     def add(self, name, loader: DataLoader, cycle=False):
+        if (cycle and isinstance(loader, DataLoader) and loader.num_workers > 0
+                and not loader.persistent_workers):
+            warnings.warn(f'Loader {name} is cycled, set `persistent_workers=True` to avoid respawning '
+                          f'its workers each time it is exhausted.')
         self._loaders[name] = loader
         self._cycle[name] = cycle
+        self._cycle_iters.pop(name, None)
         return self
 
     def copy(self):
-        loader = DataLoaderSide()
+        loader = DataLoaderSide(self._concurrent)
         loader._loaders = self._loaders
         loader._cycle = self._cycle
         loader._state = self._state
@@ -139,28 +449,55 @@ class DataLoaderSide:
         valid_keys = [k for k, cycle in self._cycle.items() if not cycle]
         return min([len(self._loaders[k]) for k in valid_keys])
 
+    def wait_time(self) -> OrderedDict:
+        """
+        Seconds the training thread spent waiting for each loader, and the number of fetched batches,
+        in the last (or current) iteration.
+        """
+        return OrderedDict((k, dict(v)) for k, v in self._wait.items())
+
+    def _iter_of(self, name):
+        loader = self._loaders[name]
+        if not self._concurrent:
+            return iter(loader)
+        if not self._cycle[name]:
+            return iter(DataLoaderPrefetch(loader, depth=1))
+
+        res = self._cycle_iters.get(name, None)
+        if res is None:
+            res = self._cycle_iters[name] = iter(DataLoaderPrefetch(_cycle_loader(loader), depth=1))
+        return res
+
     def __iter__(self):
-        iters = {k: iter(v)
-                 for k, v in self._loaders.items()}
-        stop = None
-        while stop is None:
-            res = OrderedDict()
-            for k, v in iters.items():
-                try:
-                    batch = next(v)
-                except StopIteration as e:
-                    if self._cycle[k]:
-                        v = iter(self._loaders[k])
-                        iters[k] = v
+        iters = OrderedDict((k, self._iter_of(k)) for k in self._loaders)
+        self._wait = OrderedDict((k, {'wait': 0., 'count': 0}) for k in self._loaders)
+        try:
+            while True:
+                res = OrderedDict()
+                for k, v in iters.items():
+                    start = time.perf_counter()
+                    try:
                         batch = next(v)
-                    else:
-                        # stop = e
-                        return
-                res[k] = batch
-            if self._state == 'zip':
-                yield res
-            else:
-                yield list(res.values())
+                    except StopIteration:
+                        if self._cycle[k] and not self._concurrent:
+                            v = iter(self._loaders[k])
+                            iters[k] = v
+                            batch = next(v)
+                        else:
+                            return
+                    wait = self._wait[k]
+                    wait['wait'] += time.perf_counter() - start
+                    wait['count'] += 1
+                    res[k] = batch
+                if self._state == 'zip':
+                    yield res
+                else:
+                    yield list(res.values())
+        finally:
+            for k, v in iters.items():
+                if self._concurrent and not self._cycle[k]:
+                    # stop the background thread of exhausted loaders
+                    v.close()
 
 
-DataLoaderType = NewType('DataLoaderType', Union[DataLoader, DataLoaderSide])
+DataLoaderType = NewType('DataLoaderType', Union[DataLoader, DataLoaderSide, DataLoaderPrefetch])
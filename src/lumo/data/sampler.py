@@ -0,0 +1,106 @@
+"""
+Batch samplers for variable-size samples.
+"""
+from typing import Iterator, List, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+__all__ = ['BucketBatchSampler']
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Group samples of similar length into the same batch to reduce padding, use it as the `batch_sampler` of
+    DataLoader and pair it with `lumo.data.collate.PadCollate`:
+    ```
+    sampler = BucketBatchSampler(lengths, max_tokens=40000)
+    loader = LumoDataLoader(dataset, batch_sampler=sampler, collate_fn=PadCollate())
+    ```
+
+    Indices are sorted by length (ties are broken randomly if `shuffle`), then cut into batches, and the
+    order of batches is shuffled. So the batches are the same in each epoch except samples of the same length,
+    and `len()` is exact.
+
+    Args:
+        lengths: length of each sample, e.g., number of frames or tokens.
+        batch_size: max number of samples in a batch.
+        max_tokens: max number of padded tokens in a batch, i.e., `max length in batch * batch size`.
+            A sample longer than `max_tokens` forms a batch by itself.
+        shuffle: whether to shuffle the order of batches and samples of the same length.
+        drop_last: drop the last batch if it has less than `batch_size` samples. Only takes effect when
+            `max_tokens` is None. If `shuffle`, the dropped samples are drawn randomly in each epoch, instead of
+            always being the longest ones.
+        generator: generator used to shuffle. If None, a seed is drawn from the global RNG in each epoch.
+    """
+
+    def __init__(self, lengths: Sequence[int], batch_size: int = None, max_tokens: int = None,
+                 shuffle: bool = True, drop_last: bool = False, generator: torch.Generator = None):
+        assert batch_size is not None or max_tokens is not None, '`batch_size` or `max_tokens` should be given.'
+        self.lengths = np.asarray(lengths)
+        assert self.lengths.ndim == 1, '`lengths` should be a 1-d array.'
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self._num_batches = len(self._batch_ends(np.sort(self.lengths, kind='stable')))
+
+    def _batch_ends(self, sorted_lengths: np.ndarray) -> List[int]:
+        """End positions of batches in `sorted_lengths`, which is ascending."""
+        ends = []
+        start = 0
+        for i, length in enumerate(sorted_lengths):
+            size = i - start + 1
+            if start < i and ((self.batch_size is not None and size > self.batch_size) or
+                              (self.max_tokens is not None and length * size > self.max_tokens)):
+                ends.append(i)
+                start = i
+        size = len(sorted_lengths) - start
+        if size > 0 and not (self.drop_last and self.max_tokens is None and size < self.batch_size):
+            ends.append(len(sorted_lengths))
+        return ends
+
+    def _torch_generator(self) -> torch.Generator:
+        if self.generator is not None:
+            return self.generator
+        generator = torch.Generator()
+        generator.manual_seed(int(torch.empty((), dtype=torch.int64).random_().item()))
+        return generator
+
+    def __iter__(self) -> Iterator[List[int]]:
+        size = len(self.lengths)
+        if self.shuffle:
+            generator = self._torch_generator()
+            perm = torch.randperm(size, generator=generator).numpy()
+            if self.drop_last and self.max_tokens is None:
+                # drop the remainder at random before sorting, so all batches are full
+                perm = perm[:size - size % self.batch_size]
+            # stable sort on a random permutation breaks ties randomly
+            indices = perm[np.argsort(self.lengths[perm], kind='stable')]
+        else:
+            generator = None
+            indices = np.argsort(self.lengths, kind='stable')
+
+        ends = self._batch_ends(self.lengths[indices])
+        starts = [0] + ends[:-1]
+        order = range(len(ends))
+        if generator is not None:
+            order = torch.randperm(len(ends), generator=generator).tolist()
+        for i in order:
+            yield indices[starts[i]:ends[i]].tolist()
+
+    def __len__(self):
+        return self._num_batches
+
+    def padding_ratio(self) -> float:
+        """Ratio of padded tokens in all batches, a measure of the padding waste."""
+        sorted_lengths = np.sort(self.lengths, kind='stable')
+        ends = self._batch_ends(sorted_lengths)
+        if len(ends) == 0:
+            return 0.
+        padded = sum(sorted_lengths[end - 1] * (end - start) for start, end in zip([0] + ends[:-1], ends))
+        if padded == 0:
+            return 0.
+        return 1 - sorted_lengths[:ends[-1]].sum() / padded
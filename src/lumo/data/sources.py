@@ -0,0 +1,155 @@
+"""
+Data sources which can be registered by `DatasetBuilder.add_input()`.
+"""
+import mmap
+import os
+from typing import Callable, Iterable, Iterator, Sequence, Union
+
+import numpy as np
+import torch
+
+from lumo.proc.path import dataset_cache_dir
+
+__all__ = ['MemmapSource', 'ShardedSource', 'dump_memmap']
+
+
+class MemmapSource:
+    """
+    A read-only memory-mapped array, opened lazily in each process.
+
+    Only the file path and its layout are pickled, so every DataLoader worker maps the same file and shares its
+    pages through the OS page cache, instead of unpickling (or copy-on-write breaking) its own copy of the data.
+
+    Args:
+        path: a `.npy` file, or a raw binary file if `dtype` and `shape` are given.
+        dtype: dtype of the raw binary file, None for `.npy` files.
+        shape: shape of the raw binary file, None for `.npy` files.
+        offset: offset in bytes of the array data in raw binary file.
+        order: memory layout of the raw binary file, 'C' or 'F'.
+    """
+
+    def __init__(self, path: str, dtype=None, shape=None, offset=0, order='C'):
+        self.path = os.path.abspath(path)
+        self.offset = offset
+        self.order = order
+        self._array = None
+        if dtype is None:
+            array = self.array
+            dtype, shape, self.offset = array.dtype, array.shape, array.offset
+            self.order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+        elif shape is None:
+            raise ValueError('`shape` should be given when `dtype` is given.')
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+
+    @staticmethod
+    def from_memmap(array: np.memmap) -> 'MemmapSource':
+        order = 'F' if array.flags.f_contiguous and not array.flags.c_contiguous else 'C'
+        return MemmapSource(array.filename, array.dtype, array.shape, array.offset, order)
+
+    @property
+    def array(self) -> np.memmap:
+        if self._array is None:
+            if getattr(self, 'dtype', None) is None:
+                self._array = np.load(self.path, mmap_mode='r')
+            else:
+                self._array = np.memmap(self.path, dtype=self.dtype, mode='r', offset=self.offset,
+                                        shape=self.shape, order=self.order)
+        return self._array
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_array'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getitem__(self, index):
+        res = self.array[index]
+        if isinstance(res, np.memmap):
+            # copy out of the mapping, otherwise torch will warn for wrapping a non-writable array.
+            res = np.array(res)
+        return res
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.array, dtype=dtype)
+
+    def __repr__(self):
+        return f'MemmapSource(path={self.path}, dtype={self.dtype}, shape={self.shape})'
+
+
+class ShardedSource:
+    """
+    An iterable source made of shards, e.g., the files of a WebDataset-style dataset. In `DatasetStream`, shards
+    are split across distributed ranks and DataLoader workers, so each shard is read by only one of them.
+
+    ```
+    source = ShardedSource(sorted(glob('train-*.tar')), read_tar)
+    builder.add_input('xs', source)
+    ```
+
+    Args:
+        shards: shards of the source, e.g., file paths.
+        read: a picklable function which yields the samples of a shard.
+
+    Notes:
+        Sources registered together are zipped, so they should have the same shards.
+        Ranks read different shards, and may get different numbers of samples.
+    """
+
+    def __init__(self, shards: Sequence, read: Callable[..., Iterable]):
+        self.shards = list(shards)
+        self.read = read
+
+    def __repr__(self):
+        return f'ShardedSource(num_shards={len(self.shards)})'
+
+    def shard(self, shard_id: int, num_shards: int) -> Iterator:
+        """Samples of the `shard_id`-th part of shards split into `num_shards` parts."""
+        for item in self.shards[shard_id::num_shards]:
+            yield from self.read(item)
+
+    def __iter__(self):
+        return self.shard(0, 1)
+
+
+def is_memmap_file(array) -> bool:
+    """Whether `array` is a top-level `np.memmap`, i.e., not a view of another memmap."""
+    return isinstance(array, np.memmap) and isinstance(array.base, mmap.mmap)
+
+
+def dump_memmap(source: Union[np.ndarray, torch.Tensor, list], fn: str = None,
+                name: str = None, cache_name: str = None) -> MemmapSource:
+    """
+    Materialize an in-memory source into a `.npy` file and return it as a `MemmapSource`.
+
+    Args:
+        source: an array-like object which can be converted by `np.asarray()` into a non-object array.
+        fn: file path to be written. If None, `<dataset_cache_dir(cache_name)>/<name>.npy` will be used.
+        name: file name used when `fn` is None.
+        cache_name: sub directory of `lumo.proc.path.dataset_cache_dir()`.
+    """
+    if fn is None:
+        assert name is not None, '`name` should be given when `fn` is None.'
+        fn = os.path.join(dataset_cache_dir(cache_name), f'{name}.npy')
+
+    if isinstance(source, torch.Tensor):
+        source = source.detach().cpu().numpy()
+    source = np.asarray(source)
+    if source.dtype == np.object_:
+        raise TypeError(f'Source of object dtype can not be memory-mapped, '
+                        f'make sure all samples have the same shape.')
+
+    # write to a temp file first, existing workers may still map the old one.
+    tmp_fn = f'{fn}.lumo_cache'
+    array = np.lib.format.open_memmap(tmp_fn, mode='w+', dtype=source.dtype, shape=source.shape)
+    array[:] = source
+    array.flush()
+    del array
+    os.replace(tmp_fn, fn)
+    return MemmapSource(fn)
@@ -0,0 +1,143 @@
+"""
+Streaming mode of `DatasetBuilder`, see `DatasetBuilder.stream()`.
+"""
+import math
+import random
+from typing import TYPE_CHECKING
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from lumo.proc import dist
+from .loader import LumoDataLoader
+from .sources import ShardedSource
+
+if TYPE_CHECKING:
+    from .builder import DatasetBuilder
+
+__all__ = ['DatasetStream']
+
+
+def shuffle_buffer(iterable, size: int, rng: random.Random):
+    """
+    Approximately shuffle an iterable with a buffer of `size` items, each item is swapped out by a random one
+    in the buffer.
+    """
+    buffer = []
+    for item in iterable:
+        if len(buffer) < size:
+            buffer.append(item)
+            continue
+        i = rng.randrange(size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class DatasetStream(IterableDataset):
+    """
+    An `IterableDataset` view of `DatasetBuilder`, which is sharded across DataLoader workers
+    (`torch.utils.data.get_worker_info()`) and distributed ranks (`lumo.proc.dist`), so each sample is read and
+    transformed by only one worker of one rank.
+
+    The same transform graph as `DatasetBuilder.__getitem__` is applied. If the builder is sized, samples are fetched
+    by index, so `subset()/repeat()/scale_to_size()` take effects, and skipped samples will not be read. Each rank
+    gets the same number of samples, the last ones are padded by samples from the beginning like
+    `DistributedSampler`, so distributed ranks stay in lockstep.
+
+    Otherwise, sources are iterated together. When there are multiple workers or ranks, all sources should be
+    `ShardedSource`, whose shards (e.g., files) are split across workers and ranks, so each shard is read by only
+    one worker of one rank. `::idx::` outputs are the positions of samples in their part, interleaved across parts.
+    Other iterables can only be streamed by a single worker of a single rank (e.g., with `shard_by_rank=False`).
+
+    Args:
+        builder: the `DatasetBuilder`.
+        shuffle_buffer: size of shuffle buffer, 0 means no shuffle.
+        seed: seed of the shuffle buffer. If not None, call `set_epoch()` before each epoch to get different orders.
+        shard_by_rank: whether to shard across distributed ranks. Trainer will not shard it again when preparing
+            the DataLoader.
+    """
+
+    def __init__(self, builder: 'DatasetBuilder', shuffle_buffer: int = 0, seed: int = None, shard_by_rank=True):
+        self.builder = builder
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.shard_by_rank = shard_by_rank
+        self.epoch = 0
+
+    def __repr__(self):
+        return (f'DatasetStream({self.builder}, shuffle_buffer={self.shuffle_buffer}, '
+                f'shard_by_rank={self.shard_by_rank})')
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        return self
+
+    def rank_shard(self):
+        if self.shard_by_rank and dist.is_dist():
+            return dist.rank(), dist.world_size()
+        return 0, 1
+
+    def shard(self):
+        """
+        Returns:
+            (shard id, number of shards) of current worker in current rank.
+        """
+        rank, world_size = self.rank_shard()
+        info = get_worker_info()
+        if info is None:
+            return rank, world_size
+        return rank * info.num_workers + info.id, world_size * info.num_workers
+
+    def rank_indices(self) -> range:
+        """
+        Indices of samples of current rank, which are taken modulo `len(builder)`, the exceeded ones pad the
+        ranks with fewer samples.
+        """
+        rank, world_size = self.rank_shard()
+        num_samples = math.ceil(len(self.builder) / world_size)
+        return range(rank, num_samples * world_size, world_size)
+
+    def __len__(self):
+        """number of samples of current rank."""
+        return len(self.rank_indices())
+
+    def __iter__(self):
+        builder = self.builder
+        plan = builder._plan
+        if plan is None:
+            plan = builder.compile()._plan
+
+        shard, num_shards = self.shard()
+        if builder.sized:
+            info = get_worker_info()
+            samples = self.rank_indices()
+            if info is not None:
+                samples = samples[info.id::info.num_workers]
+        elif num_shards == 1:
+            samples = enumerate(zip(*[iter(source) for source in plan.sources]))
+        else:
+            unsharded = [source for source in plan.sources if not isinstance(source, ShardedSource)]
+            if len(unsharded) > 0:
+                raise ValueError(f'Unsized sources {unsharded} can not be sharded across {num_shards} workers/ranks '
+                                 f'without reading the whole stream in each of them, use `ShardedSource` instead.')
+            samples = ((index * num_shards + shard, reads) for index, reads in
+                       enumerate(zip(*[source.shard(shard, num_shards) for source in plan.sources])))
+
+        if self.shuffle_buffer > 0:
+            if self.seed is None:
+                rng = random.Random()
+            else:
+                rng = random.Random((self.seed + self.epoch) * num_shards + shard)
+            samples = shuffle_buffer(samples, self.shuffle_buffer, rng)
+
+        if builder.sized:
+            size = len(builder)
+            for index in samples:
+                yield plan(index % size)
+        else:
+            for index, reads in samples:
+                yield plan.apply(index, dict(enumerate(reads)))
+
+    def DataLoader(self, **kwargs) -> LumoDataLoader:
+        return LumoDataLoader(dataset=self, **kwargs)
@@ -12,6 +12,17 @@ def local_rank():
     return rank
 
 
+def rank():
+    """global rank across all nodes, -1 if not in distributed mode."""
+    res = int(os.environ.get('RANK', '-1'))
+    if res == -1:
+        if dist.is_available() and dist.is_initialized():
+            res = dist.get_rank()
+        else:
+            res = local_rank()
+    return res
+
+
 def world_size():
     size = int(os.environ.get('WORLD_SIZE', '0'))
     if size == 0:
@@ -92,6 +92,76 @@ def wrapper(self, func, _call_set: list):
     return _newfunc
 
 
+def _is_overridden(callback, attr) -> bool:
+    """Whether `attr` of `callback` is not the no-op one defined in the abstract callback classes."""
+    from .callbacks import BaseCallback, TrainCallback, InitialCallback
+    if attr in callback.__dict__:
+        return True
+    for cls in type(callback).__mro__:
+        if attr in cls.__dict__:
+            return cls not in {BaseCallback, TrainCallback, InitialCallback}
+    return False
+
+
+def build_hooks(callbacks: list, name: str):
+    """
+    Build the dispatch table of function `name`, which only contains the callbacks that override its hooks.
+
+    Returns:
+        (begin hooks, end hooks), each is a list of (callback, bound method). The method is `on_begin/on_end` if the
+        callback overrides them, otherwise `on_<name>_begin/end`.
+    """
+    from .callbacks import BaseCallback, map_func_name
+    name = map_func_name(name)
+    begins, ends = [], []
+    for callback in callbacks:
+        for generic, attr, hooks in (('on_begin', f'on_{name}_begin', begins),
+                                     ('on_end', f'on_{name}_end', ends)):
+            if getattr(type(callback), generic) is not getattr(BaseCallback, generic):
+                hooks.append((callback, getattr(callback, generic)))
+            elif _is_overridden(callback, attr):
+                hooks.append((callback, getattr(callback, attr)))
+    return begins, ends
+
+
+def _profiled_call(self, profiler, func, call_set: list, aargs, kkwargs):
+    """
+    Same as the callback wrapper, but each callback and the function are timed by `profiler.clock()`, and reported
+    by `profiler.on_call(name, t_begin, t_func_begin, t_func_end, t_end, callback_times)`.
+    """
+    begins, ends = self._hooks(func.__name__)
+    clock = profiler.clock
+    callback_times = {}
+    t_begin = last = clock()
+    for callback, hook in begins:
+        hook(self, func, self.params, *aargs, **kkwargs)
+        now = clock()
+        callback_times[callback] = now - last
+        last = now
+
+    t_func_begin = last
+    try:
+        _meter = func(*aargs, **kkwargs)
+    except BaseException as e:
+        _handles = [callback.on_exception(self, func, self.params, e, *aargs, **kkwargs)
+                    for callback in call_set]
+
+        if any(_handles):
+            return None
+        else:
+            raise e
+    t_func_end = last = clock()
+
+    for callback, hook in ends:
+        hook(self, func, self.params, _meter, *aargs, **kkwargs)
+        now = clock()
+        callback_times[callback] = callback_times.get(callback, 0) + now - last
+        last = now
+
+    profiler.on_call(func.__name__, t_begin, t_func_begin, t_func_end, last, callback_times)
+    return _meter
+
+
 init_function = ['icallbacks', 'imodels']
 call_dependency = {
     'train': init_function,
@@ -119,7 +189,7 @@ class _BaseTrainer(metaclass=TrainerPropVar):
                 process_loader = getattr(self, 'process_loader', None)
                 if process_loader is not None:
                     process_loader(dm, TrainStage.create_from_str(func.__name__))
-                func(*args, **kwargs)
+                return func(*args, **kwargs)
 
             return inner
 
@@ -137,9 +207,12 @@ class _BaseTrainer(metaclass=TrainerPropVar):
             @wraps(func)
             def _newfunc(*aargs, **kkwargs):
                 """执行前回调 on_begin() 、执行后回调 on_end()、执行异常则回调 on_exception() """
+                if self._profiler is not None:
+                    return _profiled_call(self, self._profiler, func, call_set, aargs, kkwargs)
+                begins, ends = self._hooks(func.__name__)
                 # on_begin
-                for callback in call_set:
-                    callback.on_begin(self, func, self.params, *aargs, **kkwargs)
+                for _, hook in begins:
+                    hook(self, func, self.params, *aargs, **kkwargs)
                 try:
                     _meter = func(*aargs, **kkwargs)
                 except BaseException as e:
@@ -151,13 +224,16 @@ class _BaseTrainer(metaclass=TrainerPropVar):
                     else:
                         raise e
 
-                for callback in call_set:
-                    callback.on_end(self, func, self.params, _meter, *aargs, **kkwargs)
+                for _, hook in ends:
+                    hook(self, func, self.params, _meter, *aargs, **kkwargs)
                 return _meter
 
             return _newfunc
 
         self.callbacks = []
+        self._profiler = None
+        self._dispatch = {}
+        self._dispatch_size = 0
 
         vars = dir(self)
         for name in vars:
@@ -173,6 +249,20 @@ class _BaseTrainer(metaclass=TrainerPropVar):
             setattr(self, func.__name__, init_wrapper(func))
         return self
 
+    def _build_dispatch(self):
+        """Rebuild dispatch tables of callbacks, called when callbacks are added or removed."""
+        self._dispatch = {}
+        self._dispatch_size = len(self.callbacks)
+
+    def _hooks(self, name):
+        if len(self.callbacks) != self._dispatch_size:
+            # callbacks are changed without add_callback()/remove_callback()
+            self._build_dispatch()
+        hooks = self._dispatch.get(name, None)
+        if hooks is None:
+            hooks = self._dispatch[name] = build_hooks(self.callbacks, name)
+        return hooks
+
     def __getitem__(self, item):
         return getattr(self, item)
 
@@ -0,0 +1,130 @@
+"""
+Batched and downsampled scalar writing for tensorboard, see `BatchedSummaryWriter`.
+"""
+import importlib
+import threading
+import time
+from typing import Optional
+
+__all__ = ['BatchedSummaryWriter']
+
+REDUCES = {'mean', 'min', 'max'}
+
+
+def _scalar_summary(writer):
+    """`summary.scalar()` of the module of `writer`, for `torch.utils.tensorboard` and `tensorboardX`."""
+    if not hasattr(writer, '_get_file_writer'):
+        return None
+    package = type(writer).__module__.rsplit('.', 1)[0]
+    try:
+        return importlib.import_module(f'{package}.summary').scalar
+    except (ImportError, AttributeError):
+        return None
+
+
+class BatchedSummaryWriter:
+    """
+    Wrap a `SummaryWriter` to buffer scalars in memory and write them in a background thread every
+    `flush_interval` seconds. Scalars of the same step are merged into one event, and a scalar logged twice
+    at the same step only keeps the last value. Other methods are passed to the wrapped writer directly.
+
+    Scalars can be downsampled per tag: with `reduce=None` only every `downsample`-th value is kept, otherwise
+    every `downsample` values are reduced into one value by `mean`, `min` or `max`, written at the step of the
+    last one.
+
+    ```
+    writer = BatchedSummaryWriter(SummaryWriter(log_dir), flush_interval=10, downsample=10, reduce='mean')
+    writer.add_scalar('loss', loss, global_step=step)
+    ```
+
+    Args:
+        writer: a `SummaryWriter` of `torch.utils.tensorboard` or `tensorboardX`.
+        flush_interval: seconds between two writes.
+        downsample: number of values of a tag for each written value.
+        reduce: None, 'mean', 'min' or 'max'.
+    """
+
+    def __init__(self, writer, flush_interval: float = 10., downsample: int = 1, reduce: Optional[str] = None):
+        assert flush_interval > 0, f'flush_interval should be positive, but got {flush_interval}.'
+        assert downsample >= 1, f'downsample should be a positive integer, but got {downsample}.'
+        assert reduce is None or reduce in REDUCES, f'reduce should be one of {REDUCES} or None, but got {reduce}.'
+        self.writer = writer
+        self.flush_interval = flush_interval
+        self.downsample = downsample
+        self.reduce = reduce
+        self._scalar = _scalar_summary(writer)
+        self._lock = threading.Lock()  # guards the buffer
+        self._write_lock = threading.Lock()  # keeps events in order
+        self._buffer = {}  # step -> {tag: (value, walltime)}
+        self._windows = {}  # tag -> [count, sum, min, max, step, walltime]
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lumo-board', daemon=True)
+        self._thread.start()
+
+    def __getattr__(self, item):
+        return getattr(self.writer, item)
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            self._write()
+
+    def _reduced(self, window):
+        count, total, vmin, vmax = window[:4]
+        if self.reduce == 'mean':
+            return total / count
+        return vmin if self.reduce == 'min' else vmax
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None, **kwargs):
+        value = float(scalar_value)
+        walltime = time.time() if walltime is None else walltime
+        with self._lock:
+            window = self._windows.get(tag, None)
+            if window is None:
+                window = self._windows[tag] = [0, 0., float('inf'), float('-inf'), None, None]
+            window[0] += 1
+            if self.reduce is None:
+                if (window[0] - 1) % self.downsample != 0:
+                    return
+            else:
+                window[1] += value
+                window[2] = min(window[2], value)
+                window[3] = max(window[3], value)
+                window[4:] = global_step, walltime
+                if window[0] < self.downsample:
+                    return
+                value = self._reduced(window)
+                self._windows[tag] = None
+            self._buffer.setdefault(global_step, {})[tag] = (value, walltime)
+
+    def _write(self):
+        with self._write_lock:
+            with self._lock:
+                buffer, self._buffer = self._buffer, {}
+            for step, values in buffer.items():
+                if self._scalar is None:
+                    for tag, (value, walltime) in values.items():
+                        self.writer.add_scalar(tag, value, global_step=step, walltime=walltime)
+                    continue
+                summaries = [self._scalar(tag, value) for tag, (value, _) in values.items()]
+                summary = type(summaries[0])(value=[v for s in summaries for v in s.value])
+                walltime = max(walltime for _, walltime in values.values())
+                self.writer._get_file_writer().add_summary(summary, step, walltime)
+
+    def flush(self):
+        """Write all buffered scalars. Incomplete windows of `reduce` are kept until `close()`."""
+        self._write()
+        self.writer.flush()
+
+    def close(self):
+        """Write all buffered scalars and reduced incomplete windows, then close the wrapped writer."""
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            for tag, window in self._windows.items():
+                if window is not None and self.reduce is not None:
+                    self._buffer.setdefault(window[4], {})[tag] = (self._reduced(window), window[5])
+            self._windows.clear()
+        self.flush()
+        self.writer.close()
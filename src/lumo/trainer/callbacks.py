@@ -5,16 +5,18 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import inspect
 import json
 import os
-import tempfile
+import sys
 import time
 import traceback
 from datetime import datetime
 from functools import wraps
 from typing import TYPE_CHECKING, NewType, Any, Optional, Dict, Union
 
+import torch
 from torch.utils.data import DataLoader
 
 from lumo.core import ParamsType, Meter, MetricType, Record, TrainStage, wrap_result
+from lumo.core.record_backend import RecordBackend, SqliteRecordBackend, CSVRecordBackend
 from lumo.data import DataModule
 from lumo.utils.screen import inlinetqdm
 from lumo.data.loader import summarize_loader, DataLoaderType
@@ -352,14 +354,30 @@ class DebugCallback(BaseCallback):
 
 
 class LoggerCallback(TrainCallback, InitialCallback):
+    """
+    Log the progress of each stage inline, and break the line every `break_in` steps and at the end of stages.
+
+    Progress strings are only formatted when they are rendered, which happens at most `refresh_rate` times per
+    second (and only every `step_frequence` steps). If stdout is not a terminal, inline progress is skipped
+    and only the line breaks are logged.
+
+    Args:
+        step_frequence: minimal number of steps between two renders.
+        break_in: number of steps between two line breaks.
+        refresh_rate: maximal number of renders per second, `0` means no limit.
+    """
 
-    def __init__(self, step_frequence=3, break_in=1000):
+    def __init__(self, step_frequence=3, break_in=1000, refresh_rate=2):
         self.stage = {}
         self.breakin = break_in
         self.c = 0
         self.step = step_frequence
-        file = tempfile.TemporaryFile('w')
-        self.temp = file
+        self.interval = 1 / refresh_rate if refresh_rate else 0
+        self.last_render = float('-inf')
+        self.cur_stage = None
+        # tqdm is only used to format progress strings, nothing need to be written.
+        self.temp = open(os.devnull, 'w')
+        self.isatty = sys.stdout.isatty()
 
     def on_imodels_end(self, trainer: 'Trainer', func, params: ParamsType, result: Any, *args, **kwargs):
         super().on_imodels_end(trainer, func, params, result, *args, **kwargs)
@@ -397,21 +415,35 @@ class LoggerCallback(TrainCallback, InitialCallback):
         """创建一个新的"""
         self.cur_tqdm = inlinetqdm(total=self.stage[stage], position=0, leave=True,
                                    bar_format='{desc}{elapsed}<{remaining} ({percentage:3.0f}%){postfix}',
-                                   file=self.temp)
+                                   file=self.temp, mininterval=float('inf'))
         self.record = Record()
+        self.cur_stage = stage
+        self.c = 0
+
+    def render(self, trainer: 'Trainer'):
+        """Sync the progress bar with the steps and records since the last render."""
+        self.cur_tqdm.update(self.c - self.cur_tqdm.n)
+        self.cur_tqdm.set_description_str(f"{trainer.idx + 1}/{self.stage[self.cur_stage]}, ", refresh=False)
+        self.cur_tqdm.set_postfix_str(self.record.tostr(), refresh=False)
 
     def update(self, trainer: 'Trainer'):
         self.c += 1
-        self.cur_tqdm.update()
-        if self.c % self.step == 0:
-            trainer.logger.raw(self.cur_tqdm, inline=True)
-
-        if self.c % self.breakin == 0 or (
-                TrainStage.train in self.stage and ((trainer.idx + 1) == self.stage[TrainStage.train])):
+        break_in = self.c % self.breakin == 0 or (
+                self.cur_stage == TrainStage.train and (trainer.idx + 1) == self.stage[TrainStage.train])
+        if break_in:
+            self.render(trainer)
             trainer.logger.inline(self.cur_tqdm)
             trainer.logger.newline()
+            self.last_render = time.monotonic()
+        elif self.isatty and self.c % self.step == 0:
+            now = time.monotonic()
+            if now - self.last_render >= self.interval:
+                self.last_render = now
+                self.render(trainer)
+                trainer.logger.raw(self.cur_tqdm, inline=True)
 
     def flush(self, trainer: 'Trainer'):
+        self.render(trainer)
         self.c = 0
         trainer.logger.inline(self.cur_tqdm)
         trainer.logger.newline()
@@ -496,24 +528,18 @@ class LoggerCallback(TrainCallback, InitialCallback):
                           metric: MetricType = None,
                           *args, **kwargs):
         self.record.record(metric)
-        self.cur_tqdm.set_description_str(f"{trainer.idx + 1}/{self.stage[TrainStage.train]}, ", refresh=False)
-        self.cur_tqdm.set_postfix_str(self.record.tostr(), refresh=False)
         self.update(trainer)
 
     def on_eval_step_end(self, trainer: 'Trainer', func, params: ParamsType,
                          metric: MetricType = None,
                          *args, **kwargs):
         self.record.record(metric)
-        self.cur_tqdm.set_description_str(f"{trainer.idx + 1}/{self.stage[TrainStage.val]}, ", refresh=False)
-        self.cur_tqdm.set_postfix_str(self.record.tostr(), refresh=False)
         self.update(trainer)
 
     def on_test_step_end(self, trainer: 'Trainer', func, params: ParamsType,
                          metric: MetricType = None,
                          *args, **kwargs):
         self.record.record(metric)
-        self.cur_tqdm.set_description_str(f"{trainer.idx + 1}/{self.stage[TrainStage.test]}, ", refresh=False)
-        self.cur_tqdm.set_postfix_str(self.record.tostr(), refresh=False)
         self.update(trainer)
 
 
@@ -602,7 +628,13 @@ class AutoLoadModel(InitialCallback):
         if params.get('pretrain', False):
             path = params.get('pretrain_path', None)
             if path is not None:
-                trainer.load_state_dict(path)
+                # only the model weights are read from the memory-mapped checkpoint. They are under 'models' in
+                # checkpoints, and under 'model' in files of `save_model()`.
+                state_dict = trainer.saver.load_state_dict(path, keys=['models', 'model'], mmap=True)
+                models = state_dict.get('models', state_dict.get('model', None))
+                if not models:
+                    raise ValueError(f'No model weights found in {path}, expected the key `models` or `model`.')
+                trainer.load_state_dict({'models': models})
 
 
 class EvalFirst(AutoLoadModel):
@@ -745,6 +777,52 @@ class TensorBoardCallback(RecordCallback):
         return NotImplemented
 
 
+class RecordBackendCallback(RecordCallback):
+    """
+    Record metrics into a buffered backend, so step metrics can be recorded at a high frequency and queried later.
+
+    Args:
+        backend: 'sqlite' to record into `<exp dir>/metrics.sqlite`, which is shared by all tests of the experiment,
+            'csv' to record into `<test dir>/metrics.csv`, or a `RecordBackend` instance.
+        metric_step: record every `metric_step` train steps.
+        buffer_size: number of buffered records before writing.
+    """
+    only_main_process = True
+
+    def __init__(self, backend: Union[str, RecordBackend] = 'sqlite', metric_step=1, buffer_size=1000):
+        super().__init__(metric_step=metric_step)
+        assert isinstance(backend, RecordBackend) or backend in {'sqlite', 'csv'}, \
+            f'backend should be sqlite, csv or a RecordBackend instance, but got {backend}.'
+        self.backend = backend
+        self.buffer_size = buffer_size
+
+    def on_hooked(self, source: 'Trainer', params: ParamsType):
+        super().on_hooked(source, params)
+        if self.backend == 'sqlite':
+            self.backend = SqliteRecordBackend(source.exp.exp_file('metrics.sqlite'), test=source.exp.test_name,
+                                               buffer_size=self.buffer_size)
+        elif self.backend == 'csv':
+            self.backend = CSVRecordBackend(source.exp.test_file('metrics.csv'), buffer_size=self.buffer_size)
+        backend = self.backend
+        source.exp.add_exit_hook(lambda exp: backend.close())
+
+    def log_text(self, metrics: Dict, step: int, namespace: str):
+        self.backend.log({f'{namespace}.{k}': v for k, v in metrics.items()}, step=step)
+
+    def log_scalars(self, metrics: Dict, step: int, namespace: str):
+        self.backend.log({f'{namespace}.{k}': v.item() for k, v in metrics.items()}, step=step)
+
+    def log_matrix(self, metrics: Dict, step: int, namespace: str):
+        return NotImplemented
+
+    def on_train_end(self, trainer: 'Trainer', func, params: ParamsType, record: Record, *args, **kwargs):
+        super().on_train_end(trainer, func, params, record, *args, **kwargs)
+        self.backend.flush()
+
+    def __repr__(self) -> str:
+        return self._repr_by_val('metric_step', 'buffer_size')
+
+
 class StopByCode(TrainCallback):
     def __init__(self, step=100):
         self.step = step
@@ -758,6 +836,121 @@ class StopByCode(TrainCallback):
                 trainer.stop_train()
 
 
+class ProfileCallback(TrainCallback):
+    """
+    Profile each train step, and break its time down into phases:
+     - data_wait: time blocked in the loader iterator, i.e., from the end of the last step to the beginning of this.
+     - h2d: host-to-device copy of batches done by the prepared loader (not counted in data_wait).
+     - compute: `train_step()` itself.
+     - callbacks: `on_train_step_begin/end()` of all callbacks, except the logging ones.
+     - logging: `on_train_step_begin/end()` of `LoggerCallback` and `RecordCallback`.
+
+    A summary of each epoch is logged and appended into `profile.jsonl` of the experiment's test dir. If `trace`
+    is True, the first `trace_steps` steps of each epoch are also written as Chrome trace files
+    (`profile.<eidx>.trace.json`), which can be opened by `chrome://tracing` or Perfetto.
+
+    Args:
+        trace: whether to write Chrome trace files.
+        trace_steps: number of steps traced in each epoch.
+        synchronize: whether to synchronize CUDA before taking each timestamp. Kernels are launched asynchronously,
+            so without it, the device time of a step may be counted into the phase which waits for it.
+        clock: a function returning timestamps in seconds, `time.perf_counter` by default.
+    """
+    only_main_process = True
+    phases = ('data_wait', 'h2d', 'compute', 'callbacks', 'logging')
+
+    def __init__(self, trace=False, trace_steps=200, synchronize=False, clock=None):
+        self.trace = trace
+        self.trace_steps = trace_steps
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self._clock = time.perf_counter if clock is None else clock
+        self.reset()
+
+    def clock(self) -> float:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return self._clock()
+
+    def reset(self):
+        self.steps = 0
+        self.totals = {phase: 0. for phase in self.phases}
+        self.events = []
+        self._last_end = None
+        self._h2d = 0.
+
+    def on_hooked(self, source: 'Trainer', params: ParamsType):
+        super().on_hooked(source, params)
+        source._profiler = self
+
+    def _loader_h2d(self, trainer: 'Trainer') -> float:
+        loader = trainer.train_dataloader
+        return getattr(loader, 'h2d_time', 0.) if loader is not None else 0.
+
+    def on_train_epoch_begin(self, trainer: 'Trainer', func, params: ParamsType, *args, **kwargs):
+        super().on_train_epoch_begin(trainer, func, params, *args, **kwargs)
+        self.reset()
+        self._h2d = self._loader_h2d(trainer)
+        self._last_end = self.clock()
+
+    def on_call(self, name, t_begin, t_func_begin, t_func_end, t_end, callback_times: dict):
+        """Called by the trainer after each callback-wrapped function, with timestamps of `clock()`."""
+        if name != 'train_step' or self._last_end is None:
+            return
+        h2d = self._loader_h2d(self._hooked)
+        h2d, self._h2d = h2d - self._h2d, h2d
+        logging = sum(t for cb, t in callback_times.items() if isinstance(cb, (LoggerCallback, RecordCallback)))
+        times = {
+            'data_wait': max(t_begin - self._last_end - h2d, 0.),
+            'h2d': h2d,
+            'compute': t_func_end - t_func_begin,
+            'callbacks': (t_func_begin - t_begin) + (t_end - t_func_end) - logging,
+            'logging': logging,
+        }
+        for phase, t in times.items():
+            self.totals[phase] += t
+
+        if self.trace and self.steps < self.trace_steps:
+            start = self._last_end
+            for phase in self.phases:
+                if times[phase] > 0:
+                    self.events.append({'name': phase, 'ph': 'X', 'pid': 0, 'tid': 0,
+                                        'ts': start * 1e6, 'dur': times[phase] * 1e6,
+                                        'args': {'step': self.steps}})
+                    start += times[phase]
+        self.steps += 1
+        self._last_end = t_end
+
+    def summary(self) -> dict:
+        total = sum(self.totals.values())
+        res = {'steps': self.steps, 'total': total}
+        for phase, t in self.totals.items():
+            res[phase] = {
+                'total': t,
+                'mean_ms': t / max(self.steps, 1) * 1000,
+                'ratio': t / total if total > 0 else 0.,
+            }
+        return res
+
+    def chrome_trace(self) -> dict:
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms'}
+
+    def on_train_epoch_end(self, trainer: 'Trainer', func, params: ParamsType, record: Record, *args, **kwargs):
+        super().on_train_epoch_end(trainer, func, params, record, *args, **kwargs)
+        summary = self.summary()
+        trainer.logger.info('Profile: ' + ' | '.join(
+            f"{phase}: {summary[phase]['ratio']:.1%} ({summary[phase]['mean_ms']:.2f}ms)" for phase in self.phases))
+
+        with open(trainer.exp.test_file('profile.jsonl'), 'a') as w:
+            w.write(json.dumps(dict(eidx=trainer.eidx, **summary)) + '\n')
+        if self.trace:
+            with open(trainer.exp.test_file(f'profile.{trainer.eidx:03d}.trace.json'), 'w') as w:
+                json.dump(self.chrome_trace(), w)
+        self._last_end = None
+
+    def __repr__(self) -> str:
+        return self._repr_by_val("trace", "synchronize")
+
+
 CallbackType = NewType('CallbackType', BaseCallback)
 
 
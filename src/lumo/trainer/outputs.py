@@ -0,0 +1,113 @@
+"""
+Buffers of per-sample outputs used by bulk evaluation, see `Trainer.bulk_eval()`.
+"""
+from typing import Dict, Optional
+
+import torch
+
+__all__ = ['OutputBuffer']
+
+
+class OutputBuffer:
+    """
+    Collect per-sample outputs of batches into preallocated tensors on their own device, so no host sync
+    happens until all batches are collected.
+
+    ```
+    buffer = OutputBuffer(capacity=len(dataset))
+    for batch in loader:
+        buffer.append({'logits': model(batch['xs']), 'labels': batch['ys']})
+    outputs = buffer.gather(accelerator)  # {'logits': [N, C], 'labels': [N]}
+    ```
+
+    Args:
+        capacity: expected number of samples, e.g., size of the dataset of this rank. Buffers grow by
+            doubling if it is exceeded or unknown.
+    """
+
+    def __init__(self, capacity: Optional[int] = None):
+        self.capacity = capacity
+        self.size = 0
+        self.batch_size = None
+        self._buffers = {}  # type: Dict[str, torch.Tensor]
+
+    def __len__(self):
+        return self.size
+
+    def _reserve(self, key, value: torch.Tensor, size: int) -> torch.Tensor:
+        buffer = self._buffers.get(key, None)
+        if buffer is None:
+            capacity = max(self.capacity or 0, size)
+            buffer = torch.empty((capacity, *value.shape[1:]), dtype=value.dtype, device=value.device)
+        elif buffer.shape[0] < size:
+            grown = torch.empty((max(size, buffer.shape[0] * 2), *buffer.shape[1:]),
+                                dtype=buffer.dtype, device=buffer.device)
+            grown[:self.size] = buffer[:self.size]
+            buffer = grown
+        self._buffers[key] = buffer
+        return buffer
+
+    def append(self, outputs: Dict[str, torch.Tensor]):
+        """
+        Args:
+            outputs: tensors of the same batch, whose first dimension is the batch dimension.
+        """
+        outputs = {k: torch.as_tensor(v).detach() for k, v in outputs.items()}
+        sizes = {v.shape[0] if v.dim() > 0 else None for v in outputs.values()}
+        assert len(sizes) == 1 and None not in sizes, \
+            f'All outputs should have the same batch size, but got {[tuple(v.shape) for v in outputs.values()]}.'
+        assert self.batch_size is None or set(self._buffers) == set(outputs), \
+            f'Outputs should have the same keys, expected {set(self._buffers)}, but got {set(outputs)}.'
+        size = sizes.pop()
+        if self.batch_size is None:
+            self.batch_size = size
+        end = self.size + size
+        for k, v in outputs.items():
+            self._reserve(k, v, end)[self.size:end] = v
+        self.size = end
+        return self
+
+    def outputs(self) -> Dict[str, torch.Tensor]:
+        """Collected outputs of this rank."""
+        return {k: v[:self.size] for k, v in self._buffers.items()}
+
+    def gather(self, accelerator=None, num_samples: Optional[int] = None,
+               unit: Optional[int] = None) -> Dict[str, torch.Tensor]:
+        """
+        Collected outputs of all ranks.
+
+        Args:
+            accelerator: the `Accelerator` of processes, outputs of this rank are returned if None.
+            num_samples: size of the dataset. If given, outputs are returned in the order of the dataset, and the
+                samples padded by distributed samplers to even out ranks are dropped. Ranks take `unit` samples of
+                the dataset in turn (e.g., `BatchSamplerShard` of accelerate), so the padded ones are those whose
+                positions exceed `num_samples`.
+            unit: number of consecutive samples each rank takes in turn, the first batch size by default.
+        """
+        res = self.outputs()
+        if accelerator is None or accelerator.num_processes <= 1:
+            return res
+
+        sizes = accelerator.gather(torch.tensor([self.size], device=accelerator.device)).tolist()
+        gathered = {}
+        for k, v in res.items():
+            v = accelerator.gather(accelerator.pad_across_processes(v, dim=0))
+            chunk = v.shape[0] // len(sizes)
+            gathered[k] = torch.cat([v[i * chunk:i * chunk + size] for i, size in enumerate(sizes)])
+
+        if num_samples is not None and len(gathered) > 0:
+            index = self.dataset_index(sizes, unit or self.batch_size or 1)
+            order = torch.argsort(index)
+            order = order[index[order] < num_samples]
+            gathered = {k: v[order.to(v.device)] for k, v in gathered.items()}
+        return gathered
+
+    @staticmethod
+    def dataset_index(sizes, unit: int) -> torch.Tensor:
+        """Positions in the dataset of the gathered samples of ranks with `sizes`, see `gather()`."""
+        num_processes = len(sizes)
+        index = []
+        for rank, size in enumerate(sizes):
+            i = torch.arange(size)
+            index.append((i // unit * num_processes + rank) * unit + i % unit)
+        return torch.cat(index)
@@ -1,7 +1,18 @@
+import copy
+import hashlib
 import os
+import pickle
+import queue
 import shutil
+import sys
 import textwrap
-from typing import Optional, Union, List
+import threading
+import traceback
+from collections import OrderedDict
+from typing import Optional, Union, List, Sequence
+
+import numpy as np
+import torch
 
 from lumo.utils import safe_io as io
 
@@ -12,6 +23,214 @@ class state_dict_tuple:
         self.state_dict=state_dict
         self.meta_info = meta_info
 
+def _snapshot(obj, buffers: dict, memo: dict, key=()):
+    """
+    Copy tensors in `obj` into CPU buffers of `buffers`, which are reused if the shape and dtype of the tensor
+    at the same position are not changed. Buffers of cuda tensors are pinned so the copy is asynchronous.
+    """
+    if isinstance(obj, torch.Tensor):
+        if id(obj) in memo:
+            # keep tensors shared (e.g., tied weights) shared in the snapshot
+            return memo[id(obj)]
+        if obj.layout != torch.strided:
+            res = obj.detach().cpu().clone()
+        else:
+            res = buffers.get(key, None)
+            if res is None or res.shape != obj.shape or res.dtype != obj.dtype:
+                res = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                buffers[key] = res
+            res.copy_(obj.detach(), non_blocking=obj.is_cuda)
+        memo[id(obj)] = res
+        return res
+    elif isinstance(obj, np.ndarray):
+        return obj.copy()
+    elif isinstance(obj, (int, float, str, bool, type(None))):
+        return obj
+    elif isinstance(obj, (dict, list, tuple)):
+        return _map_container(obj, lambda k, v: _snapshot(v, buffers, memo, key + (k,)))
+    return copy.deepcopy(obj)
+
+
+def _map_container(obj, func):
+    """Apply `func(key, value)` to items of a dict/list/tuple, keep the `_metadata` of module state dicts."""
+    if isinstance(obj, OrderedDict):
+        res = OrderedDict((k, func(k, v)) for k, v in obj.items())
+        if hasattr(obj, '_metadata'):
+            res._metadata = obj._metadata
+        return res
+    elif isinstance(obj, dict):
+        return {k: func(k, v) for k, v in obj.items()}
+    elif type(obj) in {list, tuple}:
+        return type(obj)(func(i, v) for i, v in enumerate(obj))
+    return obj
+
+
+def _to_device(obj, device):
+    """Move tensors in `obj` to `device`."""
+    if isinstance(obj, torch.Tensor):
+        return obj.to(device)
+    elif isinstance(obj, (dict, list, tuple)):
+        return _map_container(obj, lambda k, v: _to_device(v, device))
+    return obj
+
+
+INDEX_SUFFIX = '.index.json'
+SHARD_DIR = 'shards'
+
+
+class _HashWriter:
+    """A file-like object which feeds written bytes into a hash."""
+
+    def __init__(self, hasher):
+        self.hasher = hasher
+
+    def write(self, b):
+        self.hasher.update(b)
+
+
+class _HashPickler(pickle.Pickler):
+    """Pickle the structure of an object, with the raw bytes of its tensors fed into the hash directly."""
+
+    def __init__(self, hasher):
+        super().__init__(_HashWriter(hasher), protocol=4)
+        self.hasher = hasher
+
+    def persistent_id(self, obj):
+        if isinstance(obj, torch.Tensor) and obj.layout == torch.strided:
+            tensor = obj.detach().cpu().contiguous().reshape(-1)
+            self.hasher.update(f'{tensor.dtype}{tuple(obj.shape)}'.encode())
+            self.hasher.update(tensor.view(torch.uint8).numpy())
+            return 'tensor'
+        return None
+
+
+def hash_state_dict(obj) -> str:
+    """Content hash of a state dict, which is used to deduplicate shards across checkpoints."""
+    hasher = hashlib.blake2b(digest_size=16)
+    _HashPickler(hasher).dump(obj)
+    return hasher.hexdigest()
+
+
+def _nbytes(obj) -> int:
+    if isinstance(obj, torch.Tensor):
+        return obj.numel() * obj.element_size()
+    return 0
+
+
+def split_shards(state_dict: dict, max_shard_size: int = None):
+    """
+    Split a state dict into shards, one per top-level entry. If the entry is a group of state dicts, like
+    `models` or `optims` of `Trainer.state_dict()`, one per state dict in the group. A state dict larger than
+    `max_shard_size` bytes is further split into parts.
+
+    Returns:
+        a list of (key path, part index, shard object).
+    """
+    entries = []
+    for k, v in state_dict.items():
+        if (isinstance(v, dict) and len(v) > 0 and all(isinstance(sub, dict) for sub in v.values())
+                and all(isinstance(sk, str) for sk in v.keys())):
+            entries.extend(((k, sk), sv) for sk, sv in v.items())
+        else:
+            entries.append(((k,), v))
+
+    res = []
+    for key, value in entries:
+        if max_shard_size is None or not isinstance(value, dict) or len(value) == 0:
+            res.append((key, 0, value))
+            continue
+        parts = [OrderedDict()]
+        size = 0
+        for k, v in value.items():
+            nbytes = _nbytes(v)
+            if size > 0 and size + nbytes > max_shard_size:
+                parts.append(OrderedDict())
+                size = 0
+            parts[-1][k] = v
+            size += nbytes
+        # keep the version info of module state dicts
+        if hasattr(value, '_metadata'):
+            parts[0]._metadata = value._metadata
+        res.extend((key, i, part) for i, part in enumerate(parts))
+    return res
+
+
+def _match_keys(key: Sequence[str], keys: Sequence[str]) -> bool:
+    """Whether the key path is selected by `keys`, a list of dotted prefixes like 'models' or 'models.backbone'."""
+    if keys is None:
+        return True
+    for item in keys:
+        prefix = item.split('.')
+        n = min(len(prefix), len(key))
+        if list(key[:n]) == prefix[:n]:
+            return True
+    return False
+
+
+def select_keys(state_dict, keys: Sequence[str] = None):
+    """Keep the entries of `state_dict` selected by `keys`, see `Saver.load_state_dict()`."""
+    if keys is None or not isinstance(state_dict, dict):
+        return state_dict
+    res = {}
+    for item in keys:
+        cur, src = res, state_dict
+        path = item.split('.')
+        for i, k in enumerate(path):
+            if not isinstance(src, dict) or k not in src:
+                break
+            if i == len(path) - 1:
+                cur[k] = src[k]
+            else:
+                cur = cur.setdefault(k, {})
+                src = src[k]
+    return res
+
+
+class AsyncWriter:
+    """
+    Run save jobs in a background thread in submission order, see `Saver(async_write=True)`.
+
+    State dicts are snapshotted into reusable CPU buffers on the calling thread, so training can continue to
+    update the parameters while the snapshot is serialized and written. Only one snapshot is in flight,
+    `snapshot()` waits for the jobs of the previous one before overwriting the buffers.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._buffers = {}
+        self.pending = set()
+
+    def _run(self):
+        while True:
+            job, args = self._queue.get()
+            try:
+                job(*args)
+            except Exception:
+                # same as the synchronous saver, print the error and keep training.
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def snapshot(self, obj):
+        self.flush()
+        res = _snapshot(obj, self._buffers, {})
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+        return res
+
+    def submit(self, job, *args):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='lumo-saver', daemon=True)
+            self._thread.start()
+        self._queue.put((job, args))
+
+    def flush(self):
+        """Block until all submitted jobs are done."""
+        if self._thread is not None:
+            self._queue.join()
+
+
 class Saver:
     """
     Write state_dict into test dirs, record save log into <repo working dir>/.lumo/save.<exp_name>.log
@@ -24,10 +243,36 @@ class Saver:
         then Exception or its stack infomation will be printed in stderr (not be raised), and `False`/`None` value will be returned by
         save_xx and load_xx functions.
         You can handle these values and stop your program manully, or just let it go.
+
+    Args:
+        save_dir: directory to save state dicts.
+        async_write: if True, state dicts are snapshotted to CPU and written by a background thread, and save_xx
+            functions return the path immediately. The write and the pruning of old checkpoints are done in the
+            background, call `flush()` to wait for them (loading functions will call it automatically).
+
+        sharded: if True, state dicts are saved as shards in `<save_dir>/shards`, along with an index file
+            `<fn>.index.json`. Shards are named by their content hash, so unchanged entries (e.g., frozen models)
+            are stored only once across checkpoints, and can be loaded separately by `keys` of `load_xx`.
+        max_shard_size: max bytes of each shard in sharded mode, None means one shard per state dict.
     """
 
-    def __init__(self, save_dir):
+    def __init__(self, save_dir, async_write=False, sharded=False, max_shard_size: int = None):
         self._save_dir = save_dir
+        self._writer = AsyncWriter() if async_write else None
+        self.sharded = sharded
+        self.max_shard_size = max_shard_size
+
+    def flush(self):
+        """Wait for all background writes, only takes effect when `async_write=True`."""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def _run(self, job, *args):
+        """Run `job` in the background writer if there is one, otherwise run it directly."""
+        if self._writer is not None:
+            self._writer.submit(job, *args)
+        else:
+            job(*args)
 
     @property
     def save_dir(self):
@@ -62,7 +307,7 @@ class Saver:
 
         path = _create_path()
         if not replacement:
-            while os.path.exists(path):
+            while self._exists(path) or (self._writer is not None and path in self._writer.pending):
                 offset += 1
                 path = _create_path()
         return path
@@ -78,7 +323,31 @@ class Saver:
         Returns:
             saved filepath, None if something went wrong.
         """
-        res = io.dump_state_dict(obj, fn)
+        if self._writer is None:
+            return self._dump_state_dict(obj, fn, meta_info)
+
+        obj = self._writer.snapshot(obj)
+        self._writer.pending.add(fn)
+        self._writer.submit(self._dump_state_dict, obj, fn, meta_info)
+        return fn
+
+    def _dump_state_dict(self, obj, fn, meta_info: Union[str, dict] = None):
+        try:
+            if self.sharded and isinstance(obj, dict):
+                res = self._dump_sharded(obj, fn)
+            else:
+                # write to a temp file first, so an interrupted write will not leave a broken checkpoint.
+                tmp_fn = f'{fn}.tmp'
+                res = io.dump_state_dict(obj, tmp_fn)
+                if res:
+                    os.replace(tmp_fn, fn)
+                    res = fn
+                    if os.path.exists(f'{fn}{INDEX_SUFFIX}'):
+                        self._remove(f'{fn}{INDEX_SUFFIX}')
+                        self._gc_shards()
+        finally:
+            if self._writer is not None:
+                self._writer.pending.discard(fn)
         if res and meta_info is not None:
             if isinstance(meta_info, str):
                 meta_info = {'msg': meta_info}
@@ -86,13 +355,81 @@ class Saver:
             io.dump_json(meta_info, json_fn)
         return res
 
-    def load_state_dict(self, fn: str, with_meta=False, map_location='cpu') -> state_dict_tuple:
+    def _dump_sharded(self, obj: dict, fn):
+        shard_dir = os.path.join(self.save_dir, SHARD_DIR)
+        os.makedirs(shard_dir, exist_ok=True)
+        shards = []
+        for key, part, item in split_shards(obj, self.max_shard_size):
+            name = f'{SHARD_DIR}/{hash_state_dict(item)}.pt'
+            path = os.path.join(self.save_dir, name)
+            if not os.path.exists(path):
+                tmp_fn = f'{path}.tmp'
+                io.dump_state_dict(item, tmp_fn)
+                os.replace(tmp_fn, path)
+            shards.append({'key': list(key), 'part': part, 'file': name})
+
+        index_fn = f'{fn}{INDEX_SUFFIX}'
+        replaced = os.path.exists(index_fn) or os.path.exists(fn)
+        io.dump_json({'format': 'lumo.sharded', 'shards': shards}, f'{index_fn}.tmp')
+        os.replace(f'{index_fn}.tmp', index_fn)
+        if os.path.exists(fn):
+            os.remove(fn)
+        if replaced:
+            self._gc_shards()
+        return fn
+
+    def _load_sharded(self, fn, keys: Sequence[str] = None, map_location='cpu', mmap=False):
+        index = io.load_json(f'{fn}{INDEX_SUFFIX}')
+        res = {}
+        for shard in index['shards']:
+            key = shard['key']
+            if not _match_keys(key, keys):
+                continue
+            item = io.load_state_dict(os.path.join(self.save_dir, shard['file']), map_location=map_location,
+                                      mmap=mmap)
+            cur = res
+            for k in key[:-1]:
+                cur = cur.setdefault(k, {})
+            if shard['part'] > 0:
+                cur[key[-1]].update(item)
+            else:
+                cur[key[-1]] = item
+        return select_keys(res, keys)
+
+    def _exists(self, fn) -> bool:
+        return os.path.exists(fn) or os.path.exists(f'{fn}{INDEX_SUFFIX}')
+
+    def _remove(self, fn):
+        """Remove a saved state dict, its meta info and index file. Shards should be removed by `_gc_shards()`."""
+        for path in [fn, f'{fn}.json', f'{fn}{INDEX_SUFFIX}']:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _gc_shards(self):
+        """Remove shards which are not referenced by any index file."""
+        shard_dir = os.path.join(self.save_dir, SHARD_DIR)
+        if not os.path.exists(shard_dir):
+            return
+        used = set()
+        for f in os.listdir(self.save_dir):
+            if f.endswith(INDEX_SUFFIX):
+                used.update(shard['file'] for shard in io.load_json(os.path.join(self.save_dir, f))['shards'])
+        for f in os.listdir(shard_dir):
+            if f.endswith('.pt') and f'{SHARD_DIR}/{f}' not in used:
+                os.remove(os.path.join(shard_dir, f))
+
+    def load_state_dict(self, fn: str, with_meta=False, map_location='cpu',
+                        keys: Sequence[str] = None, mmap=False) -> state_dict_tuple:
         """
 
         Args:
             fn: pickled file path.
             with_meta: whether to get its meta infomation at the same time, default is False.
             map_location:
+            keys: only load these entries, each is a top-level key or a dotted path like 'models.backbone'.
+                For sharded state dicts, other shards will not be read.
+            mmap: memory-map the file instead of reading it, so only the data of selected tensors will be read,
+                and moved to `map_location` directly.
 
         Returns:
             If `with_meta=True`, a `state_dict_tuple` object will be returned, you can unpack this tuple directly:
@@ -104,8 +441,17 @@ class Saver:
 
             if something went wrong, `ckpt` or `info` will be a None object.
         """
+        self.flush()
+        if not isinstance(map_location, (str, torch.device, type(None))):
+            # dict or callable map_location can only be handled by torch.load()
+            mmap = False
         path = self._guess_abs_path(fn)
-        ckpt = io.load_state_dict(path, map_location=map_location)
+        if os.path.exists(f'{path}{INDEX_SUFFIX}'):
+            ckpt = self._load_sharded(path, keys, map_location=map_location, mmap=mmap)
+        else:
+            ckpt = select_keys(io.load_state_dict(path, map_location=map_location, mmap=mmap), keys)
+        if mmap and map_location is not None and torch.device(map_location).type != 'cpu':
+            ckpt = _to_device(ckpt, map_location)
 
         if not with_meta:
             return ckpt
@@ -123,6 +469,7 @@ class Saver:
             info object, or None if something went wrong.
 
         """
+        self.flush()
         path = self._guess_abs_path(fn)
         info_path = f"{path}.json"
         info = io.load_json(info_path)
@@ -163,9 +510,7 @@ class Saver:
         path = self._create_state_dict_name(step, replacement=False, prefix='checkpoints')
         res = self.dump_state_dict(state_dict, path, meta_info=meta_info)
         del state_dict
-        history = self.list_checkpoints()
-        if len(history) > max_keep:
-            [os.remove(os.path.join(self.save_dir, i)) for i in history[:-max_keep]]
+        self._run(self._prune_checkpoints, max_keep)
 
         if res:
             if is_best:
@@ -173,16 +518,29 @@ class Saver:
                                                          replacement=True,
                                                          prefix='best.checkpoint',
                                                          ignore_number=True)
-                shutil.copy2(path, best_path)
-                src_json_fn = f"{path}.json"
-                if os.path.exists(src_json_fn):
-                    tgt_json_fn = f"{best_path}.json"
-                    shutil.copy2(src_json_fn, tgt_json_fn)
+                self._run(self._copy_best, path, best_path)
 
             return path
         else:
             return None
 
+    def _prune_checkpoints(self, max_keep):
+        history = self._list('checkpoints')
+        if len(history) > max_keep:
+            [self._remove(os.path.join(self.save_dir, i)) for i in history[:-max_keep]]
+            self._gc_shards()
+
+    def _copy_best(self, path, best_path):
+        self._remove(best_path)
+        if os.path.exists(path):
+            shutil.copy2(path, best_path)
+        if os.path.exists(f'{path}{INDEX_SUFFIX}'):
+            shutil.copy2(f'{path}{INDEX_SUFFIX}', f'{best_path}{INDEX_SUFFIX}')
+        src_json_fn = f"{path}.json"
+        if os.path.exists(src_json_fn):
+            tgt_json_fn = f"{best_path}.json"
+            shutil.copy2(src_json_fn, tgt_json_fn)
+
     def save_model(self, step: int, state_dict, meta_info: Union[str, dict] = None, is_best=False) -> str:
         """
         save model
@@ -207,16 +565,14 @@ class Saver:
                                                          replacement=True,
                                                          prefix='best.model',
                                                          ignore_number=True)
-                shutil.copy2(path, best_path)
-                src_json_fn = f"{path}.json"
-                if os.path.exists(src_json_fn):
-                    tgt_json_fn = f"{best_path}.json"
-                    shutil.copy2(src_json_fn, tgt_json_fn)
+                self._run(self._copy_best, path, best_path)
             return path
         else:
             return None
 
-    def load_checkpoint(self, index=-1, best_if_exist=False, fn=None, with_meta=False, map_location='cpu'):
+    def load_checkpoint(self, index=-1, best_if_exist=False, fn=None, with_meta=False, map_location='cpu', keys=None,
+                        mmap=False):
+        self.flush()
         if fn is None and best_if_exist:
             fn = self.best_checkpoint()
         if fn is None:
@@ -225,20 +581,24 @@ class Saver:
             except:
                 pass
         if fn is not None:
-            return self.load_state_dict(fn, with_meta, map_location)
+            return self.load_state_dict(fn, with_meta, map_location, keys=keys, mmap=mmap)
         return None
 
-    def load_keypoint(self, index=-1, fn=None, with_meta=False, map_location='cpu'):
+    def load_keypoint(self, index=-1, fn=None, with_meta=False, map_location='cpu', keys=None,
+                      mmap=False):
+        self.flush()
         if fn is None:
             try:
                 fn = self.list_keypoints()[index]
             except:
                 pass
         if fn is not None:
-            return self.load_state_dict(fn, with_meta, map_location)
+            return self.load_state_dict(fn, with_meta, map_location, keys=keys, mmap=mmap)
         return None
 
-    def load_model(self, index=-1, best_if_exist=False, fn=None, with_meta=False, map_location='cpu'):
+    def load_model(self, index=-1, best_if_exist=False, fn=None, with_meta=False, map_location='cpu', keys=None,
+                   mmap=False):
+        self.flush()
         if fn is None and best_if_exist:
             fn = self.best_model()
         if fn is None:
@@ -247,38 +607,47 @@ class Saver:
             except:
                 pass
         if fn is not None:
-            return self.load_state_dict(fn, with_meta, map_location)
+            return self.load_state_dict(fn, with_meta, map_location, keys=keys, mmap=mmap)
         return None
 
     def best_checkpoint(self):
         fn = os.path.join(self.save_dir, 'best.checkpoint.pt')
-        if os.path.exists(fn):
+        if self._exists(fn):
             return fn
         return None
 
     def best_model(self):
         fn = os.path.join(self.save_dir, 'best.model.pt')
-        if os.path.exists(fn):
+        if self._exists(fn):
             return fn
         return None
 
     def _is_pkl(self, x: str, start, end):
         return x.startswith(start) and x.endswith(end)
 
+    def _list(self, prefix) -> List[str]:
+        """Saved state dicts whose names start with `prefix`, including sharded ones, sorted by creation time."""
+        names = {x[:-len(INDEX_SUFFIX)] if x.endswith(INDEX_SUFFIX) else x for x in os.listdir(self.save_dir)}
+
+        def ctime(x):
+            path = os.path.join(self.save_dir, x)
+            if not os.path.exists(path):
+                path = f'{path}{INDEX_SUFFIX}'
+            return os.stat(path).st_ctime
+
+        return sorted(list(filter(lambda x: self._is_pkl(x, prefix, 'pt'), names)), key=ctime)
+
     def list_checkpoints(self) -> List[str]:
-        return sorted(list(filter(lambda x: self._is_pkl(x, 'checkpoints', 'pt'),
-                                  os.listdir(self.save_dir))),
-                      key=lambda x: os.stat(os.path.join(self.save_dir, x)).st_ctime)
+        self.flush()
+        return self._list('checkpoints')
 
     def list_keypoints(self) -> List[str]:
-        return sorted(list(filter(lambda x: self._is_pkl(x, 'key', 'pt'),
-                                  os.listdir(self.save_dir))),
-                      key=lambda x: os.stat(os.path.join(self.save_dir, x)).st_ctime)
+        self.flush()
+        return self._list('key')
 
     def list_models(self) -> List[str]:
-        return sorted(list(filter(lambda x: self._is_pkl(x, 'model', 'pt'),
-                                  os.listdir(self.save_dir))),
-                      key=lambda x: os.stat(os.path.join(self.save_dir, x)).st_ctime)
+        self.flush()
+        return self._list('model')
 
     def list(self):
         return sorted(os.listdir(self.save_dir))
@@ -0,0 +1,151 @@
+"""
+Evaluate many checkpoints with one trainer, see `Trainer.evaluate_checkpoints()`.
+"""
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import TYPE_CHECKING, Callable, List, Sequence, Union
+
+import numpy as np
+import torch
+
+from lumo.core import TrainStage
+from .saver import select_keys
+
+if TYPE_CHECKING:
+    from .trainer import Trainer
+
+__all__ = ['evaluate_checkpoints', 'dump_results']
+
+_worker_trainer = None
+
+
+def _scalar(value):
+    if isinstance(value, torch.Tensor) and value.numel() == 1:
+        return value.item()
+    if isinstance(value, np.ndarray) and value.size == 1:
+        return value.item()
+    return value
+
+
+def _clone(obj):
+    """Copy tensors of a (nested) state dict into memory, which also reads the pages of memory-mapped ones."""
+    if isinstance(obj, torch.Tensor):
+        return obj.clone()
+    if isinstance(obj, dict):
+        return obj.__class__((k, _clone(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(_clone(v) for v in obj)
+    return obj
+
+
+def _load(trainer: 'Trainer', checkpoint: str, keys):
+    # mmap only reads the selected entries, cloning reads them here in the background thread,
+    # rather than lazily in the first forward of the evaluation.
+    state_dict = _clone(trainer.saver.load_state_dict(checkpoint, keys=keys, mmap=True))
+    info = None
+    if os.path.exists(f'{trainer.saver._guess_abs_path(checkpoint)}.json'):
+        info = trainer.saver.load_meta_info(checkpoint)
+    return state_dict, info
+
+
+def _run(trainer: 'Trainer', checkpoints: Sequence[str], stage: TrainStage, keys, prefetch: int) -> List[dict]:
+    """Evaluate checkpoints in order, the next `prefetch` checkpoints are loaded in background meanwhile."""
+    evaluate = trainer.evaluate if stage.is_val() else trainer.test
+    results = []
+    # the trainer keeps its own weights after the sweep
+    snapshot = _clone(select_keys(trainer.state_dict(), keys))
+    try:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            futures = [executor.submit(_load, trainer, fn, keys) for fn in checkpoints[:prefetch + 1]]
+            for i, checkpoint in enumerate(checkpoints):
+                state_dict, info = futures[i].result()
+                futures[i] = None
+                if i + prefetch + 1 < len(checkpoints):
+                    futures.append(executor.submit(_load, trainer, checkpoints[i + prefetch + 1], keys))
+
+                trainer.load_state_dict(state_dict)
+                del state_dict
+                record = evaluate()
+
+                res = {'checkpoint': os.path.basename(checkpoint)}
+                if info is not None:
+                    res.update({k: info[k] for k in ['eidx', 'global_steps'] if k in info})
+                if record is not None:
+                    res.update({k: _scalar(v) for k, v in record.agg().items()})
+                results.append(res)
+    finally:
+        trainer.load_state_dict(snapshot)
+    return results
+
+
+def _init_worker(trainer_fn: Callable[[], 'Trainer'], num_threads: int):
+    global _worker_trainer
+    torch.set_num_threads(num_threads)
+    _worker_trainer = trainer_fn()
+
+
+def _run_worker(checkpoints, stage, keys, prefetch):
+    return _run(_worker_trainer, checkpoints, stage, keys, prefetch)
+
+
+def evaluate_checkpoints(trainer: 'Trainer', checkpoints: Sequence[str] = None,
+                         stage: Union[TrainStage, str] = TrainStage.val, keys: Sequence[str] = ('models',),
+                         prefetch: int = 1, num_processes: int = 1,
+                         trainer_fn: Callable[[], 'Trainer'] = None) -> List[dict]:
+    """
+    Evaluate checkpoints one by one with the models and dataloaders of `trainer`. Only `keys` of each checkpoint
+    are loaded into the trainer, and the next `prefetch` checkpoints are loaded in a background thread while the
+    current one is being evaluated. The state of `trainer` selected by `keys` is restored after the sweep.
+
+    Args:
+        trainer: the trainer whose models and dataloaders are reused.
+        checkpoints: file names or paths of checkpoints, `trainer.saver.list_checkpoints()` by default.
+        stage: `val` to call `trainer.evaluate()`, `test` to call `trainer.test()`.
+        keys: entries loaded from each checkpoint, see `Saver.load_state_dict()`.
+        prefetch: number of checkpoints loaded ahead.
+        num_processes: spread checkpoints across a pool of processes, each process creates its own trainer
+            by `trainer_fn`. Used for CPU evaluation.
+        trainer_fn: a picklable function which returns an initialized trainer, required when `num_processes > 1`.
+
+    Returns:
+        a list of results, one dict for each checkpoint in order, which contains the checkpoint name,
+        `eidx`/`global_steps` of its meta info, and the aggregated metrics.
+    """
+    if checkpoints is None:
+        checkpoints = trainer.saver.list_checkpoints()
+    checkpoints = list(checkpoints)
+    if isinstance(stage, str):
+        stage = TrainStage.create_from_str(stage)
+    keys = list(keys) if keys is not None else None
+
+    if num_processes <= 1 or len(checkpoints) <= 1:
+        return _run(trainer, checkpoints, stage, keys, prefetch)
+
+    assert trainer_fn is not None, '`trainer_fn` should be given when `num_processes > 1`.'
+    # absolute paths, the trainers in subprocesses may have different save dirs.
+    checkpoints = [trainer.saver._guess_abs_path(fn) for fn in checkpoints]
+    num_processes = min(num_processes, len(checkpoints))
+    chunks = [checkpoints[i::num_processes] for i in range(num_processes)]
+    num_threads = max(1, torch.get_num_threads() // num_processes)
+    with ProcessPoolExecutor(num_processes, initializer=_init_worker, initargs=(trainer_fn, num_threads)) as pool:
+        futures = [pool.submit(_run_worker, chunk, stage, keys, prefetch) for chunk in chunks]
+        chunk_results = [future.result() for future in futures]
+
+    # restore the order of checkpoints
+    results = [None] * len(checkpoints)
+    for i, chunk in enumerate(chunk_results):
+        results[i::num_processes] = chunk
+    return results
+
+
+def dump_results(results: List[dict], fn: str) -> str:
+    """Write results of `evaluate_checkpoints()` into a csv table."""
+    fieldnames = []
+    for res in results:
+        fieldnames.extend(k for k in res if k not in fieldnames)
+    with open(fn, 'w', newline='', encoding='utf-8') as w:
+        writer = csv.DictWriter(w, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(results)
+    return fn
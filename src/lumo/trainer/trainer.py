@@ -1,18 +1,21 @@
 import bisect
 import warnings
+from contextlib import ExitStack, contextmanager, nullcontext
 from functools import lru_cache
-from typing import Union, Dict, Any, Optional, Sequence, Mapping
+from typing import Union, Dict, Any, Optional, Sequence, Mapping, List
 
 import numpy as np
 import torch
 from accelerate import DistributedDataParallelKwargs
+from accelerate.data_loader import _PYTORCH_DATALOADER_KWARGS
 from accelerate.utils import send_to_device
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import Optimizer
-from torch.utils.data import DataLoader
-from lumo.data.accelerator import DataLoaderShard, DataLoaderDispatcher
+from torch.utils.data import DataLoader, BatchSampler, IterableDataset
+from lumo.data.accelerator import DataLoaderShard, DataLoaderDispatcher, prepare_data_loader
 from lumo.core import ParamsType, TrainStage, Record, MetricType, Meter, Attr
-from lumo.data import DataModule
+from lumo.data import DataModule, DatasetStream
 from lumo.proc import dist
 
 from lumo.trainer.rnd import RndManager
@@ -22,7 +25,49 @@ from accelerate import Accelerator
 from .base import _BaseTrainer
 from .components import TrainerExperiment
 from .saver import Saver
-from ..data.loader import DataLoaderType, DataLoaderSide
+from ..data.loader import DataLoaderType, DataLoaderSide, DataLoaderPrefetch, LumoDataLoader
+
+
+def _is_resumable(loader) -> bool:
+    """Whether the position of `loader` can be saved by `state_dict()`."""
+    if isinstance(loader, DataLoaderPrefetch):
+        loader = loader.loader
+    return isinstance(loader, LumoDataLoader)
+
+
+def _safe_len(loader) -> Optional[int]:
+    try:
+        return len(loader)
+    except TypeError:
+        return None
+
+
+def _resumed_steps(loader) -> int:
+    """Batches of the current epoch consumed before the restored state of `loader`, which will be skipped."""
+    if isinstance(loader, DataLoaderPrefetch):
+        loader = loader.loader
+    if not isinstance(loader, LumoDataLoader):
+        return 0
+    resume = loader.__dict__.get('_resume', None)
+    return resume['consumed'] if resume is not None else 0
+
+
+def _rebatch(loader: DataLoader, batch_size: int) -> DataLoader:
+    """A copy of `loader` with the same sampler but another batch size, see `params.eval_batch_size`."""
+    if loader.batch_size == batch_size:
+        return loader
+    if loader.batch_size is None or type(loader.batch_sampler) is not BatchSampler:
+        warnings.warn(f'{loader.__class__.__name__} with a custom batch sampler can not be rebatched '
+                      f'by `eval_batch_size`, its batch size is kept.')
+        return loader
+    ignore_kwargs = {'batch_size', 'shuffle', 'sampler', 'batch_sampler'}
+    kwargs = {k: getattr(loader, k, v) for k, v in _PYTORCH_DATALOADER_KWARGS.items() if k not in ignore_kwargs}
+    if not isinstance(loader.dataset, IterableDataset):
+        kwargs['sampler'] = loader.sampler
+    res = loader.__class__(loader.dataset, batch_size=batch_size, **kwargs)
+    if isinstance(loader, LumoDataLoader):
+        res.set_prop({k: v for k, v in loader._prop.items() if k != 'batch_count'})
+    return res
 
 
 class Trainer(_BaseTrainer):
@@ -44,6 +89,7 @@ class Trainer(_BaseTrainer):
         self._logger = None
         self._saver = None
         self.shared_prop = {}
+        self._loader_states = {}
         self.params.iparams()
         self.exp = TrainerExperiment(self._gene_class_exp_name())
         self.rnd = RndManager()
@@ -60,6 +106,14 @@ class Trainer(_BaseTrainer):
         if self.accelerate.state.distributed_type == self.accelerate.state.distributed_type.NO:
             self.accelerate.state.device = torch.device(device)
 
+        # managed optimization step, see `optimize()`
+        self._amp_dtype = self._resolve_amp_dtype()
+        self._scaler = None
+        if self._amp_dtype == torch.float16:
+            self._scaler = torch.amp.GradScaler('cuda')
+        self._accum_count = 0
+        self._epoch_steps = None
+
         if dist.is_main():
             self.params.to_yaml(self.exp.test_file('params.yaml'))
 
@@ -97,28 +151,65 @@ class Trainer(_BaseTrainer):
         else:
             return None
 
+        if stage.value in self._loader_states and _is_resumable(loader):
+            loader.load_state_dict(self._loader_states.pop(stage.value))
         return loader
 
-    def _load_fun_state_dict(self, src: dict, tgt: dict):
-        for k, v in tgt.items():
+    def _load_fun_state_dict(self, src: dict, tgt: set):
+        for k in tgt:
             if k in src:
+                v = self[k]
+                if isinstance(v, nn.Module):
+                    v = self.accelerate.unwrap_model(v)
                 v.load_state_dict(src[k])
 
     def load_state_dict(self, state_dict: dict):
-        _sub = {'models', 'optims', 'other'}
+        _sub = {'models', 'optims', 'others'}
         _missing = []
 
         for k, v in state_dict.items():
             if k in _sub:
-                self._load_fun_state_dict(v, self._state_dicts[k])
+                self._load_fun_state_dict(v, self._state_dicts.get(k, set()))
+            elif k == 'loaders':
+                self.load_loader_state_dict(v)
+            elif k == 'scaler':
+                if self._scaler is not None:
+                    self._scaler.load_state_dict(v)
             else:
                 self._state_dicts[k] = v
         return
 
+    def loader_state_dict(self) -> dict:
+        """Position and sampler RNG state of the train loader, see `LumoDataLoader.state_dict()`."""
+        res = {}
+        loader = self.train_dataloader
+        if loader is not None and _is_resumable(loader):
+            res[TrainStage.train.value] = loader.state_dict()
+        return res
+
+    def load_loader_state_dict(self, state_dict: dict):
+        """
+        Restore loader states. If the loader has not been processed yet, the state will be loaded after it is
+        prepared, and the next epoch will skip the batches consumed before the checkpoint.
+        """
+        for stage, state in state_dict.items():
+            loader = self.datamodule[stage]
+            if loader is not None and _is_resumable(loader):
+                loader.load_state_dict(state)
+            else:
+                self._loader_states[stage] = state
+
     @property
     def saver(self) -> Saver:
         if self._saver is None:
-            self._saver = Saver(self.exp.saver_dir)
+            async_write = self.params.get('async_checkpoint', False)
+            self._saver = Saver(self.exp.saver_dir, async_write=async_write,
+                                sharded=self.params.get('sharded_checkpoint', False),
+                                max_shard_size=self.params.get('max_shard_size', None))
+            if async_write:
+                # make sure checkpoints are completely written before exit.
+                saver = self._saver
+                self.exp.add_exit_hook(lambda exp: saver.flush())
         return self._saver
 
     @property
@@ -157,6 +248,8 @@ class Trainer(_BaseTrainer):
             if self.params.get('debug', False):
                 self._logger.set_verbose(Logger.V_DEBUG)
                 self._logger.debug('Enable debug log.')
+            if self.params.get('async_log', False):
+                self._logger.set_async(True)
             if self.is_main:
                 fn = self._logger.add_log_dir(self.exp.log_dir)
                 self.exp.dump_info('logger_args', {'log_dir': fn})
@@ -210,6 +303,10 @@ class Trainer(_BaseTrainer):
 
         solution is referred by https://github.com/tensorflow/tensorboard/issues/2010
 
+        3. Scalars can be buffered and written in batches in a background thread, see `BatchedSummaryWriter`,
+        by setting `params.board_flush_interval` (seconds), and be downsampled by `params.board_downsample`
+        and `params.board_reduce` (None, 'mean', 'min' or 'max').
+
         Returns:
             A SummaryWriter instance
         """
@@ -220,6 +317,12 @@ class Trainer(_BaseTrainer):
 
         kwargs = self.exp.board_args
         res = SummaryWriter(**kwargs)
+        flush_interval = self.params.get('board_flush_interval', None)
+        if flush_interval:
+            from .board import BatchedSummaryWriter
+            res = BatchedSummaryWriter(res, flush_interval=flush_interval,
+                                       downsample=self.params.get('board_downsample', 1),
+                                       reduce=self.params.get('board_reduce', None))
 
         def close(*args):
             res.flush()
@@ -315,6 +418,129 @@ class Trainer(_BaseTrainer):
             item = send_to_device(item, device)
             return item
 
+    def _resolve_amp_dtype(self) -> Optional[torch.dtype]:
+        mixed_precision = self.params.get('mixed_precision', None)
+        if mixed_precision in {None, False, 'no'}:
+            return None
+        assert mixed_precision in {'fp16', 'bf16'}, \
+            f'params.mixed_precision should be one of no/fp16/bf16, but got {mixed_precision}.'
+        if mixed_precision == 'fp16' and self.device.type != 'cuda':
+            warnings.warn(f'fp16 mixed precision is only supported on cuda, use bf16 on {self.device.type} instead.')
+            return torch.bfloat16
+        return torch.float16 if mixed_precision == 'fp16' else torch.bfloat16
+
+    @property
+    def grad_accum_steps(self) -> int:
+        """Number of micro-batches accumulated before each optimizer step, `params.grad_accum_steps`."""
+        return max(self.params.get('grad_accum_steps', 1), 1)
+
+    @property
+    def effective_batch_size(self) -> Optional[int]:
+        """Number of samples of each optimizer step across all processes."""
+        loader = self.train_dataloader
+        if isinstance(loader, DataLoaderPrefetch):
+            loader = loader.loader
+        batch_size = getattr(loader, 'batch_size', None)
+        if batch_size is None:
+            batch_size = getattr(getattr(loader, 'batch_sampler', None), 'batch_size', None)
+        if batch_size is None:
+            batch_size = self.params.get('batch_size', None)
+        if batch_size is None:
+            return None
+        num_processes = 1 if self.params.get('split_batches', False) else self.accelerate.num_processes
+        return batch_size * self.grad_accum_steps * num_processes
+
+    def _accum_size(self) -> int:
+        """Number of micro-batches of current accumulation cycle."""
+        steps = self.grad_accum_steps
+        if self._epoch_steps is not None:
+            # the last cycle of an epoch may have fewer micro-batches
+            steps = min(steps, self._epoch_steps - (self.idx - self._accum_count))
+        return max(steps, 1)
+
+    @property
+    def sync_gradients(self) -> bool:
+        """Whether current micro-batch is the last one of its accumulation cycle, i.e., optimizers will be stepped."""
+        return self._accum_count + 1 >= self._accum_size()
+
+    def autocast(self):
+        """Autocast context of `params.mixed_precision`, a null context if mixed precision is disabled."""
+        if self._amp_dtype is None:
+            return nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=self._amp_dtype)
+
+    @contextmanager
+    def accumulate(self):
+        """
+        Context of the forward pass of a micro-batch. It enables `autocast()`, and skips the gradient all-reduce of
+        DDP models if the optimizers will not be stepped after this micro-batch. Use it with `optimize()`:
+        ```
+        def train_step(self, batch, params=None):
+            with self.accumulate():
+                loss = F.cross_entropy(self.model(batch['xs']), batch['ys'])
+            self.optimize(loss)
+        ```
+        """
+        with ExitStack() as stack:
+            if not self.sync_gradients:
+                for model in self.model_dict.values():
+                    if isinstance(model, DistributedDataParallel):
+                        stack.enter_context(model.no_sync())
+            stack.enter_context(self.autocast())
+            yield
+
+    def optimize(self, loss: torch.Tensor, optim: Union[Optimizer, Sequence[Optimizer]] = None,
+                 max_grad_norm: float = None) -> bool:
+        """
+        Backward `loss` of a micro-batch, and step optimizers at the end of each gradient accumulation cycle.
+        Gradients are scaled by GradScaler when `params.mixed_precision` is 'fp16'.
+
+        Args:
+            loss: loss of the micro-batch, it will be averaged over micro-batches of the accumulation cycle.
+            optim: optimizer(s) to step, all optimizers of the trainer by default.
+            max_grad_norm: clip gradients by norm before stepping, `params.max_grad_norm` by default.
+
+        Returns:
+            whether the optimizers are stepped.
+        """
+        if optim is None:
+            optims = list(self.optim_dict.values())
+        elif isinstance(optim, Optimizer):
+            optims = [optim]
+        else:
+            optims = list(optim)
+
+        sync = self.sync_gradients
+        loss = loss / self._accum_size()
+        if self._scaler is not None:
+            self._scaler.scale(loss).backward()
+        else:
+            loss.backward()
+        self._accum_count += 1
+        if not sync:
+            return False
+
+        if max_grad_norm is None:
+            max_grad_norm = self.params.get('max_grad_norm', None)
+        if max_grad_norm is not None:
+            if self._scaler is not None:
+                for item in optims:
+                    self._scaler.unscale_(item)
+            parameters = [p for item in optims for group in item.param_groups for p in group['params']]
+            torch.nn.utils.clip_grad_norm_(parameters, max_grad_norm)
+
+        for item in optims:
+            if self._scaler is not None:
+                self._scaler.step(item)
+            else:
+                item.step()
+        if self._scaler is not None:
+            self._scaler.update()
+        for item in optims:
+            item.zero_grad(set_to_none=True)
+        self._accum_count = 0
+        return True
+
     def initialize(self):
         if self._prop.get('initial', False):
             return
@@ -333,21 +559,63 @@ class Trainer(_BaseTrainer):
         self.train_epoch_toggle = True
 
     def prepare_dataloader(self, loader: DataLoaderType, stage: TrainStage = None):
-        if isinstance(loader, (DataLoaderShard, DataLoaderDispatcher)):
+        """
+        Prepare loader by accelerate. If `params.prefetch > 0`, the prepared loader will be wrapped by
+        `DataLoaderPrefetch` to stage the next `params.prefetch` batches on device in background.
+
+        If `params.eval_batch_size` is set, val/test loaders are rebatched with it before preparing, the batches
+        are split across processes. Evaluation runs without gradients, so it can usually afford larger batches.
+        """
+        if isinstance(loader, (DataLoaderShard, DataLoaderDispatcher, DataLoaderPrefetch)):
             warnings.warn('Duplicated prepare a same DataLoader twice, check your code.')
             return loader
 
+        eval_batch_size = self.params.get('eval_batch_size', None)
+        if eval_batch_size is not None and stage is not None and not stage.is_train() \
+                and isinstance(loader, DataLoader):
+            loader = _rebatch(loader, eval_batch_size)
+
+        prefetch = self.params.get('prefetch', 0)
+        if prefetch > 0:
+            loader = self._prepare_dataloader(loader, stage)
+            device = None
+            children = loader._loaders.values() if isinstance(loader, DataLoaderSide) else [loader]
+            for child in children:
+                if getattr(child, 'device', None) is not None:
+                    # let the prefetch thread copy batches to device asynchronously.
+                    device, child.device = child.device, None
+            return DataLoaderPrefetch(loader, depth=prefetch, device=device)
+        return self._prepare_dataloader(loader, stage)
+
+    def _prepare_dataloader(self, loader: DataLoaderType, stage: TrainStage = None):
         split_batches = self.params.get('split_batches', None)
         if stage is not None and not stage.is_train():
             split_batches = True
 
         """do not change original loader stage"""
         if isinstance(loader, DataLoader):
+            num_processes, process_index = self.accelerate.num_processes, self.accelerate.process_index
+            if isinstance(loader.dataset, DatasetStream) and loader.dataset.shard_by_rank:
+                # already sharded across ranks by the dataset itself, only move batches to device.
+                num_processes, process_index = 1, 0
             self.accelerate.split_batches = split_batches
-            loader = self.accelerate.prepare_data_loader(loader)
+            # `Accelerator.prepare_data_loader()` only forwards the attributes of the accelerator to accelerate's
+            # `prepare_data_loader()`, which rebuilds the loader as accelerate's `DataLoaderShard` and loses the prop
+            # and the resumable position of `LumoDataLoader` (see `loader_state_dict()`). The same arguments are
+            # forwarded to lumo's version instead, which keeps the loader a `LumoDataLoader`.
+            loader = prepare_data_loader(loader, self.device,
+                                         num_processes=num_processes,
+                                         process_index=process_index,
+                                         split_batches=self.accelerate.split_batches,
+                                         put_on_device=self.accelerate.device_placement,
+                                         rng_types=self.accelerate.rng_types.copy(),
+                                         dispatch_batches=self.accelerate.dispatch_batches)
+            if isinstance(getattr(self.accelerate, '_dataloaders', None), list):
+                # newer accelerate tracks prepared loaders, e.g., to save their states.
+                self.accelerate._dataloaders.append(loader)
         elif isinstance(loader, DataLoaderSide):
             loader = loader.copy()
-            loader._loaders = {k: self.prepare_dataloader(v, stage) for k, v in loader._loaders.items()}
+            loader._loaders = {k: self._prepare_dataloader(v, stage) for k, v in loader._loaders.items()}
         return loader
 
     def train(self, dm: Union[DataModule, DataLoaderType] = None, params: ParamsType = None, limit_global_steps=None):
@@ -360,6 +628,11 @@ class Trainer(_BaseTrainer):
         if params is None:
             params = self.params
 
+        if self.grad_accum_steps > 1 or self._amp_dtype is not None:
+            self.logger.info(f'Effective batch size: {self.effective_batch_size}, '
+                             f'gradient accumulation steps: {self.grad_accum_steps}, '
+                             f'mixed precision: {self._amp_dtype}.')
+
         for eidx in range(params.epoch):
             self.set_epoch_idx(eidx)
             epoch_record = self.train_epoch(loader, params, limit_global_steps=limit_global_steps)
@@ -384,6 +657,17 @@ class Trainer(_BaseTrainer):
         if params is None:
             params = self.params
 
+        self._epoch_steps = _safe_len(loader)
+        if self._epoch_steps is not None:
+            # a resumed epoch only yields the remaining batches
+            self._epoch_steps = max(self._epoch_steps - _resumed_steps(loader), 0)
+        if limit_step is not None and self._epoch_steps is not None:
+            self._epoch_steps = min(self._epoch_steps, limit_step + 1)
+        if self._accum_count > 0:
+            # the last epoch stopped in the middle of an accumulation cycle, drop its gradients
+            for optim in self.optim_dict.values():
+                optim.zero_grad(set_to_none=True)
+        self._accum_count = 0
         self.wait_for_everyone()
         for idx, batch in enumerate(loader):
             if self.train_epoch_toggle:
@@ -452,6 +736,7 @@ class Trainer(_BaseTrainer):
         if msg is not None:
             return False
         bisect.insort(self.callbacks, callback)
+        self._build_dispatch()
 
         callback._hooked = self
         callback.on_hooked(self, self.params)
@@ -460,7 +745,9 @@ class Trainer(_BaseTrainer):
 
     def remove_callback(self, cur):
         self.callbacks.remove(cur)
-        pass
+        self._build_dispatch()
+        if self._profiler is cur:
+            self._profiler = None
 
     def change_stage(self, stage: TrainStage):
         if self.trainstage == stage:
@@ -487,14 +774,17 @@ class Trainer(_BaseTrainer):
         if params is None:
             params = self.params
 
-        record = self.create_record(stage=stage)
-        self.wait_for_everyone()
-        for idx, batch in enumerate(loader):
-            if limit_step is not None and idx >= limit_step:
-                break
-            self.set_idx(idx)
-            metric = self.test_step(batch, params)
-            record.record(metric)
+        if params.get('bulk_eval', False):
+            record = self.bulk_eval(loader, params, limit_step=limit_step, stage=stage)
+        else:
+            record = self.create_record(stage=stage)
+            self.wait_for_everyone()
+            for idx, batch in enumerate(loader):
+                if limit_step is not None and idx >= limit_step:
+                    break
+                self.set_idx(idx)
+                metric = self.test_step(batch, params)
+                record.record(metric)
         for k, v in record.agg().items():
             self.share(f'test.{k}', v)
         record.flush()
@@ -510,18 +800,93 @@ class Trainer(_BaseTrainer):
         if params is None:
             params = self.params
 
-        record = self.create_record(stage=stage)
-        for idx, batch in enumerate(loader):
-            if limit_step is not None and idx >= limit_step:
-                break
-            self.set_idx(idx)
-            metric = self.evaluate_step(batch, params)
-            record.record(metric)
+        if params.get('bulk_eval', False):
+            record = self.bulk_eval(loader, params, limit_step=limit_step, stage=stage)
+        else:
+            record = self.create_record(stage=stage)
+            for idx, batch in enumerate(loader):
+                if limit_step is not None and idx >= limit_step:
+                    break
+                self.set_idx(idx)
+                metric = self.evaluate_step(batch, params)
+                record.record(metric)
         for k, v in record.agg().items():
             self.share(f'test.{k}', v)
         record.flush()
         return record
 
+    def evaluate_checkpoints(self, checkpoints: Sequence[str] = None, stage: Union[TrainStage, str] = TrainStage.val,
+                             prefetch: int = 1, num_processes: int = 1, trainer_fn=None,
+                             dump: bool = True) -> List[dict]:
+        """
+        Evaluate saved checkpoints with the models and dataloaders of this trainer, and write the results
+        into `<test dir>/checkpoints.<stage>.csv`. See `lumo.trainer.sweep.evaluate_checkpoints()` for details.
+        """
+        from .sweep import evaluate_checkpoints, dump_results
+        results = evaluate_checkpoints(self, checkpoints, stage=stage, prefetch=prefetch,
+                                       num_processes=num_processes, trainer_fn=trainer_fn)
+        if dump and self.is_main:
+            stage = TrainStage.create_from_str(stage) if isinstance(stage, str) else stage
+            fn = dump_results(results, self.exp.test_file(f'checkpoints.{stage.value}.csv'))
+            self.logger.info(f'Results of {len(results)} checkpoints are saved in {fn}')
+        return results
+
+    def bulk_eval(self, loader: DataLoaderType, params: ParamsType = None, limit_step: int = None,
+                  stage: TrainStage = None) -> Record:
+        """
+        Evaluate in bulk, used by `test()` and `evaluate()` when `params.bulk_eval` is True.
+
+        Per-sample outputs of `collect_step()` are collected under `torch.inference_mode()` into buffers
+        preallocated on device (see `OutputBuffer`), gathered across processes once in the order of the dataset,
+        without the samples padded by the distributed sampler, and passed to `compute_metrics()`. So metrics are
+        computed on the whole dataset in one pass, instead of averaging the metrics of each batch, and there is no
+        host sync between batches. Set `params.eval_batch_size` to evaluate with larger batches than the ones of
+        the DataModule.
+        """
+        from .outputs import OutputBuffer
+        if params is None:
+            params = self.params
+        record = self.create_record(stage=stage)
+
+        capacity = num_samples = None
+        dataset = getattr(loader, 'dataset', None)
+        if dataset is not None and _safe_len(dataset) is not None:
+            capacity = -(-len(dataset) // self.accelerate.num_processes)
+            if not isinstance(dataset, IterableDataset):
+                # to drop the samples padded by the distributed batch sampler
+                num_samples = len(dataset)
+            elif isinstance(dataset, DatasetStream) and dataset.shard_by_rank and self.accelerate.num_processes > 1:
+                capacity = len(dataset)
+                if len(dataset) * self.accelerate.num_processes != len(dataset.builder):
+                    warnings.warn('Ranks of the stream are padded by samples from the beginning, which are kept '
+                                  'in the outputs of `bulk_eval()`.')
+        buffer = OutputBuffer(capacity)
+
+        self.wait_for_everyone()
+        with torch.inference_mode():
+            for idx, batch in enumerate(loader):
+                if limit_step is not None and idx >= limit_step:
+                    break
+                self.set_idx(idx)
+                buffer.append(self.collect_step(batch, params))
+            outputs = buffer.gather(self.accelerate, num_samples=num_samples)
+            record.record(self.compute_metrics(outputs, params))
+        return record
+
+    def collect_step(self, batch, params: ParamsType = None) -> Dict[str, torch.Tensor]:
+        """
+        Per-sample outputs of a batch used by `bulk_eval()`, e.g., `{'logits': logits, 'labels': ys}`,
+        the first dimension of each tensor is the batch dimension.
+        """
+        raise NotImplementedError()
+
+    def compute_metrics(self, outputs: Dict[str, torch.Tensor], params: ParamsType = None) -> MetricType:
+        """
+        Metrics of the outputs of the whole dataset in `bulk_eval()`. `lumo.contrib.torch.accuracy.topk_accuracy()`
+        computes top-k accuracies in one pass.
+        """
+        raise NotImplementedError()
+
     def train_step(self, batch, params: ParamsType = None) -> MetricType:
         pass
 
@@ -566,19 +931,25 @@ class Trainer(_BaseTrainer):
             'optims': self.optim_state_dict(wrap=False),
             'models': self.model_state_dict(wrap=False),
             'others': self.other_state_dict(wrap=False),
+            'loaders': self.loader_state_dict(),
             'thtensor': self.torch_tensor,
             'nptensor': self.numpy_tensor,
         }
+        if self._scaler is not None:
+            res['scaler'] = self._scaler.state_dict()
 
         return res
 
     def Meter(self):
-        return Meter()
+        """Create a Meter, which is lazy if `params.lazy_metric` is True, see `Record` for details."""
+        return Meter(lazy=self.params.get('lazy_metric', False))
 
     def create_record(self, stage: TrainStage = None):
         if stage is None:
             stage = self.trainstage
-        record = Record(stage=stage)
+        record = Record(stage=stage,
+                        lazy=self.params.get('lazy_metric', False),
+                        sync_interval=self.params.get('metric_sync_interval', None))
         return record
 
     def wait_for_everyone(self):
@@ -598,6 +969,7 @@ class Trainer(_BaseTrainer):
     def _build_trainer_meta_info(self, meta_info: Union[str, dict, Attr] = None):
         info = dict()
         info['eidx'] = self.eidx
+        info['global_steps'] = self.global_steps
         if meta_info is not None:
             if isinstance(meta_info, str):
                 info['msg'] = meta_info
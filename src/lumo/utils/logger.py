@@ -2,9 +2,14 @@
 used for logging
 """
 
+import atexit
 import logging
 import os
+import queue
 import sys
+import threading
+import time
+import warnings
 from collections import namedtuple
 from datetime import datetime
 from typing import Any, Callable
@@ -55,6 +60,143 @@ def process_str():
     return ''
 
 
+class AsyncFileWriter:
+    """
+    Append strings to files in a background thread. Strings are put into a bounded queue, and the thread
+    keeps files open, writes all queued strings at once, and flushes files every `flush_interval` seconds.
+
+    A string that fails to be written (e.g., the directory does not exist) is dropped with a warning, and the
+    thread keeps draining the queue. If the thread is dead anyway, strings are written synchronously.
+
+    Args:
+        maxsize: max number of queued strings, `write()` blocks when the queue is full.
+        flush_interval: seconds between two flushes of files.
+    """
+
+    def __init__(self, maxsize=10000, flush_interval=1.):
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._files = {}
+        self._failed = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='lumo-logger', daemon=True)
+        self._thread.start()
+
+    def _file(self, fn):
+        file = self._files.get(fn, None)
+        if file is None:
+            file = self._files[fn] = open(fn, 'a', encoding='utf-8')
+        return file
+
+    def _report(self, fn, e: Exception):
+        if fn not in self._failed:
+            self._failed.add(fn)
+            warnings.warn(f'Failed to write log file {fn}: {e!r}, lines of it are dropped.')
+
+    def _write_item(self, fn, string):
+        try:
+            self._file(fn).write(string)
+        except Exception as e:
+            self._report(fn, e)
+
+    def _flush_files(self):
+        for fn, file in self._files.items():
+            try:
+                file.flush()
+            except Exception as e:
+                self._report(fn, e)
+
+    def _close_files(self):
+        for fn, file in self._files.items():
+            try:
+                file.close()
+            except Exception as e:
+                self._report(fn, e)
+        self._files.clear()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                items = [self._queue.get(timeout=max(last_flush + self.flush_interval - time.monotonic(), 0))]
+            except queue.Empty:
+                self._flush_files()
+                last_flush = time.monotonic()
+                continue
+            # drain all queued items, and write them in one batch
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = False
+            for item in items:
+                if isinstance(item, threading.Event):
+                    # flush request
+                    self._flush_files()
+                    item.set()
+                elif item is None:
+                    stop = True
+                else:
+                    self._write_item(*item)
+                self._queue.task_done()
+            if stop:
+                self._close_files()
+                return
+            if time.monotonic() - last_flush >= self.flush_interval:
+                # lines keep coming, flush them on time anyway
+                self._flush_files()
+                last_flush = time.monotonic()
+
+    def _write_sync(self, *items):
+        """Write the queued strings and `items` in the calling thread, used when the background thread is dead."""
+        with self._lock:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, threading.Event):
+                    item.set()
+                elif item is not None:
+                    self._write_item(*item)
+            for item in items:
+                self._write_item(*item)
+            self._close_files()
+
+    def _put(self, item) -> bool:
+        """Queue `item` for the background thread, returns False if the thread is dead."""
+        while self._thread.is_alive():
+            try:
+                self._queue.put(item, timeout=self.flush_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def write(self, fn, string):
+        if not self._put((fn, string)):
+            self._write_sync((fn, string))
+
+    def flush(self, timeout=None):
+        """Block until all queued strings are written and flushed."""
+        event = threading.Event()
+        if self._put(event):
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while self._thread.is_alive():
+                if event.wait(self.flush_interval):
+                    return
+                if deadline is not None and time.monotonic() >= deadline:
+                    return
+        self._write_sync()
+
+    def close(self):
+        if self._put(None):
+            self._thread.join()
+        self._write_sync()
+
+
 class Logger:
     VERBOSE = 20
     VVV_DEBUG = VVV_DEBUG
@@ -87,6 +229,7 @@ class Logger:
         self.use_stdout = use_stdout
         self._print_func = print
         self._try_rich = try_rich
+        self._writer = None
         Logger._instance = self
 
     def _format(self, *values, inline=False, fix=0, raw=False, append=False, level=V_INFO):
@@ -149,14 +292,40 @@ class Logger:
                 self.print_rich(self.return_str, end="\n", file=file)
             self.print_rich(logstr, end="", file=file)
 
-            for i in self.out_channel:
-                with open(i, "a", encoding="utf-8") as w:
-                    if len(self.return_str) != 0:
-                        w.write("{}\n".format(self.return_str.strip()))
-                    w.write(logstr)
+            if len(self.out_channel) > 0:
+                if len(self.return_str) != 0:
+                    logstr = "{}\n{}".format(self.return_str.strip(), logstr)
+                for i in self.out_channel:
+                    self._write(i, logstr)
 
             self.return_str = ""
 
+    def _write(self, fn, logstr):
+        if self._writer is not None:
+            self._writer.write(fn, logstr)
+        else:
+            with open(fn, "a", encoding="utf-8") as w:
+                w.write(logstr)
+
+    def set_async(self, val: bool = True, maxsize=10000, flush_interval=1.):
+        """
+        Write log files in a background thread instead of opening files for every log line,
+        see `AsyncFileWriter`. Queued lines will be written at exit, or by calling `flush()`.
+        """
+        if val and self._writer is None:
+            self._writer = AsyncFileWriter(maxsize=maxsize, flush_interval=flush_interval)
+            atexit.register(self._writer.close)
+        elif not val and self._writer is not None:
+            self._writer.close()
+            atexit.unregister(self._writer.close)
+            self._writer = None
+        return self
+
+    def flush(self):
+        """Wait for the queued lines to be written to log files, only takes effect in async mode."""
+        if self._writer is not None:
+            self._writer.flush()
+
     def inline(self, *values, fix=0, append=False):
         """Log a message with severity 'INFO' inline"""
         logstr, fix = self._format(*values, inline=True, fix=fix, append=append)
@@ -44,7 +44,20 @@ def load_yaml(fn):
         return yaml.safe_load(r)
 
 
-def load_state_dict(fn: str, map_location='cpu'):
+def load_state_dict(fn: str, map_location='cpu', mmap=False):
+    """
+    Args:
+        fn: file saved by `torch.save()`.
+        map_location: see `torch.load()`.
+        mmap: memory-map the file instead of reading it into memory, tensors are on cpu and their data will be
+            read on access. `map_location` is ignored in this case. Files of the legacy format are loaded normally.
+    """
+    if mmap:
+        try:
+            return torch.load(fn, map_location='cpu', mmap=True)
+        except RuntimeError:
+            # the legacy (non-zip) format can not be memory-mapped
+            pass
     ckpt = torch.load(fn, map_location=map_location)
     return ckpt
 
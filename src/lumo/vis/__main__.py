@@ -33,25 +33,19 @@ class Main():
         with st.expander("Experiment Info"):
             st.write(finder.format_experiment(exp))
         # with st.expander("Visualize Metrics"):
-        if exp.has_prop('tensorboard_args'):
-            tb = exp.get_prop('tensorboard_args')
-            metrics = parser.parse_fron_tensorboard(tb['log_dir'])
-        elif exp.has_prop('logger_args'):
-            tb = exp.get_prop('logger_args')
-            metrics = parser.parse_from_log(tb['log_dir'])
-        else:
-            metrics = {}
+        metric_parser = parser.IncrementalParser.from_test_root(test_root)
+        metrics = metric_parser.refresh() if metric_parser is not None else {}
         metrics = list(metrics.items())
         for i in range(0, len(metrics), 2):
             l, m = st.columns(2)
-            k, v = metrics[i]
+            k, (_, v) = metrics[i]
             l.write(k)
-            l.line_chart(np.array([vv.value for vv in v]))
+            l.line_chart(v)
             if i + 1 >= len(metrics):
                 break
-            k, v = metrics[i + 1]
+            k, (_, v) = metrics[i + 1]
             m.write(k)
-            m.line_chart(np.array([vv.value for vv in v]))
+            m.line_chart(v)
                 # if i + 2 >= len(metrics):
                 #     break
                 # k, v = metrics[i + 2]
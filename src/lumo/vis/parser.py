@@ -1,6 +1,12 @@
+import hashlib
+import json
 import os
+import struct
+import tempfile
 from itertools import chain
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 
 try:
     import regex as re
@@ -14,7 +20,9 @@ from numbers import Number
 from lumo.exp import Experiment, finder
 
 match_metric_v0 = re.compile(' ([a-z0-9A-Z_]+): ([0-9.]+)')
-match_metric_v1 = re.compile(' ([a-z0-9A-Z_])=([0-9.]+)')
+match_metric_v1 = re.compile(' ([a-z0-9A-Z_]+)=([0-9.]+)')
+
+CACHE_FN = 'metrics.cache'
 
 
 @dataclass()
@@ -23,38 +31,49 @@ class Step:
     step: int
 
 
+def metric_source(exp: Experiment) -> Optional[str]:
+    """The tensorboard directory or the log file which metrics of `exp` are parsed from."""
+    if exp.has_prop('tensorboard_args'):
+        return exp.get_prop('tensorboard_args')['log_dir']
+    elif exp.has_prop('logger_args'):
+        return exp.get_prop('logger_args')['log_dir']
+    logs = [f for f in os.listdir(exp.test_root) if f.endswith('.log')]
+    if len(logs) > 0:
+        return os.path.join(exp.test_root, logs[0])
+    return None
+
+
 def find_metric_fron_test_root(test_root):
     test_root = finder.ensure_test_root(test_root)
     if test_root is None:
         return False, {}
 
-    exp = Experiment.from_disk(test_root)
-    if exp.has_prop('tensorboard_args'):
-        tb = exp.get_prop('tensorboard_args')
-        metrics = parse_fron_tensorboard(tb['log_dir'])
-    elif exp.has_prop('logger_args'):
-        tb = exp.get_prop('logger_args')
-        metrics = parse_from_log(tb['log_dir'])
+    source = metric_source(Experiment.from_disk(test_root))
+    if source is None:
+        metrics = {}
+    elif os.path.isdir(source):
+        metrics = parse_fron_tensorboard(source)
     else:
-        fs = [i for i in os.listdir(exp.test_root)]
-        if len([f for f in fs if f.endswith('.log')]) > 0:
-            metrics = parse_from_log(os.path.join(exp.test_root, fs[0]))
-        else:
-            metrics = {}
+        metrics = parse_from_log(source)
     return True, metrics
 
 
+def metrics_of_line(line: str) -> List[Tuple[str, float]]:
+    res = []
+    for k, v in chain(match_metric_v0.findall(line), match_metric_v1.findall(line)):
+        try:
+            res.append((k, float(v)))
+        except ValueError:
+            pass
+    return res
+
+
 def parse_from_log(log) -> Dict[str, List[Step]]:
     metrics = defaultdict(list)
     with open(log) as r:
         for line in r:
-            temp1 = match_metric_v0.findall(line.strip())
-            temp2 = match_metric_v0.findall(line.strip())
-            for k, v in chain(temp1, temp2):
-                try:
-                    metrics[k].append(Step(value=float(v), step=len(metrics[k])))
-                except ValueError:
-                    pass
+            for k, v in metrics_of_line(line.strip()):
+                metrics[k].append(Step(value=v, step=len(metrics[k])))
     return metrics
 
 
@@ -65,3 +84,233 @@ def parse_fron_tensorboard(root) -> Dict[str, List[Step]]:
     for k in reader.scalar_names:
         metrics[k] = [Step(i.value, i.step) for i in reader.Scalars(k)]
     return metrics
+
+
+def _event_class():
+    try:
+        from tensorboard.compat.proto.event_pb2 import Event
+    except ImportError:
+        from tensorboardX.proto.event_pb2 import Event
+    return Event
+
+
+def _scalar_of(value) -> Optional[float]:
+    kind = value.WhichOneof('value')
+    if kind == 'simple_value':
+        return value.simple_value
+    if kind == 'tensor':
+        tensor = value.tensor
+        for values in (tensor.float_val, tensor.double_val, tensor.int_val, tensor.int64_val):
+            if len(values) == 1:
+                return float(values[0])
+    return None
+
+
+class IncrementalParser:
+    """
+    Parse metrics from a log file or a tensorboard directory incrementally. Byte offsets of the parsed
+    files are remembered, so each `refresh()` only parses the newly appended part. Parsed series and offsets
+    are cached in a directory, and are reused by later parsers of the same source, e.g., in the next
+    refresh of the visualizer.
+
+    In the cache directory, each series is a binary file of fixed-size (step, value) records, and new records
+    are written at their positions, so a refresh only writes the newly parsed points. `state.json` holds the
+    offsets and the lengths of series, and is replaced atomically after the series are written. Records are
+    determined by the source, so parsers of the same source, e.g., two visualizers, write the same bytes.
+
+    ```
+    parser = IncrementalParser.from_test_root(test_root)
+    metrics = parser.refresh()  # {key: (steps, values)}
+    ```
+
+    Args:
+        source: a log file or a tensorboard directory.
+        cache_fn: path of the cache directory, no cache by default.
+    """
+    record = np.dtype([('step', '<i8'), ('value', '<f8')])
+
+    def __init__(self, source: str, cache_fn: Optional[str] = None):
+        self.source = source
+        self.cache_fn = cache_fn
+        self.offsets = {}  # type: Dict[str, int]
+        self.signatures = {}  # type: Dict[str, str]
+        self.metrics = {}  # type: Dict[str, Tuple[np.ndarray, np.ndarray]]
+        # series files of different generations never mix, a new one starts when the source is rewritten.
+        self.generation = None  # type: Optional[str]
+        self._load()
+
+    @classmethod
+    def from_test_root(cls, test_root) -> Optional['IncrementalParser']:
+        """Parser of the metrics of a test, see `metric_source()`, cached in `<test_root>/metrics.cache`."""
+        test_root = finder.ensure_test_root(test_root)
+        if test_root is None:
+            return None
+        exp = Experiment.from_disk(test_root)
+        source = metric_source(exp)
+        if source is None:
+            return None
+        return cls(source, exp.test_file(CACHE_FN))
+
+    def _reset(self):
+        self.metrics, self.offsets, self.signatures = {}, {}, {}
+        self.generation = None
+
+    def _series_fn(self, i):
+        return os.path.join(self.cache_fn, f'{self.generation}.{i}.bin')
+
+    def _load(self):
+        if self.cache_fn is None or not os.path.exists(os.path.join(self.cache_fn, 'state.json')):
+            return
+        try:
+            with open(os.path.join(self.cache_fn, 'state.json'), encoding='utf-8') as r:
+                state = json.load(r)
+            if state['source'] != self.source:
+                return
+            self.generation = state['generation']
+            for i, (k, length) in enumerate(zip(state['keys'], state['lengths'])):
+                series = np.fromfile(self._series_fn(i), dtype=self.record, count=length)
+                if len(series) < length:
+                    raise ValueError(f'series {k} is broken.')
+                self.metrics[k] = (series['step'].copy(), series['value'].copy())
+            self.offsets = state['offsets']
+            self.signatures = state['signatures']
+        except (OSError, ValueError, KeyError):
+            # broken cache, parse from the beginning.
+            self._reset()
+
+    def _dump(self, new: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        if self.cache_fn is None:
+            return
+        os.makedirs(self.cache_fn, exist_ok=True)
+        keys = list(self.metrics)
+        for i, k in enumerate(keys):
+            if k not in new:
+                continue
+            steps, values = new[k]
+            records = np.empty(len(steps), dtype=self.record)
+            records['step'], records['value'] = steps, values
+            # never truncate, another parser may be writing the same records
+            fd = os.open(self._series_fn(i), os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+            with os.fdopen(fd, 'r+b') as w:
+                w.seek((len(self.metrics[k][0]) - len(steps)) * self.record.itemsize)
+                w.write(records.tobytes())
+
+        state = {'source': self.source, 'generation': self.generation, 'keys': keys,
+                 'lengths': [len(self.metrics[k][0]) for k in keys],
+                 'offsets': self.offsets, 'signatures': self.signatures}
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.cache_fn)
+        with os.fdopen(fd, 'w', encoding='utf-8') as w:
+            json.dump(state, w)
+        os.replace(tmp, os.path.join(self.cache_fn, 'state.json'))
+
+        for f in os.listdir(self.cache_fn):
+            if f.endswith('.bin') and not f.startswith(f'{self.generation}.'):
+                # series of a rewritten source
+                try:
+                    os.remove(os.path.join(self.cache_fn, f))
+                except OSError:
+                    pass
+
+    def _files(self) -> List[str]:
+        if not os.path.isdir(self.source):
+            return [self.source] if os.path.exists(self.source) else []
+        return [os.path.join(self.source, f) for f in sorted(os.listdir(self.source)) if 'tfevents' in f]
+
+    @staticmethod
+    def _signature(fn, offset) -> str:
+        """Inode and the digest of the head and the last parsed bytes of `fn`, to detect rewritten files."""
+        md5 = hashlib.md5()
+        with open(fn, 'rb') as r:
+            md5.update(r.read(min(offset, 1024)))
+            r.seek(max(offset - 1024, 0))
+            md5.update(r.read(offset - r.tell()))
+        return f'{os.stat(fn).st_ino}:{md5.hexdigest()}'
+
+    @staticmethod
+    def _generation(files: List[str]) -> str:
+        """Derived from the head of the first file, so parsers of the same source share the same series files."""
+        with open(files[0], 'rb') as r:
+            head = r.readline(64)
+        return hashlib.md5(f'{os.stat(files[0]).st_ino}:'.encode() + head).hexdigest()[:16]
+
+    def _rewritten(self, fn) -> bool:
+        offset = self.offsets.get(fn, 0)
+        if offset == 0:
+            return False
+        return os.path.getsize(fn) < offset or self._signature(fn, offset) != self.signatures.get(fn, None)
+
+    def _parse_log(self, fn, offset, new):
+        counts = {}
+        with open(fn, 'rb') as r:
+            r.seek(offset)
+            for line in r:
+                if not line.endswith(b'\n'):
+                    # the line is being written, parse it in the next refresh
+                    break
+                offset += len(line)
+                for k, v in metrics_of_line(line.decode('utf-8', errors='replace').strip()):
+                    if k not in counts:
+                        counts[k] = len(self.metrics[k][0]) if k in self.metrics else 0
+                    steps, values = new.setdefault(k, ([], []))
+                    steps.append(counts[k] + len(steps))
+                    values.append(v)
+        return offset
+
+    def _parse_events(self, fn, offset, new):
+        Event = _event_class()
+        with open(fn, 'rb') as r:
+            r.seek(offset)
+            while True:
+                # record: uint64 length, uint32 length crc, data, uint32 data crc
+                header = r.read(12)
+                if len(header) < 12:
+                    break
+                length, = struct.unpack('<Q', header[:8])
+                data = r.read(length + 4)
+                if len(data) < length + 4:
+                    break
+                offset += 12 + length + 4
+                event = Event.FromString(data[:length])
+                if not event.HasField('summary'):
+                    continue
+                for value in event.summary.value:
+                    scalar = _scalar_of(value)
+                    if scalar is not None:
+                        steps, values = new.setdefault(value.tag, ([], []))
+                        steps.append(event.step)
+                        values.append(scalar)
+        return offset
+
+    def refresh(self) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Parse the newly appended part of the source, and return (steps, values) of all metrics."""
+        files = self._files()
+        if any(self._rewritten(fn) for fn in files):
+            # truncated or rewritten, parse from the beginning.
+            self._reset()
+        if self.generation is None and len(files) > 0:
+            self.generation = self._generation(files)
+
+        new = {}
+        changed = False
+        for fn in files:
+            offset = self.offsets.get(fn, 0)
+            if os.path.getsize(fn) == offset:
+                continue
+            if os.path.isdir(self.source):
+                end = self._parse_events(fn, offset, new)
+            else:
+                end = self._parse_log(fn, offset, new)
+            if end != offset:
+                changed = True
+                self.offsets[fn] = end
+                self.signatures[fn] = self._signature(fn, end)
+
+        for k, (steps, values) in new.items():
+            new[k] = steps, values = np.array(steps, dtype=np.int64), np.array(values, dtype=np.float64)
+            if k in self.metrics:
+                steps = np.concatenate([self.metrics[k][0], steps])
+                values = np.concatenate([self.metrics[k][1], values])
+            self.metrics[k] = (steps, values)
+        if changed:
+            self._dump(new)
+        return self.metrics
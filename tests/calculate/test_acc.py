@@ -13,3 +13,11 @@ def test_classify():
     total, res = acc.classify(preds, labels, topk=(1, 2, 3, 4))
     assert total == 4
     assert res[0] == 1 and res[1] == 2 and res[2] == 3 and res[3] == 4,str(res)
+
+
+def test_topk_accuracy():
+    labels = torch.tensor([0, 1, 2, 3])
+    preds = torch.tensor([[5, 4, 3, 2], [5, 4, 3, 2], [5, 4, 3, 2], [5, 4, 3, 2]], dtype=torch.float)
+    assert acc.topk_correct(preds, labels, topk=(1, 3)).tolist() == [1, 3]
+    assert torch.allclose(acc.topk_accuracy(preds, labels, topk=(4, 2)), torch.tensor([1., 0.5]))
+    assert acc.classify(preds, labels, cacu_rate=True, topk=[2]) == [0.5]
@@ -0,0 +1,52 @@
+from lumo.trainer.board import BatchedSummaryWriter
+
+
+class ScalarWriter:
+    def __init__(self):
+        self.scalars = []
+        self.closed = False
+
+    def add_scalar(self, tag, scalar_value, global_step=None, walltime=None):
+        self.scalars.append((tag, scalar_value, global_step))
+
+    def add_text(self, tag, text, global_step=None):
+        self.scalars.append((tag, text, global_step))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_batched_writer():
+    writer = BatchedSummaryWriter(ScalarWriter(), flush_interval=100)
+    for i in range(10):
+        writer.add_scalar('loss', i, global_step=i)
+        writer.add_scalar('loss', i + 1, global_step=i)
+    assert writer.scalars == []
+    writer.flush()
+    assert writer.scalars == [('loss', i + 1, i) for i in range(10)]
+
+    writer.add_text('note', 'text', global_step=0)
+    assert writer.scalars[-1] == ('note', 'text', 0)
+    writer.close()
+    assert writer.closed
+
+
+def test_downsample():
+    writer = BatchedSummaryWriter(ScalarWriter(), flush_interval=100, downsample=4)
+    for i in range(10):
+        writer.add_scalar('loss', i, global_step=i)
+    writer.close()
+    assert writer.scalars == [('loss', 0, 0), ('loss', 4, 4), ('loss', 8, 8)]
+
+    for reduce, values in [('mean', [1.5, 5.5, 8.5]), ('min', [0, 4, 8]), ('max', [3, 7, 9])]:
+        writer = BatchedSummaryWriter(ScalarWriter(), flush_interval=100, downsample=4, reduce=reduce)
+        for i in range(10):
+            writer.add_scalar('loss', i, global_step=i)
+        writer.flush()
+        assert writer.scalars == [('loss', values[0], 3), ('loss', values[1], 7)]
+        # incomplete windows are written at close
+        writer.close()
+        assert writer.scalars[-1] == ('loss', values[2], 9)
@@ -1,4 +1,7 @@
+import pytest
+
 from lumo import DatasetBuilder
+from lumo.data import ShardedSource
 
 
 def global_check(dic):
@@ -57,3 +60,196 @@ def test_builder_base():
     # source from memory bank will be removed after global transform
     assert 'memory' not in sub_builder[499]
     assert sub_builder[499]['test'] == 1
+
+
+def test_builder_getitems():
+    import numpy as np
+    import torch
+    from torch.utils.data import DataLoader
+
+    xs = np.arange(100, dtype=np.float32).reshape(50, 2)
+    ys = torch.arange(50)
+    builder = (
+        DatasetBuilder()
+            .add_idx('idx')
+            .add_input('xs', xs, transform=lambda x: x * 2, batched=True)
+            .add_input('ys', ys)
+            .add_input('names', [f'n{i}' for i in range(50)])
+            .add_output('xs', 'xs')
+            .add_output('ys', 'ys', transform=lambda y: y + 1)
+            .add_output('names', 'names')
+            .subset(range(10, 40))
+    )
+
+    indices = [0, 5, 29]
+    batch = builder.__getitems__(indices)
+    for i, sample in zip(indices, batch):
+        single = builder[i]
+        assert single.keys() == sample.keys()
+        assert (single['xs'] == sample['xs']).all()
+        assert single['ys'] == sample['ys'] and single['idx'] == sample['idx']
+        assert single['names'] == sample['names']
+
+    columns = builder.get_batch(indices)
+    assert isinstance(columns['xs'], np.ndarray) and columns['xs'].shape == (3, 2)
+    assert (columns['xs'] == xs[[10, 15, 39]] * 2).all()
+    assert columns['names'] == ['n10', 'n15', 'n39']
+
+    loader = DataLoader(builder.chain(), batch_size=8)
+    idx, xs_batch, ys_batch, names = next(iter(loader))
+    assert (idx == torch.arange(10, 18)).all()
+    assert (ys_batch == torch.arange(11, 19)).all()
+
+
+def test_builder_memmap(tmp_path):
+    import pickle
+    import numpy as np
+    from lumo.data import MemmapSource
+
+    xs = np.arange(60, dtype=np.float32).reshape(20, 3)
+    np.save(tmp_path / 'xs.npy', xs)
+    xs.tofile(tmp_path / 'xs.bin')
+
+    builder = (
+        DatasetBuilder()
+            .add_input('npy', str(tmp_path / 'xs.npy'))
+            .add_input('mmap', np.load(tmp_path / 'xs.npy', mmap_mode='r'))
+            .add_input_memmap('raw', str(tmp_path / 'xs.bin'), dtype=np.float32, shape=(20, 3))
+            .add_input('ram', xs.copy())
+            .materialize_memmap('ram', fn=str(tmp_path / 'ram.npy'))
+            .add_output('npy', 'npy')
+            .add_output('mmap', 'mmap')
+            .add_output('raw', 'raw')
+            .add_output('ram', 'ram')
+    )
+    for name in ['npy', 'mmap', 'raw', 'ram']:
+        assert isinstance(builder.get_source(name), MemmapSource)
+
+    builder = pickle.loads(pickle.dumps(builder))
+    assert len(builder) == 20
+    sample = builder[7]
+    for name in ['npy', 'mmap', 'raw', 'ram']:
+        assert type(sample[name]) is np.ndarray and (sample[name] == xs[7]).all()
+    assert (builder.get_batch([1, 2])['raw'] == xs[[1, 2]]).all()
+
+
+def test_builder_cache(tmp_path):
+    import numpy as np
+    from lumo.data import TransformCache
+
+    calls = []
+
+    def decode(x):
+        calls.append(x)
+        return x * 10
+
+    cache = TransformCache(maxsize=4, disk=str(tmp_path / 'decode'))
+    builder = (
+        DatasetBuilder()
+            .add_input('xs', np.arange(10), transform=decode, cache=cache)
+            .add_output('xs', 'xs')
+            .add_output('xs', 'noise', transform=lambda x: x + np.random.rand())
+    )
+    for i in range(10):
+        assert builder[i]['xs'] == i * 10
+    assert len(calls) == 10 and len(cache) == 4
+
+    for i in range(10):
+        assert builder[i]['xs'] == i * 10
+    assert builder[9]['xs'] == 90
+    assert len(calls) == 10
+    # sequential access evicts every item before it is visited again
+    assert builder.cache_info()['xs'] == {'hits': 1, 'disk_hits': 10, 'misses': 10, 'size': 4}
+    assert builder[1]['noise'] != builder[1]['noise']
+
+    batch = builder.get_batch([2, 3, 4])
+    assert batch['xs'] == [20, 30, 40] and len(calls) == 10
+
+    builder.set_input_transform('xs', lambda x: x)
+    assert len(cache) == 0 and builder[2]['xs'] == 2
+
+
+def test_builder_compile():
+    class CountSource:
+        def __init__(self):
+            self.c = 0
+
+        def __len__(self):
+            return 10
+
+        def __getitem__(self, item):
+            self.c += 1
+            return item
+
+    source = CountSource()
+    builder = (
+        DatasetBuilder()
+            .add_input('xs', source)
+            .add_input('xs_', source)
+            .add_output('xs', 'xs1')
+            .add_output('xs', 'xs2', transform=lambda x: x + 1)
+            .add_output('xs_', 'xs3')
+    )
+    assert builder[3] == {'xs1': 3, 'xs2': 4, 'xs3': 3}
+    assert source.c == 1
+
+    builder.add_output_transform('xs1', lambda x: -x)
+    assert builder[3]['xs1'] == -3
+    builder.repeat(2).chain()
+    assert builder[13] == [-3, 4, 3]
+
+
+def test_builder_stream():
+    from torch.utils.data import DataLoader
+
+    builder = (
+        DatasetBuilder()
+            .add_idx('idx')
+            .add_input('xs', range(100), transform=lambda x: x * 2)
+            .add_output('xs', 'xs')
+            .subset(range(50))
+    )
+    stream = builder.stream()
+    assert len(stream) == 50
+    res = [sample['xs'] for sample in DataLoader(stream, batch_size=None, num_workers=2)]
+    assert sorted(res) == list(range(0, 100, 2))
+
+    stream = builder.stream(shuffle_buffer=10, seed=1)
+    res = [sample['idx'] for sample in stream]
+    assert sorted(res) == list(range(50)) and res != list(range(50))
+
+    # 50 samples across 3 ranks are padded to 17 per rank
+    ranks = []
+    for rank in range(3):
+        stream = builder.stream()
+        stream.rank_shard = lambda: (rank, 3)
+        ranks.append([int(sample['idx']) for sample in DataLoader(stream, batch_size=None, num_workers=2)])
+        assert len(stream) == len(ranks[-1]) == 17
+    assert sorted(set(sum(ranks, []))) == list(range(50))
+
+    gen = (i for i in range(30))
+    builder = DatasetBuilder().add_idx('idx').add_input('xs', gen).add_output('xs', 'xs', lambda x: -x)
+    assert [sample['xs'] for sample in builder.stream()] == [-i for i in range(30)]
+
+    # unsized sources are split by shards, each shard is read by one worker of one rank
+    reads = []
+
+    def read(shard):
+        reads.append(shard)
+        return range(shard * 10, shard * 10 + 10)
+
+    builder = DatasetBuilder().add_idx('idx').add_input('xs', ShardedSource(range(6), read)).add_output('xs', 'xs')
+    samples = []
+    for rank in range(2):
+        stream = builder.stream()
+        stream.rank_shard = lambda: (rank, 2)
+        samples.extend(sample['xs'] for sample in stream)
+    assert sorted(reads) == list(range(6)) and sorted(samples) == list(range(60))
+    res = [int(sample['xs']) for sample in DataLoader(builder.stream(), batch_size=None, num_workers=2)]
+    assert sorted(res) == list(range(60))
+
+    builder = DatasetBuilder().add_input('xs', (i for i in range(30))).add_output('xs', 'xs')
+    stream = builder.stream()
+    stream.rank_shard = lambda: (0, 2)
+    with pytest.raises(ValueError, match='ShardedSource'):
+        next(iter(stream))
@@ -0,0 +1,63 @@
+from collections import namedtuple
+
+import numpy as np
+import pytest
+import torch
+from torch.utils.data._utils.collate import default_collate
+
+from lumo.data import LumoDataLoader, CollateBase
+from lumo.data.collate import BufferCollate, numpy_collate
+
+Pair = namedtuple('Pair', ['a', 'b'])
+
+
+def create_samples(size=4):
+    return [{
+        'xs': np.full((3, 2), i, dtype=np.float32),
+        'ts': torch.full((2,), i, dtype=torch.int64),
+        'ys': i,
+        'w': 0.5 * i,
+        'name': f'sample{i}',
+        'pair': Pair(np.int64(i), [torch.tensor(i), 'b']),
+    } for i in range(size)]
+
+
+def test_buffer_collate():
+    samples = create_samples()
+    collate = BufferCollate()
+    batch = collate(samples)
+    expected = default_collate(samples)
+    for key in ['xs', 'ts', 'ys', 'w']:
+        assert batch[key].dtype == expected[key].dtype
+        assert torch.equal(batch[key], expected[key])
+    assert batch['name'] == expected['name']
+    assert isinstance(batch['pair'], Pair)
+    assert torch.equal(batch['pair'].a, expected['pair'].a)
+    assert torch.equal(batch['pair'].b[0], expected['pair'].b[0]) and batch['pair'].b[1] == ['b'] * 4
+
+    # schema is cached and inferred again when samples change
+    assert collate(create_samples(2))['xs'].shape == (2, 3, 2)
+    assert collate([(np.zeros(2), 1)] * 3)[0].shape == (3, 2)
+
+    batch = numpy_collate(samples)
+    assert isinstance(batch['xs'], np.ndarray) and batch['xs'].shape == (4, 3, 2)
+    assert batch['ts'].dtype == np.int64 and batch['w'].dtype == np.float64
+    assert (batch['ys'] == np.arange(4)).all()
+
+    # samples of different structures raise like `default_collate`, instead of dropping values
+    for samples in [[np.zeros(2), np.zeros(3)], [[1, 2], [3, 4, 5]], [{'x': 1}, {'x': 1, 'y': 2}], [{'x': 1}, {'y': 2}]]:
+        with pytest.raises(RuntimeError):
+            numpy_collate(samples)
+    with pytest.raises(RuntimeError):
+        collate([(np.zeros(2), 1), (np.zeros(2), 1, 2)])
+
+    # each call of numpy_collate infers its own schema
+    assert set(numpy_collate([{'x': 1}] * 2)) == {'x'}
+    assert set(numpy_collate([{'x': 1, 'y': 2}] * 2)) == {'x', 'y'}
+    assert set(collate([{'x': 1}] * 2)) == {'x'} and set(collate([{'x': 1, 'y': 2}] * 2)) == {'x', 'y'}
+
+    # used in workers with shared memory
+    loader = LumoDataLoader(create_samples(8), batch_size=4, num_workers=1,
+                            collate_fn=CollateBase(collate_fn=BufferCollate()))
+    batches = list(loader)
+    assert len(batches) == 2 and batches[1]['xs'][:, 0, 0].tolist() == [4, 5, 6, 7]
@@ -0,0 +1,68 @@
+from lumo.trainer.base import _BaseTrainer, build_hooks
+from lumo.trainer.callbacks import TrainCallback, BaseCallback
+
+
+class StepCallback(TrainCallback):
+    def __init__(self, log):
+        self.log = log
+
+    def on_train_step_begin(self, trainer, func, params, *args, **kwargs):
+        self.log.append('step_begin')
+
+
+class EvalCallback(StepCallback):
+    def on_eval_step_end(self, trainer, func, params, metric, *args, **kwargs):
+        self.log.append(('eval_end', metric))
+
+
+class GenericCallback(BaseCallback):
+    def __init__(self, log):
+        self.log = log
+
+    def on_begin(self, source, func, params, *args, **kwargs):
+        self.log.append(f'{func.__name__}_begin')
+
+
+class ToyTrainer(_BaseTrainer):
+    callback_function = {'train_step', 'evaluate_step'}
+
+    def __init__(self):
+        self.params = None
+
+    def train(self):
+        pass
+
+    test = evaluate = train
+
+    def train_step(self, batch, params=None):
+        return batch
+
+    def evaluate_step(self, batch, params=None):
+        return batch * 2
+
+
+def test_dispatch():
+    log = []
+    trainer = ToyTrainer()
+    step, evaluate, generic = StepCallback(log), EvalCallback(log), GenericCallback(log)
+
+    begins, ends = build_hooks([step, evaluate, generic, TrainCallback()], 'train_step')
+    assert [cb for cb, _ in begins] == [step, evaluate, generic]
+    assert ends == []
+    begins, ends = build_hooks([step, evaluate, generic], 'evaluate_step')
+    assert [cb for cb, _ in begins] == [generic]
+    assert [cb for cb, _ in ends] == [evaluate]
+
+    # appended without add_callback(), the table is rebuilt lazily
+    trainer.callbacks.extend([step, evaluate, generic])
+    assert trainer.train_step(1) == 1
+    assert log == ['step_begin', 'step_begin', 'train_step_begin']
+
+    log.clear()
+    assert trainer.evaluate_step(1) == 2
+    assert log == ['evaluate_step_begin', ('eval_end', 2)]
+
+    log.clear()
+    trainer.callbacks.remove(generic)
+    trainer.train_step(1)
+    assert log == ['step_begin', 'step_begin']
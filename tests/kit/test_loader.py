@@ -0,0 +1,109 @@
+import torch
+from torch.utils.data import TensorDataset
+
+from lumo.data import LumoDataLoader, DataLoaderSide, DataLoaderPrefetch
+
+
+def create_loader(size=20, batch_size=4):
+    return LumoDataLoader(TensorDataset(torch.arange(size)), batch_size=batch_size)
+
+
+def test_prefetch():
+    loader = DataLoaderPrefetch(create_loader(), depth=2, device='cpu')
+    assert len(loader) == 5
+    assert torch.cat([xs for xs, in loader]).tolist() == list(range(20))
+
+    # early break releases the background thread
+    for i, (xs,) in enumerate(loader):
+        if i == 1:
+            break
+    assert xs.tolist() == [4, 5, 6, 7]
+
+    side = DataLoaderSide().add('a', create_loader()).add('b', create_loader(8), cycle=True)
+    batches = list(DataLoaderPrefetch(side, depth=3))
+    assert len(batches) == 5 and batches[4]['b'][0].tolist() == [0, 1, 2, 3]
+
+    loader = create_loader().set_prefetch(2)
+    assert torch.cat([xs for xs, in loader]).tolist() == list(range(20))
+
+
+def test_prefetch_exception():
+    def gen():
+        yield 1
+        raise KeyError('boom')
+
+    res = []
+    try:
+        for i in DataLoaderPrefetch(gen()):
+            res.append(i)
+        assert False
+    except KeyError:
+        pass
+    assert res == [1]
+
+
+def test_side_concurrent():
+    for concurrent in [True, False]:
+        side = (DataLoaderSide(concurrent=concurrent)
+                .add('a', create_loader(8))
+                .add('b', create_loader(12), cycle=True))
+        first = [batch['b'][0][0].item() for batch in side]
+        second = [batch['b'][0][0].item() for batch in side]
+        assert first == [0, 4]
+        if concurrent:
+            # cycled loader is kept across iterations
+            assert second == [8, 0]
+        else:
+            assert second == [0, 4]
+        wait = side.wait_time()
+        assert list(wait.keys()) == ['a', 'b'] and wait['b']['count'] == 2
+
+
+def test_resume():
+    def shuffled(seed):
+        torch.manual_seed(seed)
+        return LumoDataLoader(TensorDataset(torch.arange(20)), batch_size=3, shuffle=True)
+
+    def consume(loader, n):
+        it = iter(loader)
+        return [next(it)[0].tolist() for _ in range(n)]
+
+    full = [xs.tolist() for xs, in shuffled(0)]
+    loader = shuffled(0)
+    head = consume(loader, 3)
+    state = loader.state_dict()
+    assert state['consumed'] == 3 and state['pos'] == 3
+
+    resumed = shuffled(1).load_state_dict(state)
+    assert head + [xs.tolist() for xs, in resumed] == full
+    # only the first epoch is skipped
+    assert len(list(resumed)) == 7
+
+    # batch_count repeats the sampler, the position is in the second pass
+    loader = shuffled(2)
+    loader._prop['batch_count'] = 10
+    full = [xs.tolist() for xs, in loader]
+    loader = shuffled(2)
+    loader._prop['batch_count'] = 10
+    head = consume(loader, 8)
+    state = loader.state_dict()
+    assert state['pos'] == 1
+    resumed = shuffled(3)
+    resumed._prop['batch_count'] = 10
+    resumed.load_state_dict(state)
+    assert head + [xs.tolist() for xs, in resumed] == full
+
+    # staged batches are not counted as consumed
+    full = [xs.tolist() for xs, in shuffled(4)]
+    loader = DataLoaderPrefetch(shuffled(4), depth=3)
+    head = consume(loader, 2)
+    state = loader.state_dict()
+    assert state['consumed'] == 2
+    assert head + [xs.tolist() for xs, in shuffled(5).load_state_dict(state)] == full
+
+    # a finished epoch resumes from the next one
+    loader = shuffled(6)
+    list(loader)
+    state = loader.state_dict()
+    assert state['consumed'] == 0
+    assert [xs.tolist() for xs, in loader] == [xs.tolist() for xs, in shuffled(7).load_state_dict(state)]
@@ -0,0 +1,40 @@
+from lumo.core import TrainStage
+from lumo.trainer import callbacks
+
+
+class LogRecorder:
+    def __init__(self):
+        self.lines = []
+
+    def raw(self, value, inline=False):
+        self.lines.append(('raw', str(value)))
+
+    def inline(self, value):
+        self.lines.append(('inline', str(value)))
+
+    def newline(self):
+        pass
+
+
+def test_logger_callback_throttle():
+    class ToyTrainer:
+        logger = LogRecorder()
+        idx = 0
+
+    trainer = ToyTrainer()
+    cb = callbacks.LoggerCallback(step_frequence=1, break_in=50, refresh_rate=0)
+    cb.stage[TrainStage.val] = 100
+    for isatty, refresh_rate, raw_lines in [(True, 0, 98), (True, 1e-6, 1), (False, 0, 0)]:
+        trainer.logger.lines.clear()
+        cb.isatty = isatty
+        cb.interval = 1 / refresh_rate if refresh_rate else 0
+        cb.last_render = float('-inf')
+        cb.renew(TrainStage.val)
+        for i in range(100):
+            trainer.idx = i
+            cb.on_eval_step_end(trainer, None, None, metric={'acc': i})
+        cb.flush(trainer)
+        # steps 50/100 and the flush break lines, others are inline renders when allowed
+        assert len([line for line in trainer.logger.lines if line[0] == 'inline']) == 3
+        assert len([line for line in trainer.logger.lines if line[0] == 'raw']) == raw_lines
+        assert trainer.logger.lines[-1][1].startswith('100/100')
@@ -0,0 +1,60 @@
+import pytest
+import torch
+from accelerate.data_loader import BatchSamplerShard
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from lumo.trainer.outputs import OutputBuffer
+
+
+def test_output_buffer():
+    buffer = OutputBuffer(capacity=5)
+    logits = torch.randn(12, 3)
+    labels = torch.arange(12)
+    for i in range(0, 12, 4):
+        buffer.append({'logits': logits[i:i + 4], 'labels': labels[i:i + 4]})
+    assert len(buffer) == 12
+
+    outputs = buffer.gather()
+    assert outputs['logits'].equal(logits) and outputs['labels'].equal(labels)
+
+    with pytest.raises(AssertionError, match='batch size'):
+        buffer.append({'logits': logits[:2], 'labels': labels[:3]})
+
+    # a new key after the first batch would leave its buffer uninitialized
+    with pytest.raises(AssertionError, match='same keys'):
+        buffer.append({'logits': logits[:2], 'labels': labels[:2], 'extra': labels[:2]})
+    with pytest.raises(AssertionError, match='same keys'):
+        buffer.append({'logits': logits[:2]})
+
+
+class FakeAccelerator:
+    """Two processes, the gathered tensors of the other rank are given in calling order."""
+    num_processes = 2
+    device = 'cpu'
+
+    def __init__(self, others):
+        self.others = others
+
+    def pad_across_processes(self, tensor, dim=0):
+        return tensor
+
+    def gather(self, tensor):
+        return torch.cat([tensor, self.others.pop(0)])
+
+
+def test_output_buffer_gather_padded():
+    # 10 samples in batches of 4 split across 2 ranks, the last batch is padded by samples 0 and 1
+    batch_sampler = BatchSampler(SequentialSampler(range(10)), 4, drop_last=False)
+    buffers = []
+    for rank in range(2):
+        buffer = OutputBuffer()
+        for batch in BatchSamplerShard(batch_sampler, 2, rank, split_batches=True):
+            buffer.append({'labels': torch.tensor(batch), 'logits': torch.tensor(batch) * 10})
+        buffers.append(buffer)
+    assert len(buffers[1]) == 6
+
+    other = buffers[1].outputs()
+    outputs = buffers[0].gather(FakeAccelerator([torch.tensor([6]), other['labels'], other['logits']]),
+                                num_samples=10)
+    assert outputs['labels'].tolist() == list(range(10))
+    assert outputs['logits'].tolist() == [i * 10 for i in range(10)]
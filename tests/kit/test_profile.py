@@ -0,0 +1,72 @@
+from lumo.trainer.base import _BaseTrainer
+from lumo.trainer.callbacks import ProfileCallback, LoggerCallback, TrainCallback
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, t):
+        self.now += t
+
+
+clock = FakeClock()
+
+
+class SlowCallback(TrainCallback):
+    def on_train_step_end(self, trainer, func, params, metric, *args, **kwargs):
+        clock.advance(4)
+
+
+class SlowLogger(LoggerCallback):
+    def __init__(self):
+        pass
+
+    def on_train_step_end(self, trainer, func, params, metric, *args, **kwargs):
+        clock.advance(2)
+
+
+class ToyTrainer(_BaseTrainer):
+    callback_function = {'train_step'}
+
+    def __init__(self):
+        self.params = None
+        self.train_dataloader = None
+
+    def train(self):
+        pass
+
+    test = evaluate = train
+
+    def train_step(self, batch, params=None):
+        clock.advance(10)
+        return batch
+
+
+def test_profile_callback():
+    trainer = ToyTrainer()
+    profiler = ProfileCallback(trace=True, trace_steps=2, clock=clock)
+    for cb in [SlowCallback(), SlowLogger(), profiler]:
+        trainer.callbacks.append(cb)
+        cb._hooked = trainer
+    profiler.on_hooked(trainer, None)
+
+    profiler.on_train_epoch_begin(trainer, None, None)
+    for i in range(3):
+        clock.advance(3)  # waiting for data
+        assert trainer.train_step(i) == i
+
+    res = profiler.summary()
+    assert res['steps'] == 3 and res['total'] == 3 * 19
+    assert {phase: res[phase]['total'] for phase in profiler.phases} == {
+        'data_wait': 9, 'h2d': 0, 'compute': 30, 'callbacks': 12, 'logging': 6}
+    assert res['compute']['mean_ms'] == 10000
+    assert abs(sum(res[phase]['ratio'] for phase in profiler.phases) - 1) < 1e-6
+
+    events = profiler.chrome_trace()['traceEvents']
+    assert {event['args']['step'] for event in events} == {0, 1}
+    assert [(event['name'], event['ts'], event['dur']) for event in events[:4]] == [
+        ('data_wait', 0, 3e6), ('compute', 3e6, 10e6), ('callbacks', 13e6, 4e6), ('logging', 17e6, 2e6)]
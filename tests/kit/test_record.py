@@ -0,0 +1,73 @@
+import numpy as np
+import torch
+
+from lumo.core import Meter, Record
+
+
+def test_record_lazy():
+    record = Record(lazy=True)
+    losses = torch.rand(20)
+    for i, loss in enumerate(losses):
+        m = Meter(lazy=True)
+        m.loss = loss
+        m.min.lmin = loss
+        m.max.lmax = loss
+        m.sum.lsum = loss
+        m.step = torch.tensor(i)
+        assert isinstance(m.loss, torch.Tensor)
+        record.record(m)
+        # dict metrics are wrapped lazily, too
+        record.record({'acc': loss * 2})
+        # nothing is copied to host before agg()
+        assert record._staged['loss'].size == i + 1 and len(record._agg['loss']) == 0
+
+    res = record.agg()
+    assert abs(res['loss'] - losses.mean().item()) < 1e-6
+    assert abs(res['acc'] - losses.mean().item() * 2) < 1e-6
+    assert res['lmin'] == losses.min().item() and res['lmax'] == losses.max().item()
+    assert abs(res['lsum'] - losses.sum().item()) < 1e-5
+    assert res['step'] == 19 and isinstance(res['step'], int)
+    assert 'loss: ' in str(m) and 'tensor' not in str(m)
+
+    # copied to host periodically
+    record = Record(lazy=True, sync_interval=5)
+    for i in range(5):
+        record.record({'loss': torch.tensor(float(i))})
+    assert record._agg['loss'].sum == 10. and record._staged['loss'].size == 0
+    record.record({'loss': torch.tensor(5.)})
+    assert record.agg()['loss'] == 2.5
+
+    # min/max do not start from 0
+    record = Record()
+    for i in range(3, 6):
+        m = Meter()
+        m.min.loss = i
+        record.record(m)
+    assert record.agg()['loss'] == 3
+
+
+def test_record_history(tmpdir):
+    record = Record(window_size=10, history_size=50)
+    for i in range(100):
+        m = Meter()
+        m.loss = float(i)
+        m.slide.sloss = float(i)
+        m.ema.eloss = float(i)
+        m.max.lmax = i
+        m.name = 'a'
+        record.record(m)
+    res = record.agg()
+    assert res['loss'] == np.mean(range(100))
+    assert res['sloss'] == np.mean(range(90, 100))
+    ema = 0.
+    for i in range(1, 100):
+        ema = ema * 0.9 + i * 0.1
+    assert abs(res['eloss'] - ema) < 1e-6
+    assert res['lmax'] == 99 and res['name'] == 'a'
+
+    history = record.history()
+    assert list(history.keys()) == ['loss', 'sloss', 'eloss', 'lmax']
+    assert history['loss'].tolist() == list(range(50, 100))
+    assert record.percentile('loss', 50) == np.percentile(range(50, 100), 50)
+    fn = record.dump(tmpdir.join('record.npz').strpath)
+    assert (np.load(fn)['lmax'] == np.arange(50, 100)).all()
@@ -0,0 +1,39 @@
+import os
+import tempfile
+
+from lumo.core.record_backend import SqliteRecordBackend, CSVRecordBackend
+
+
+def test_sqlite_backend():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, 'metrics.sqlite')
+        backend = SqliteRecordBackend(fn, test='a', buffer_size=4)
+        other = SqliteRecordBackend(fn, test='b', buffer_size=100)
+        for i in range(5):
+            backend.log({'loss': 1 / (i + 1), 'acc': i}, step=i)
+            other.log({'loss': i})
+        # buffered records are written in batches
+        assert other.conn.execute('SELECT COUNT(*) FROM metrics').fetchone()[0] == 8
+        backend.log({'msg': 'done'}, sync=True)
+
+        assert set(other.keys('a')) == {'loss', 'acc', 'msg'}
+        assert other.query('acc', test='a') == [(i, float(i)) for i in range(5)]
+        assert other.query('msg', test='a') == [(5, 'done')]
+        assert other.query('loss') == [(i, float(i)) for i in range(5)]
+        backend.close()
+        other.close()
+
+
+def test_csv_backend():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fn = os.path.join(tmpdir, 'metrics.csv')
+        backend = CSVRecordBackend(fn, buffer_size=4)
+        for i in range(3):
+            backend.log({'loss': i, 'acc': i * 2})
+        with open(fn) as r:
+            assert len(r.readlines()) == 1 + 4
+        backend.log({'msg': 'done'}, step=10)
+        res = backend.read()
+        assert res['loss'] == [(0, 0.), (1, 1.), (2, 2.)]
+        assert res['acc'] == [(0, 0.), (1, 2.), (2, 4.)]
+        assert res['msg'] == [(10, 'done')]
@@ -0,0 +1,64 @@
+import numpy as np
+import torch
+
+from lumo.data import LumoDataLoader, BucketBatchSampler, PadCollate
+
+
+class VarLenDataset:
+    def __init__(self, lengths):
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, index):
+        length = self.lengths[index]
+        return {'xs': np.full((length, 2), index + 1, dtype=np.float32), 'len': length}
+
+
+def test_bucket_sampler():
+    lengths = np.random.RandomState(0).randint(1, 50, size=100)
+
+    sampler = BucketBatchSampler(lengths, max_tokens=120)
+    batches = list(sampler)
+    assert len(batches) == len(sampler)
+    assert sorted(i for batch in batches for i in batch) == list(range(100))
+    for batch in batches:
+        assert len(batch) == 1 or lengths[batch].max() * len(batch) <= 120
+
+    sampler = BucketBatchSampler(lengths, batch_size=8, drop_last=True, shuffle=False)
+    batches = list(sampler)
+    assert len(batches) == len(sampler) == 12
+    assert all(len(batch) == 8 for batch in batches)
+    # padding waste is much less than random batches
+    assert sampler.padding_ratio() < 0.1
+
+    # with shuffle, the dropped remainder is random rather than always the longest samples
+    sampler = BucketBatchSampler(lengths, batch_size=8, drop_last=True, generator=torch.Generator().manual_seed(0))
+    seen = set()
+    for _ in range(10):
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == 12 and all(len(batch) == 8 for batch in batches)
+        seen.update(i for batch in batches for i in batch)
+    assert seen == set(range(100))
+
+    loader = LumoDataLoader(VarLenDataset(lengths),
+                            batch_sampler=BucketBatchSampler(lengths, batch_size=8),
+                            collate_fn=PadCollate(pad_value=-1))
+    batch = next(iter(loader))
+    # batches are shuffled, the first one may be the last short batch
+    assert batch['xs'].shape == (len(batch['len']), batch['len'].max(), 2)
+    for xs, length in zip(batch['xs'], batch['len']):
+        assert (xs[:length] > 0).all() and (xs[length:] == -1).all()
+
+    # the dedicated generator of sampler is saved and restored
+    full = [batch['len'].tolist() for batch in loader]
+    torch.manual_seed(1)
+    it = iter(loader)
+    head = [next(it)['len'].tolist() for _ in range(3)]
+    state = loader.state_dict()
+    rest = [batch['len'].tolist() for batch in loader.load_state_dict(state)]
+    assert len(head + rest) == len(full)
+    torch.manual_seed(2)
+    loader.load_state_dict(state)
+    assert [batch['len'].tolist() for batch in loader] == rest
@@ -1,7 +1,10 @@
-from lumo import Saver
+from lumo.trainer.saver import Saver
+import os
 import time
 import shutil
 
+import torch
+
 
 def test_save_load():
     save_root = './temp_saver'
@@ -18,8 +21,8 @@ def test_save_load():
 
     assert len(saver.list_models()) == (epoch)
 
-    state = saver.load_model(best_if_exist=True, with_meta=True)
-    assert state[0]['step'] == 5 and state[1]['meta_step'] == 5
+    res = saver.load_model(best_if_exist=True, with_meta=True)
+    assert res.state_dict['step'] == 5 and res.meta_info['meta_step'] == 5
 
     state = saver.load_model(2)
     assert state['step'] == 2
@@ -36,3 +39,80 @@ def test_save_load():
     assert state['step'] == 4
 
     shutil.rmtree(save_root)
+
+
+def test_async_save():
+    save_root = './temp_async_saver'
+    saver = Saver(save_root, async_write=True)
+    weight = torch.zeros(4)
+    state_dict = {'model': {'weight': weight, 'tied': weight}, 'step': 0}
+    for i in range(6):
+        weight.fill_(i)
+        state_dict['step'] = i
+        path = saver.save_checkpoint(i, state_dict, {'meta_step': i}, max_keep=3, is_best=(i == 2))
+        # the snapshot is taken before returning, training can update the weight in place.
+        weight.fill_(-1)
+        assert path.endswith('.pt')
+
+    saver.flush()
+    assert len(saver.list_checkpoints()) == 3
+    assert not any(fn.endswith('.tmp') for fn in saver.list())
+
+    res = saver.load_checkpoint(best_if_exist=True, with_meta=True)
+    state, info = res.state_dict, res.meta_info
+    assert state['step'] == 2 and info['meta_step'] == 2
+    assert state['model']['weight'].eq(2).all()
+    assert state['model']['weight'] is state['model']['tied']
+
+    state = saver.load_checkpoint(-1)
+    assert state['step'] == 5 and state['model']['weight'].eq(5).all()
+    shutil.rmtree(save_root)
+
+
+def test_sharded_save():
+    save_root = './temp_sharded_saver'
+    saver = Saver(save_root, sharded=True, max_shard_size=64)
+    backbone = torch.nn.Linear(8, 8)
+    head = torch.nn.Linear(8, 2)
+    for i in range(4):
+        with torch.no_grad():
+            head.weight.fill_(i)
+        state_dict = {
+            'models': {'backbone': backbone.state_dict(), 'head': head.state_dict()},
+            'optims': {'sgd': {'state': {}, 'param_groups': [{'lr': 0.1 * i}]}},
+            'step': i,
+        }
+        saver.save_checkpoint(i, state_dict, {'meta_step': i}, max_keep=2, is_best=(i == 1))
+
+    assert len(saver.list_checkpoints()) == 2
+    assert not any(fn.endswith('.pt') for fn in saver.list())
+    # weight and bias are split into two shards. The backbone and the bias of the head are shared by all
+    # checkpoints, the others are kept for each of the last two and the best one.
+    assert len(os.listdir(os.path.join(save_root, 'shards'))) == 2 + 1 + 3 * 3
+
+    state = saver.load_checkpoint()
+    assert state['step'] == 3 and state['optims']['sgd']['param_groups'][0]['lr'] == 0.1 * 3
+    model = torch.nn.Linear(8, 8)
+    model.load_state_dict(state['models']['backbone'])
+    assert model.weight.equal(backbone.weight)
+
+    state = saver.load_checkpoint(best_if_exist=True, keys=['models.head'])
+    assert list(state) == ['models'] and list(state['models']) == ['head']
+    assert state['models']['head']['weight'].eq(1).all()
+    shutil.rmtree(save_root)
+
+
+def test_mmap_load():
+    save_root = './temp_mmap_saver'
+    saver = Saver(save_root)
+    state_dict = {'models': {'model': {'weight': torch.arange(1024.)}}, 'optims': {'sgd': {'lr': 0.1}}}
+    saver.save_checkpoint(0, state_dict)
+
+    state = saver.load_checkpoint(keys=['models.model.weight'], mmap=True)
+    assert list(state) == ['models']
+    weight = state['models']['model']['weight']
+    assert weight.equal(torch.arange(1024.))
+
+    state = saver.load_checkpoint(mmap=True, map_location='meta')
+    assert state['models']['model']['weight'].is_meta and state['optims']['sgd']['lr'] == 0.1
+    shutil.rmtree(save_root)
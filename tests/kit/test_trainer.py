@@ -0,0 +1,265 @@
+import copy
+import os
+import subprocess
+
+import pytest
+import torch
+from torch import nn
+from torch.utils.data import TensorDataset
+
+from lumo import Trainer, Params, DataModule, Meter
+from lumo.data import LumoDataLoader
+from lumo.trainer.callbacks import AutoLoadModel
+
+
+class ToyParams(Params):
+    def __init__(self):
+        super().__init__()
+        self.epoch = 1
+        self.device = 'cpu'
+
+
+class ToyDM(DataModule):
+    def idataloader(self, params, stage):
+        loader = LumoDataLoader(TensorDataset(torch.arange(20)), batch_size=3, shuffle=True)
+        self.regist_dataloader_with_stage(stage, loader)
+
+
+class ResumeTrainer(Trainer):
+    def __init__(self, params, dm, save_at=None):
+        super().__init__(params, dm)
+        self.save_at = save_at
+        self.seen = []
+        self.saved = None
+
+    def icallbacks(self, params):
+        pass
+
+    def imodels(self, params):
+        self.model = nn.Linear(1, 1)
+        self.optim = torch.optim.SGD(self.model.parameters(), lr=0.1)
+
+    def train_step(self, batch, params=None):
+        self.seen.append(batch[0].tolist())
+        if len(self.seen) == self.save_at:
+            # like a step checkpoint saved in `on_train_step_end`
+            self.saved = self.state_dict()
+
+
+def in_temp_repo(tmp_path, monkeypatch):
+    """Experiments commit the working dir to git, run them in a temporary repository."""
+    subprocess.run(['git', 'init', '-q'], cwd=tmp_path, check=True)
+    monkeypatch.chdir(tmp_path)
+
+
+def test_resume_trainer(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    torch.manual_seed(0)
+    trainer = ResumeTrainer(ToyParams(), ToyDM(), save_at=3)
+    trainer.initialize()
+    trainer.train()
+    assert len(trainer.seen) == 7
+    # prepared by accelerate's arguments, but still resumable
+    assert isinstance(trainer.train_dataloader, LumoDataLoader)
+    assert trainer.accelerate.split_batches is None
+
+    torch.manual_seed(1)
+    resumed = ResumeTrainer(ToyParams(), ToyDM())
+    resumed.initialize()
+    resumed.load_state_dict(trainer.saved)
+    resumed.train()
+    assert resumed.seen == trainer.seen[3:]
+    assert torch.equal(resumed.model.weight, trainer.saved['models']['model']['weight'])
+
+
+class AccumParams(ToyParams):
+    def __init__(self):
+        super().__init__()
+        self.grad_accum_steps = 3
+
+
+class OnesDM(DataModule):
+    def idataloader(self, params, stage):
+        # 10 batches of 2 samples
+        self.regist_dataloader_with_stage(stage, LumoDataLoader(TensorDataset(torch.ones(20, 2)), batch_size=2))
+
+
+class AccumTrainer(Trainer):
+    def __init__(self, params, dm, stop_at=None):
+        super().__init__(params, dm)
+        self.stop_at = stop_at
+        self.stepped = []
+
+    def icallbacks(self, params):
+        pass
+
+    def imodels(self, params):
+        self.model = nn.Linear(2, 1, bias=False)
+        nn.init.zeros_(self.model.weight)
+        self.optim = torch.optim.SGD(self.model.parameters(), lr=1.)
+
+    def train_step(self, batch, params=None):
+        with self.accumulate():
+            # gradient of each micro-batch is 2 for each weight
+            loss = self.model(batch[0]).sum()
+        self.stepped.append(self.optimize(loss))
+        if self.idx + 1 == self.stop_at:
+            self.stop_at = None
+            self.stop_train_epoch()
+
+
+def test_grad_accumulation(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    trainer = AccumTrainer(AccumParams(), OnesDM())
+    trainer.initialize()
+    trainer.train()
+    assert trainer.stepped == [False, False, True] * 3 + [True]
+    assert trainer.effective_batch_size == 6
+    # loss is averaged over micro-batches of each cycle, the last cycle has only one
+    assert trainer.model.weight.tolist() == [[-8., -8.]]
+
+
+def test_grad_clip_and_scaler(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    params = AccumParams()
+    params.max_grad_norm = 0.5
+    expected = -4 * 0.5 / 2 ** 0.5
+
+    trainer = AccumTrainer(params, OnesDM())
+    trainer.initialize()
+    trainer.train()
+    assert torch.allclose(trainer.model.weight, torch.full((1, 2), expected))
+
+    # fp16 path, gradients are unscaled before clipping
+    trainer = AccumTrainer(params, OnesDM())
+    trainer._scaler = torch.amp.GradScaler('cpu', init_scale=1024.)
+    trainer.initialize()
+    trainer.train()
+    assert trainer.stepped == [False, False, True] * 3 + [True]
+    assert torch.allclose(trainer.model.weight, torch.full((1, 2), expected))
+    assert trainer._scaler.get_scale() == 1024. and 'scaler' in trainer.state_dict()
+
+
+def test_accumulation_reset_by_epoch(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    params = AccumParams()
+    params.epoch = 2
+    # the first epoch stops in the middle of the second cycle
+    trainer = AccumTrainer(params, OnesDM(), stop_at=5)
+    trainer.initialize()
+    trainer.train()
+    assert trainer.stepped[:5] == [False, False, True, False, False]
+    # half-accumulated gradients are dropped, the second epoch starts a new cycle
+    assert trainer.stepped[5:] == [False, False, True] * 3 + [True]
+    assert trainer.model.weight.tolist() == [[-10., -10.]]
+
+
+class SweepTrainer(Trainer):
+    def icallbacks(self, params):
+        pass
+
+    def imodels(self, params):
+        self.model = nn.Linear(1, 1, bias=False)
+
+    def evaluate_step(self, batch, params=None):
+        meter = Meter()
+        # the output of each sample is the weight
+        meter.w = self.model(torch.ones(len(batch[0]), 1)).mean()
+        return meter
+
+
+def create_sweep_trainer():
+    trainer = SweepTrainer(ToyParams(), ToyDM())
+    trainer.initialize()
+    return trainer
+
+
+def test_evaluate_checkpoints(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    trainer = create_sweep_trainer()
+    checkpoints = []
+    for i in range(1, 4):
+        nn.init.constant_(trainer.model.weight, i)
+        checkpoints.append(trainer.saver.save_checkpoint(i, trainer.state_dict()))
+    nn.init.constant_(trainer.model.weight, 10)
+
+    results = trainer.evaluate_checkpoints(checkpoints, dump=False)
+    assert [res['w'] for res in results] == [1., 2., 3.]
+    # weights are restored after the sweep
+    assert trainer.model.weight.item() == 10.
+
+    results = trainer.evaluate_checkpoints(checkpoints, num_processes=2, trainer_fn=create_sweep_trainer, dump=False)
+    assert [res['w'] for res in results] == [1., 2., 3.]
+    assert [res['checkpoint'] for res in results] == [os.path.basename(fn) for fn in checkpoints]
+
+
+class EvalTrainer(SweepTrainer):
+    def __init__(self, params, dm):
+        super().__init__(params, dm)
+        self.seen = []
+
+    def evaluate_step(self, batch, params=None):
+        self.seen.append(batch[0].tolist())
+
+
+def test_eval_batch_size(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    params = ToyParams()
+    params.eval_batch_size = 8
+    trainer = EvalTrainer(params, ToyDM())
+    trainer.initialize()
+    trainer.evaluate()
+    assert [len(batch) for batch in trainer.seen] == [8, 8, 4]
+    assert sorted(sum(trainer.seen, [])) == list(range(20))
+    assert isinstance(trainer.val_dataloader, LumoDataLoader)
+
+
+class PretrainTrainer(SweepTrainer):
+    def icallbacks(self, params):
+        AutoLoadModel().hook(self)
+
+
+def test_auto_load_model(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    trainer = create_sweep_trainer()
+    nn.init.constant_(trainer.model.weight, 3)
+    paths = [trainer.save_model(), trainer.save_checkpoint()]
+
+    params = ToyParams()
+    params.pretrain = True
+    for path in paths:
+        params.pretrain_path = path
+        trainer = PretrainTrainer(params, ToyDM())
+        trainer.initialize()
+        assert trainer.model.weight.item() == 3
+
+    params.pretrain_path = trainer.saver.save_keypoint(0, {'step': 0})
+    with pytest.raises(ValueError, match='No model weights'):
+        PretrainTrainer(params, ToyDM()).initialize()
+
+
+class ResumeAccumTrainer(AccumTrainer):
+    saved = None
+
+    def train_step(self, batch, params=None):
+        super().train_step(batch, params)
+        if self.saved is None and self.idx + 1 == 5:
+            # in the middle of the second accumulation cycle
+            self.saved = copy.deepcopy(self.state_dict())
+
+
+def test_resume_accumulation(tmp_path, monkeypatch):
+    in_temp_repo(tmp_path, monkeypatch)
+    trainer = ResumeAccumTrainer(AccumParams(), OnesDM())
+    trainer.initialize()
+    trainer.train()
+    assert trainer.saved['models']['model']['weight'].tolist() == [[-2., -2.]]
+
+    resumed = ResumeAccumTrainer(AccumParams(), OnesDM())
+    resumed.saved = trainer.saved
+    resumed.initialize()
+    resumed.load_state_dict(trainer.saved)
+    resumed.train()
+    # the remaining 5 batches are accumulated as cycles of 3 and 2, the last step is not lost
+    assert resumed.stepped == [False, False, True, False, True]
+    assert resumed.model.weight.tolist() == [[-6., -6.]]
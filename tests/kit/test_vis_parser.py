@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from lumo.vis.parser import IncrementalParser, parse_from_log
+
+
+def test_incremental_log(tmp_path):
+    log = str(tmp_path / 'test.log')
+    cache = str(tmp_path / 'metrics.cache')
+    with open(log, 'w') as w:
+        w.write('26-10-18 05:47:06 | 4/4, 00:00<00:00 (100%), loss=0.5, acc=1\n')
+        w.write('26-10-18 05:47:07 | 4/4, 00:00<00:00 (100%), loss=0.4\n')
+        w.write('26-10-18 05:47:08 | 4/4, 00:00<00:00 (100%), loss=0.3')
+
+    parser = IncrementalParser(log, cache)
+    metrics = parser.refresh()
+    assert metrics['loss'][1].tolist() == [0.5, 0.4]
+    assert metrics['acc'][1].tolist() == [1]
+
+    with open(log, 'a') as w:
+        w.write(', acc=0.5\n')
+    # a new parser reuses the cache and only parses the new line
+    parser = IncrementalParser(log, cache)
+    assert parser.offsets[log] < os.path.getsize(log)
+    metrics = parser.refresh()
+    assert metrics['loss'][0].tolist() == [0, 1, 2]
+    assert metrics['loss'][1].tolist() == [0.5, 0.4, 0.3]
+    assert metrics['acc'][1].tolist() == [1, 0.5]
+    assert {k: [s.value for s in v] for k, v in parse_from_log(log).items()} == {
+        k: v.tolist() for k, (_, v) in metrics.items()}
+
+    # rewritten file is parsed from the beginning
+    with open(log, 'w') as w:
+        w.write('| loss=0.1\n')
+    assert {k: v.tolist() for k, (_, v) in parser.refresh().items()} == {'loss': [0.1]}
+
+
+def test_incremental_events(tmp_path):
+    tensorboardX = pytest.importorskip('tensorboardX')
+    root = str(tmp_path / 'board')
+    writer = tensorboardX.SummaryWriter(root)
+    for i in range(5):
+        writer.add_scalar('loss', i, global_step=i * 10)
+    writer.close()
+
+    parser = IncrementalParser(root, str(tmp_path / 'metrics.cache'))
+    assert parser.refresh()['loss'][0].tolist() == [0, 10, 20, 30, 40]
+
+    # the next run appends a new event file
+    writer = tensorboardX.SummaryWriter(root, filename_suffix='.next')
+    writer.add_scalar('loss', 5, global_step=50)
+    writer.add_scalar('acc', 1, global_step=50)
+    writer.close()
+    metrics = IncrementalParser(root, str(tmp_path / 'metrics.cache')).refresh()
+    assert metrics['loss'][1].tolist() == [0, 1, 2, 3, 4, 5]
+    assert metrics['acc'][0].tolist() == [50]
+
+
+def test_incremental_cache(tmp_path):
+    log = str(tmp_path / 'test.log')
+    cache = str(tmp_path / 'metrics.cache')
+    with open(log, 'w') as w:
+        w.write('26-10-18 05:47:06 | 4/4, 00:00<00:00 (100%), loss=0.5, acc=1\n')
+    first, second = IncrementalParser(log, cache), IncrementalParser(log, cache)
+    first.refresh()
+    sizes = {f: os.path.getsize(os.path.join(cache, f)) for f in os.listdir(cache) if f.endswith('.bin')}
+    assert len(sizes) == 2 and set(sizes.values()) == {16}
+
+    # only the new record of the changed series is written
+    with open(log, 'a') as w:
+        w.write('26-10-18 05:47:07 | 4/4, 00:00<00:00 (100%), loss=0.4\n')
+    metrics = second.refresh()
+    assert metrics['loss'][1].tolist() == [0.5, 0.4]
+    assert sorted(os.path.getsize(os.path.join(cache, f)) for f in sizes) == [16, 32]
+    assert IncrementalParser(log, cache).metrics['loss'][1].tolist() == [0.5, 0.4]
+
+    # rewritten in place with a longer content
+    size = os.path.getsize(log)
+    with open(log, 'w') as w:
+        w.write('26-10-18 06:00:00 | 1/4, 00:00<00:00 (25%), loss=0.9, acc=0\n')
+        w.write('26-10-18 06:00:01 | 2/4, 00:00<00:01 (50%), loss=0.8, lr=0.1\n')
+    assert os.path.getsize(log) >= size
+    metrics = first.refresh()
+    assert {k: v.tolist() for k, (_, v) in metrics.items()} == {'loss': [0.9, 0.8], 'acc': [0.], 'lr': [0.1]}
+    assert IncrementalParser(log, cache).metrics['loss'][1].tolist() == [0.9, 0.8]
+    files = os.listdir(cache)
+    assert len(files) == 4 and not any(f.endswith('.tmp') for f in files) and not set(sizes) & set(files)
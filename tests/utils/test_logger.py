@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+
+import pytest
+
+from lumo.utils.logger import AsyncFileWriter
+
+
+def test_async_file_writer():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fa, fb = os.path.join(tmpdir, 'a.log'), os.path.join(tmpdir, 'b.log')
+        writer = AsyncFileWriter(maxsize=4, flush_interval=10)
+        for i in range(20):
+            writer.write(fa, f'{i}\n')
+        writer.write(fb, 'b\n')
+        writer.flush()
+        with open(fa) as r:
+            assert r.read() == ''.join(f'{i}\n' for i in range(20))
+
+        writer.write(fb, 'c\n')
+        writer.close()
+        with open(fb) as r:
+            assert r.read() == 'b\nc\n'
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_async_file_writer_failure():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fa, bad = os.path.join(tmpdir, 'a.log'), os.path.join(tmpdir, 'none', 'b.log')
+        writer = AsyncFileWriter(maxsize=2, flush_interval=0.1)
+        with pytest.warns(UserWarning, match='b.log'):
+            writer.write(bad, 'b\n')
+            writer.write(fa, '0\n')
+            writer.flush()
+        with open(fa) as r:
+            assert r.read() == '0\n'
+
+        def crash():
+            raise RuntimeError()
+
+        # the thread is killed, and later strings are written synchronously instead of blocking
+        writer._flush_files = crash
+        writer.flush(timeout=1)
+        for i in range(1, 5):
+            writer.write(fa, f'{i}\n')
+        writer.flush()
+        writer.close()
+        with open(fa) as r:
+            assert r.read() == ''.join(f'{i}\n' for i in range(5))
+
+
+def test_async_file_writer_interval():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fa = os.path.join(tmpdir, 'a.log')
+        writer = AsyncFileWriter(flush_interval=0.2)
+        # lines keep coming, but files are still flushed on the interval
+        start = time.monotonic()
+        while time.monotonic() - start < 1:
+            writer.write(fa, 'line\n')
+            time.sleep(0.05)
+        assert os.path.getsize(fa) > 0
+        writer.close()